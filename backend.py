@@ -8,7 +8,9 @@ from fastapi.openapi.docs import (
 from fastapi.staticfiles import StaticFiles
 
 from dd_parser import dd_parser_router
+from dd_parser.logg import init_logging
 
+init_logging()
 
 app = FastAPI(
     title="DDocumentParser",
@@ -50,10 +52,45 @@ async def redoc_html():
         redoc_js_url="/statics/redoc.standalone.js",
     )
 
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="DDocumentParser api server")
+    parser.add_argument("--host", default="0.0.0.0", help="bind host")
+    parser.add_argument("--port", type=int, default=8000, help="bind port")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes. Use `os.cpu_count()` to scale across all cores of a node")
+    parser.add_argument(
+        "--work-dir", default=None,
+        help="shared work directory. Each worker creates its own subdirectory under it. Overrides env `WORK_DIR`")
+    parser.add_argument(
+        "--limit-concurrency", type=int, default=None,
+        help="max concurrent connections per worker before responding 503")
+    parser.add_argument("--backlog", type=int, default=2048, help="max number of pending connections")
+    parser.add_argument(
+        "--timeout-keep-alive", type=int, default=5,
+        help="seconds to keep idle keep-alive connections open")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    import os
+    import tempfile
     import uvicorn
+
+    args = parse_args()
+    if args.work_dir:
+        os.environ["WORK_DIR"] = args.work_dir
+    elif args.workers > 1 and not os.getenv("WORK_DIR"):
+        #NOTE workers share one work directory, so they share the LibreOffice check cache as well
+        os.environ["WORK_DIR"] = os.path.join(tempfile.gettempdir(), "DDocumentParser")
+
     uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000
-    )
\ No newline at end of file
+        app if args.workers == 1 else "backend:app", #NOTE multi workers require an import string
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        limit_concurrency=args.limit_concurrency,
+        backlog=args.backlog,
+        timeout_keep_alive=args.timeout_keep_alive,
+    )
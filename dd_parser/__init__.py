@@ -1 +1,7 @@
-from .endpoint import router as dd_parser_router
\ No newline at end of file
+def __getattr__(name:str):
+    #NOTE the router pulls in FastAPI and all backends. Imported on first access,
+    # so `import dd_parser.batch` (the CLI) does not pay for the api server
+    if name == "dd_parser_router":
+        from .endpoint import router
+        return router
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
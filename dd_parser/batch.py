@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+from typing import *
+from pathlib import Path
+from concurrent.futures import as_completed
+
+from .logg import logger
+from .tools import get_pure_text, convert_docs_to_docxs
+from .parse import split_text, format_txt_slices
+from .windowing import window_slices, format_txt_windows
+from .markdown import SplitMode, resolve_split_mode
+from .config import SPREADSHEET_CHUNK_CHARS, SPREADSHEET_HEADER_ROWS, EXTRACT_MEMORY_LIMIT
+from .spreadsheet import get_spreadsheet_slices, xlrd_available
+from .store import CorpusStore
+from .sandbox import SandboxPool
+
+SPREADSHEET_SUFFIXES = {".xlsx", ".xls"}
+SUPPORTED_SUFFIXES = {".docx", ".doc", ".pdf", ".md", ".txt", *SPREADSHEET_SUFFIXES}
+
+
+def hash_file(filepath:Union[str, Path]) -> str:
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def format_seconds(seconds:float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class Manifest:
+    """
+    append-only record of processed files, in json lines. The last record of a file wins.
+
+    A file is skipped on resume if it was processed successfully and its size and mtime are unchanged,
+    or its content hash is unchanged.
+
+    Args:
+        filepath (str | Path): manifest filepath
+    """
+    def __init__(self, filepath:Union[str, Path]):
+        self.filepath = Path(filepath)
+        self.entries:dict[str, dict] = {}
+        if self.filepath.exists():
+            with open(self.filepath, "r", encoding="utf8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        #NOTE the last line may be truncated if the previous run was killed
+                        continue
+                    self.entries[entry["path"]] = entry
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.filepath, "a", encoding="utf8")
+
+    def get_done(self, relpath:str) -> Optional[dict]:
+        entry = self.entries.get(relpath)
+        if entry and entry["status"] == "done":
+            return entry
+        return None
+
+    def record(self, entry:dict):
+        self.entries[entry["path"]] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def get_batch_spreadsheet_slices(filepath:str, length_limit:int, limit_unit:str="char") -> list[dict]:
+    #NOTE .xls files are converted to .xlsx by LibreOffice in a temporary directory if `xlrd` is not installed
+    if Path(filepath).suffix.lower() == ".xls" and not xlrd_available():
+        with tempfile.TemporaryDirectory(prefix="convert_xlsx_") as temp_dir:
+            convert_docs_to_docxs(filepath, output_directory=temp_dir, convert_to="xlsx")
+            return get_spreadsheet_slices(
+                Path(temp_dir) / f"{Path(filepath).stem}.xlsx", length_limit, SPREADSHEET_HEADER_ROWS, limit_unit)
+    return get_spreadsheet_slices(filepath, length_limit, SPREADSHEET_HEADER_ROWS, limit_unit)
+
+
+def process_file(
+    filepath:str,
+    output_filepath:str,
+    previous_sha256:Optional[str],
+    options:dict,
+) -> dict:
+    """
+    extract, split and write one file. Runs in worker processes.
+
+    Returns:
+        dict: `sha256` of the file, `status` ("done" or "unchanged" if the content hash equals `previous_sha256`),
+        number of `slices` and `chars` extracted, and the slices themselves as `stored_slices` if they are to be stored
+    """
+    with logger.contextualize(request_id=Path(filepath).name):
+        return _process_file(filepath, output_filepath, previous_sha256, options)
+
+
+def _process_file(
+    filepath:str,
+    output_filepath:str,
+    previous_sha256:Optional[str],
+    options:dict,
+) -> dict:
+    sha256 = hash_file(filepath)
+    if sha256 == previous_sha256 and Path(output_filepath).exists():
+        return dict(sha256=sha256, status="unchanged", slices=0, chars=0)
+
+    if Path(filepath).suffix.lower() in SPREADSHEET_SUFFIXES:
+        slices = get_batch_spreadsheet_slices(
+            filepath, options["length_limit"] or SPREADSHEET_CHUNK_CHARS, options["limit_unit"])
+        chars = sum(len(slice["content"]) for slice in slices)
+    else:
+        text = get_pure_text(filepath)
+        split_mode = resolve_split_mode(options["split_mode"], markdown_source=Path(filepath).suffix.lower() == ".md")
+        slices = split_text(text, options["re_matchers"], options["ignore_matchers"], split_mode)
+        chars = len(text)
+
+    Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
+    temp_filepath = f"{output_filepath}.{os.getpid()}.tmp"
+    windows = None
+    if options["overlap"] is not None:
+        windows = window_slices(
+            slices,
+            length_limit=options["length_limit"],
+            overlap=options["overlap"],
+            filename=Path(filepath).stem,
+            filename_in_chunk=options["filename_in_chunk"],
+            limit_unit=options["limit_unit"],
+        )
+    with open(temp_filepath, "w", encoding="utf8") as f:
+        if windows is not None and options["output_format"] == "json":
+            json.dump(dict(slices=slices, windows=windows), f, ensure_ascii=False, indent=2)
+        elif windows is not None:
+            f.write(format_txt_windows(slices, windows, splitter=options["splitter"]))
+        elif options["output_format"] == "json":
+            json.dump(slices, f, ensure_ascii=False, indent=2)
+        else:
+            f.write(format_txt_slices(
+                slices,
+                filename=Path(filepath).stem,
+                filename_in_chunk=options["filename_in_chunk"],
+                length_limit=options["length_limit"],
+                splitter=options["splitter"],
+                limit_unit=options["limit_unit"],
+            ))
+    os.replace(temp_filepath, output_filepath) #NOTE never leave half-written outputs behind
+    result = dict(sha256=sha256, status="done", slices=len(slices), chars=chars)
+    if options["store"]:
+        #NOTE workers only send slices back if they are stored, the store is written by the main process alone
+        result["stored_slices"] = slices
+    return result
+
+
+def run_batch(
+    input_dir:Union[str, Path],
+    output_dir:Union[str, Path],
+    output_format:Literal["json", "txt"]="txt",
+    workers:Optional[int]=None,
+    re_matchers:Optional[List[str]]=None,
+    ignore_matchers:Optional[List[str]]=None,
+    split_mode:SplitMode="auto",
+    filename_in_chunk:bool=True,
+    length_limit:Optional[int]=None,
+    splitter:str="\n\n\n\n",
+    limit_unit:Literal["char", "token"]="char",
+    overlap:Optional[int]=None,
+    manifest_filepath:Optional[Union[str, Path]]=None,
+    store_path:Optional[Union[str, Path]]=None,
+    timeout:Optional[float]=600.0,
+    force:bool=False,
+    report_interval:float=5.0,
+) -> dict:
+    """
+    preprocess all supported files under input_dir (including subdirectories) in parallel,
+    and write outputs into output_dir with the same directory structure. The output of a file keeps its suffix,
+    like `a.md.txt`, so that `a.md` and `a.txt` never write into the same output.
+
+    Files are processed in sandboxed worker processes (see `SandboxPool`): a file crashing its worker,
+    or running longer than `timeout` seconds, fails alone and its worker is replaced.
+
+    Args:
+        input_dir (str | Path): directory of files to preprocess
+        output_dir (str | Path): directory to write outputs into
+        output_format (Literal['json', 'txt']): output format
+        workers (int): number of worker processes. Default is `os.cpu_count()`
+        re_matchers (List[str]): regular expressions of chapter (and article). Detected per file if not given
+        ignore_matchers (List[str]): regular expressions of lines to be ignored
+        split_mode (SplitMode): `markdown` splits by markdown headings, `regex` by chapter/article patterns,\
+        `auto` uses `markdown` for .md files
+        filename_in_chunk (bool): if True, set filename at the beginning of every chunk. **Only used when `output_format==txt`**
+        length_limit (int): max length in a chunk. **Only used when `output_format==txt`**
+        splitter (str): Text splitter for separating content. **Only used when `output_format==txt`**
+        limit_unit (Literal['char', 'token']): unit of `length_limit`, characters or tokens
+        overlap (int): max length of trailing slices of a chunk repeated in the next chunk. Requires `length_limit`
+        manifest_filepath (str | Path): manifest of processed files. Default is `manifest.jsonl` under output_dir
+        store_path (str | Path): sqlite corpus store to write slices of processed files into, keyed (and named) by their path under input_dir
+        timeout (float): max seconds to process a file, no limit if None
+        force (bool): given True to reprocess files recorded in manifest
+        report_interval (float): seconds between progress reports
+    Returns:
+        dict: summary of the run
+    """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    if not input_dir.is_dir():
+        raise ValueError(f"Input path {input_dir} is not a directory.")
+    if overlap is not None and not (length_limit and 0 <= overlap < length_limit):
+        raise ValueError("`overlap` requires `length_limit`, and must be in [0, length_limit)")
+    if split_mode == "markdown" and re_matchers:
+        raise ValueError("`re_matchers` split by regex patterns, use `split_mode==regex` or `auto`")
+    manifest = Manifest(manifest_filepath or output_dir / "manifest.jsonl")
+    store = CorpusStore(store_path) if store_path else None
+    options = dict(
+        output_format=output_format,
+        re_matchers=re_matchers,
+        ignore_matchers=ignore_matchers,
+        split_mode=split_mode,
+        filename_in_chunk=filename_in_chunk,
+        length_limit=length_limit,
+        splitter=splitter,
+        limit_unit=limit_unit,
+        overlap=overlap,
+        store=store is not None,
+    )
+
+    filepaths = sorted(p for p in input_dir.rglob("*") if p.is_file() and p.suffix.lower() in SUPPORTED_SUFFIXES)
+    jobs = []
+    skipped = 0
+    for filepath in filepaths:
+        relpath = filepath.relative_to(input_dir).as_posix()
+        output_filepath = output_dir / f"{relpath}.{output_format}"
+        stat = filepath.stat()
+        entry = None if force else manifest.get_done(relpath)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns and output_filepath.exists():
+            skipped += 1
+            continue
+        jobs.append((filepath, relpath, output_filepath, stat, entry["sha256"] if entry else None))
+    total_bytes = sum(job[3].st_size for job in jobs)
+    logger.info(
+        f"[batch] {len(filepaths)} files found, {skipped} done already, "
+        f"{len(jobs)} to process ({total_bytes/1024/1024:.1f} MB) with {workers or os.cpu_count()} workers")
+
+    done = unchanged = failed = slices = 0
+    done_bytes = 0
+    start = last_report = time.perf_counter()
+    #NOTE unlike `ProcessPoolExecutor`, a crashed worker fails its own file only instead of breaking the whole pool
+    pool = SandboxPool(
+        "batch", workers=workers or os.cpu_count() or 1, timeout=timeout, memory_limit=EXTRACT_MEMORY_LIMIT or None)
+    try:
+        futures = {
+            pool.submit(process_file, str(filepath), str(output_filepath), previous_sha256, options):
+                (relpath, output_filepath, stat)
+            for filepath, relpath, output_filepath, stat, previous_sha256 in jobs
+        }
+        for finished, future in enumerate(as_completed(futures), start=1):
+            relpath, output_filepath, stat = futures[future]
+            entry = dict(
+                path=relpath,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                output=output_filepath.relative_to(output_dir).as_posix(),
+            )
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f"[batch] failed {relpath}: {e!r}")
+                manifest.record(dict(entry, status="failed", error=repr(e)))
+            else:
+                if result["status"] == "unchanged":
+                    unchanged += 1
+                else:
+                    done += 1
+                    slices += result["slices"]
+                    if store is not None and store.put(relpath, relpath, result["sha256"], result["stored_slices"]):
+                        store.flush()
+                manifest.record(dict(entry, status="done", sha256=result["sha256"], slices=result["slices"]))
+            done_bytes += stat.st_size
+
+            now = time.perf_counter()
+            if now - last_report >= report_interval or finished == len(jobs):
+                last_report = now
+                elapsed = now - start
+                rate = finished / elapsed if elapsed else 0.0
+                eta = (len(jobs) - finished) / rate if rate else 0.0
+                logger.info(
+                    f"[batch] {finished}/{len(jobs)} ({finished/len(jobs):.1%}) "
+                    f"{rate:.1f} files/s, {failed} failed, elapsed {format_seconds(elapsed)}, ETA {format_seconds(eta)}")
+    finally:
+        pool.shutdown(cancel_futures=True)
+        manifest.close()
+        if store is not None:
+            store.close()
+
+    elapsed = time.perf_counter() - start
+    summary = dict(
+        found=len(filepaths),
+        skipped=skipped,
+        processed=done,
+        unchanged=unchanged,
+        failed=failed,
+        slices=slices,
+        seconds=round(elapsed, 3),
+        files_per_second=round((done + unchanged + failed) / elapsed, 3) if elapsed else 0.0,
+        mb_per_second=round(done_bytes / 1024 / 1024 / elapsed, 3) if elapsed else 0.0,
+    )
+    logger.info(
+        f"[batch] finished in {format_seconds(elapsed)}: {done} processed, {unchanged} unchanged, "
+        f"{skipped} skipped, {failed} failed, {slices} slices, "
+        f"{summary['files_per_second']} files/s, {summary['mb_per_second']} MB/s")
+    return summary
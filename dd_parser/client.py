@@ -0,0 +1,245 @@
+import time
+import random
+import asyncio
+from typing import *
+
+if TYPE_CHECKING:
+    import aiohttp
+
+from .logg import logger
+from .limiter import OverloadedError
+from .config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    MINERU_RETRIES,
+    MINERU_BACKOFF_BASE,
+    MINERU_BACKOFF_MAX,
+    MINERU_BREAKER_THRESHOLD,
+    MINERU_BREAKER_RECOVERY,
+)
+
+#NOTE status codes worth retrying. Others (4xx, 500) will fail again with the same input
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class CircuitOpenError(OverloadedError):
+    """raised without calling the remote service, when its circuit is open"""
+    def __init__(self, name:str, retry_after:float):
+        super().__init__(
+            name, 503, retry_after,
+            f"[{name}] circuit open, service unavailable. Retry after {retry_after:.1f}s")
+
+
+class CircuitBreaker:
+    """
+    circuit breaker around a remote service.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail fast with `CircuitOpenError`.
+    After `recovery_timeout` seconds one trial call is let through (half open):
+    the circuit closes if it succeeds, or opens again if it fails.
+
+    Args:
+        name (str): service name, shown in logs and errors
+        failure_threshold (int): consecutive failures to open the circuit
+        recovery_timeout (float): seconds to wait before a trial call
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name:str, failure_threshold:int=5, recovery_timeout:float=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: If the circuit is open, or a trial call is in progress
+        """
+        if self.state == self.CLOSED:
+            return
+        remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+        if self.state == self.OPEN and remaining <= 0:
+            logger.info(f"[{self.name}] circuit half open, trying one call")
+            self.state = self.HALF_OPEN
+            return
+        raise CircuitOpenError(self.name, max(remaining, 1.0))
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"[{self.name}] circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def release(self):
+        """
+        end a call without a result, like a cancelled one. A trial call in progress gives its place to the next call,
+        instead of leaving the circuit half open forever
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.recovery_timeout
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"[{self.name}] circuit open after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class HTTPClientManager:
+    """
+    holds the single keep-alive `aiohttp.ClientSession` shared by all requests of a worker.
+
+    `start()` and `close()` are called in the lifespan of the api.
+    """
+    def __init__(
+        self,
+        limit:int=100,
+        limit_per_host:int=0,
+        ttl_dns_cache:int=300,
+        keepalive_timeout:float=30.0,
+        connect_timeout:float=3.0,
+        read_timeout:float=300.0,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session:Optional["aiohttp.ClientSession"] = None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        import aiohttp #NOTE imported on start instead of on import, aiohttp is slow to import
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            ),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            raise RuntimeError("http client is not started. Call `await HTTP_CLIENT.start()` first.")
+        return self._session
+
+    async def request_json(
+        self,
+        method:str,
+        url:str,
+        *,
+        data_factory:Callable[[], Any]=None,
+        json:Any=None,
+        idempotent:bool=True,
+        retries:int=3,
+        backoff_base:float=0.5,
+        backoff_max:float=10.0,
+        breaker:Optional[CircuitBreaker]=None,
+    ) -> Any:
+        """
+        send a request and return the json body, with retries and circuit breaker.
+
+        Args:
+            method (str): http method
+            url (str): request url
+            data_factory (Callable): returns request body of every attempt.\
+            A factory is required since `aiohttp.FormData` cannot be sent twice
+            json (Any): json request body
+            idempotent (bool): only idempotent requests are retried
+            retries (int): max retries after the first attempt
+            backoff_base (float): backoff of the first retry in seconds, doubled every retry
+            backoff_max (float): max backoff in seconds
+            breaker (CircuitBreaker): circuit breaker around the service
+        Raises:
+            CircuitOpenError: If the circuit is open
+            aiohttp.ClientError: If the request still fails after retries
+            ValueError: If the response body is not valid json
+        """
+        import aiohttp
+        attempts = retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            if breaker:
+                breaker.before_call()
+            try:
+                data = data_factory() if data_factory else None
+                async with self.session.request(method, url, data=data, json=json) as aresp:
+                    if aresp.status in RETRY_STATUS_CODES:
+                        aresp.raise_for_status()
+                    if aresp.status >= 400:
+                        #NOTE the service is alive, the request itself is wrong. Do not retry or trip the breaker
+                        if breaker:
+                            breaker.record_success()
+                        aresp.raise_for_status()
+                    result = await aresp.json()
+            except aiohttp.ContentTypeError:
+                #NOTE the body is not json. Fails again if retried, but the service is broken
+                if breaker:
+                    breaker.record_failure()
+                raise
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUS_CODES:
+                    raise
+                error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            except asyncio.CancelledError:
+                if breaker:
+                    breaker.release()
+                raise
+            except BaseException:
+                #NOTE like an invalid json body. Every call ends in a result of the breaker,
+                # or a trial call would leave the circuit half open forever
+                if breaker:
+                    breaker.record_failure()
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
+
+            if breaker:
+                breaker.record_failure()
+            if attempt == attempts - 1:
+                raise error
+            #NOTE exponential backoff with full jitter, so retries of many requests do not arrive together
+            delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+            logger.warning(f"[{method} {url}] attempt {attempt+1}/{attempts} failed: {error!r}, retry in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+HTTP_CLIENT = HTTPClientManager(
+    limit=HTTP_POOL_LIMIT,
+    limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+    ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+)
+MINERU_BREAKER = CircuitBreaker(
+    "mineru",
+    failure_threshold=MINERU_BREAKER_THRESHOLD,
+    recovery_timeout=MINERU_BREAKER_RECOVERY,
+)
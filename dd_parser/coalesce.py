@@ -0,0 +1,45 @@
+import asyncio
+from typing import *
+
+from .logg import logger
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls with the same key into one in-flight computation.
+
+    The first caller of a key starts the computation, and callers arriving before it finishes
+    await the same result (or exception). The key is released once the computation finishes,
+    so later calls compute again.
+
+    Args:
+        name (str): name shown in logs and stats
+    """
+    def __init__(self, name:str):
+        self.name = name
+        self._in_flight:dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key:str, coro_factory:Callable[[], Awaitable[T]]) -> T:
+        """
+        Args:
+            key (str): calls with the same key share one computation
+            coro_factory (Callable): returns the coroutine to compute. Only called by the first caller of a key
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(coro_factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.info(f"[{self.name}] coalesced into the in-flight computation of {key[:16]}")
+        #NOTE a cancelled caller (like a disconnected client) must not cancel the computation other callers share
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return dict(in_flight=len(self._in_flight), started=self.started, coalesced=self.coalesced)
@@ -1,13 +1,155 @@
 import os
 import tempfile
-import aiohttp
+import threading
+from typing import *
+from shutil import rmtree
 from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
-TEMP_DIR:Path = Path(tempfile.mkdtemp(prefix="DDocumentParser_"))
+_temp_dir:Optional[Path] = None
+_temp_dir_lock = threading.Lock() #NOTE first use may happen in worker threads at the same time
+
+
+def get_work_dir() -> Optional[Path]:
+    """
+    shared work directory for multi-worker deployment, None if not set. Every worker process creates its own
+    subdirectory under it, so that one worker never touches files of another.
+
+    env `WORK_DIR` is read on every call instead of on import, so that `backend.py --work-dir` takes effect
+    after `dd_parser` is imported.
+    """
+    work_dir = os.getenv("WORK_DIR")
+    return Path(work_dir) if work_dir else None
+
+
+def get_temp_dir() -> Path:
+    """temp directory of this process, created on first use instead of on import"""
+    global _temp_dir
+    with _temp_dir_lock:
+        if _temp_dir is None:
+            work_dir = get_work_dir()
+            if work_dir:
+                work_dir.mkdir(parents=True, exist_ok=True)
+                _temp_dir = Path(tempfile.mkdtemp(prefix=f"worker_{os.getpid()}_", dir=work_dir))
+            else:
+                _temp_dir = Path(tempfile.mkdtemp(prefix="DDocumentParser_"))
+        return _temp_dir
+
+
+def remove_temp_dir() -> Optional[Path]:
+    """remove temp directory of this process if created. Returns the removed directory"""
+    global _temp_dir
+    with _temp_dir_lock:
+        temp_dir, _temp_dir = _temp_dir, None
+    if temp_dir is not None:
+        rmtree(temp_dir, ignore_errors=True)
+    return temp_dir
+
+
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+#NOTE `dev`: colorized text logs with variables in tracebacks. `prod`: json logs, INFO or higher, no variables in tracebacks
+LOG_MODE = os.getenv("LOG_MODE", "dev")
+#NOTE per-line debug logs (like ignored lines) are sampled, 1 of every LOG_SAMPLE_EVERY is logged
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 1000))
 MINERU_URL = os.getenv("MINERU_URL", None)
+#NOTE `json`: slices are split by heading levels of MinerU blocks, by regex patterns only if MinerU found no heading.
+# `markdown`: slices are split by regex patterns over the markdown of MinerU
+MINERU_OUTPUT_FORMAT = os.getenv("MINERU_OUTPUT_FORMAT", "json")
+
+def get_libreoffice_check_cache() -> Path:
+    """file caching the result of `soffice --version`, shared by all workers"""
+    return (get_work_dir() or Path(tempfile.gettempdir())) / ".dd_parser_libreoffice_check"
+
+LIBREOFFICE_CHECK_TTL = float(os.getenv("LIBREOFFICE_CHECK_TTL", 3600))
+
+#NOTE admission control and per-stage concurrency limits
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 16))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", 64))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 60))
+RETRY_AFTER = float(os.getenv("RETRY_AFTER", 5))
+LIBREOFFICE_CONCURRENCY = int(os.getenv("LIBREOFFICE_CONCURRENCY", 2))
+MINERU_CONCURRENCY = int(os.getenv("MINERU_CONCURRENCY", 4))
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", os.cpu_count() or 4))
+
+#NOTE extraction (docx, spreadsheets, pdf layouts) runs in sandboxed worker processes, `EXTRACT_CONCURRENCY` of them.
+# A job is killed after `EXTRACT_TIMEOUT` seconds or `EXTRACT_CPU_LIMIT` CPU seconds, and a worker beyond `EXTRACT_MEMORY_LIMIT` MB
+# of address space fails its job. 0 disables the CPU/memory caps, which are POSIX only. LibreOffice is killed after `LIBREOFFICE_TIMEOUT` seconds
+EXTRACT_SANDBOX = os.getenv("EXTRACT_SANDBOX", "true").lower() in ("1", "true", "yes")
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", 120))
+EXTRACT_CPU_LIMIT = float(os.getenv("EXTRACT_CPU_LIMIT", 120))
+EXTRACT_MEMORY_LIMIT = int(os.getenv("EXTRACT_MEMORY_LIMIT", 2048))
+LIBREOFFICE_TIMEOUT = float(os.getenv("LIBREOFFICE_TIMEOUT", 300))
+
+#NOTE shared http client and MinerU retries / circuit breaker
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 0))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 300))
+MINERU_RETRIES = int(os.getenv("MINERU_RETRIES", 3))
+MINERU_BACKOFF_BASE = float(os.getenv("MINERU_BACKOFF_BASE", 0.5))
+MINERU_BACKOFF_MAX = float(os.getenv("MINERU_BACKOFF_MAX", 10))
+MINERU_BREAKER_THRESHOLD = int(os.getenv("MINERU_BREAKER_THRESHOLD", 5))
+MINERU_BREAKER_RECOVERY = float(os.getenv("MINERU_BREAKER_RECOVERY", 30))
+
+#NOTE response compression
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 5))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", 3))
+
+#NOTE optional embedding stage, OpenAI-compatible embeddings endpoint
+EMBEDDING_URL = os.getenv("EMBEDDING_URL", None)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "Qwen3-Embedding-4B")
+EMBEDDING_BATCH_CHARS = int(os.getenv("EMBEDDING_BATCH_CHARS", 16000))
+#NOTE max tokens of a batch, below the token limit of the embedding model (or `--max-batch-tokens` of the server).
+# Counted by the tokenizer of `TOKENIZER_PATH`, or approximated. 0 to limit batches by characters only
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 8192))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 100000))
+
+#NOTE chapters and articles split by regex patterns follow their numbering: a heading numbered out of order
+# (like a reference `第十二条规定的…` wrapped to the start of a line) is body text, unless the next heading continues its numbering.
+# Numbering may skip at most `HEADING_MAX_GAP` numbers, like articles deleted by a revision
+HEADING_MAX_GAP = int(os.getenv("HEADING_MAX_GAP", 3))
+
+#NOTE versions of documents parsed with `document_id`, to diff re-parsed documents against
+VERSION_STORE_DIR = os.getenv("VERSION_STORE_DIR", "./versions")
+
+#NOTE optional sqlite store of parsed documents and slices with full-text search, disabled if not set.
+# Documents are written behind requests, in one transaction per `STORE_BATCH_SIZE` slices or every `STORE_FLUSH_INTERVAL` seconds
+STORE_PATH = os.getenv("STORE_PATH", None)
+STORE_BATCH_SIZE = int(os.getenv("STORE_BATCH_SIZE", 5000))
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", 1))
+#NOTE consecutive flushes failing on a database busy or locked by other processes, before buffered documents are dropped
+STORE_MAX_RETRIES = int(os.getenv("STORE_MAX_RETRIES", 10))
+
+#NOTE max pdf pages whose layouts are cached
+PDF_LAYOUT_CACHE_SIZE = int(os.getenv("PDF_LAYOUT_CACHE_SIZE", 2000))
+
+#NOTE local pdf extraction if `MINERU_URL` is not set or MinerU fails: text layers by layout, and pages without text layer by OCR.
+# `OCR_ENGINE` is a name registered in `dd_parser.ocr.OCR_ENGINES` (`tesseract` requires tesseract and its language data), `none` to disable OCR.
+# Pages are rendered at `OCR_DPI`, lowered so that the longer side of a page is at most `OCR_MAX_SIDE` pixels
+PDF_LOCAL_FALLBACK = os.getenv("PDF_LOCAL_FALLBACK", "true").lower() in ("1", "true", "yes")
+OCR_ENGINE = os.getenv("OCR_ENGINE", "tesseract")
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "chi_sim+eng")
+OCR_DPI = int(os.getenv("OCR_DPI", 300))
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", 4000))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 4))
+#NOTE OCR workers are sandboxed like extraction workers, with the memory cap of `EXTRACT_MEMORY_LIMIT`. A batch of pages is killed after `OCR_TIMEOUT` seconds
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", 600))
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", 2000))
+
+#NOTE max compiled numbering parts of docx templates cached, keyed by content hash of `word/numbering.xml`
+NUMBERING_CACHE_SIZE = int(os.getenv("NUMBERING_CACHE_SIZE", 128))
+
+#NOTE row groups of xlsx/xls sheets, max length of a slice if `length_limit` is not given, and header rows repeated in every slice
+SPREADSHEET_CHUNK_CHARS = int(os.getenv("SPREADSHEET_CHUNK_CHARS", 4000))
+SPREADSHEET_HEADER_ROWS = int(os.getenv("SPREADSHEET_HEADER_ROWS", 1))
 
-HTTP_CLIENT:aiohttp.ClientSession = None
+#NOTE local `tokenizer.json` of the embedding model for `limit_unit=token`, token counts are approximated if not set
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", None)
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 200000))
@@ -0,0 +1,77 @@
+import io
+import codecs
+from typing import *
+
+from .logg import logger
+
+#NOTE longer BOMs first, the utf-32-le BOM starts with the utf-16-le BOM
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+#NOTE tried in order when there is no BOM. GB18030 is a superset of GBK and GB2312, which Windows saves Chinese texts in
+FALLBACK_ENCODINGS = ["utf-8", "gb18030"]
+CHUNK_SIZE = 1024 * 1024
+
+
+def sniff_bom(head:bytes) -> tuple[Optional[str], int]:
+    """encoding and length of the BOM at the beginning of `head`, (None, 0) if there is no BOM"""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    return None, 0
+
+
+def iter_decoded(
+    stream:BinaryIO,
+    encoding:str,
+    errors:str="strict",
+    chunk_size:int=CHUNK_SIZE,
+) -> Iterator[str]:
+    """
+    decode a binary stream chunk by chunk. Line breaks (`\\r\\n`, `\\r`) are normalized into `\\n` in the same pass,
+    including `\\r\\n` split across chunks.
+
+    Raises:
+        UnicodeDecodeError: If the stream is not in `encoding` and `errors=="strict"`
+    """
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors), translate=True)
+    while chunk := stream.read(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def decode_stream(stream:BinaryIO, chunk_size:int=CHUNK_SIZE) -> tuple[str, str]:
+    """
+    decode a seekable binary stream (like a spooled upload) into text with `\\n` line breaks, without writing it to disk.
+
+    The encoding is detected by the BOM, else utf-8 is tried, then gb18030.
+    A failed attempt usually fails within the first non-ascii characters, and the stream is decoded again from its start.
+    Undecodable bytes are replaced if no encoding fits.
+
+    Args:
+        stream (BinaryIO): seekable binary stream, decoded from its current position
+        chunk_size (int): bytes decoded at a time
+    Returns:
+        tuple[str, str]: text, encoding detected
+    """
+    start = stream.tell()
+    encoding, bom_length = sniff_bom(stream.read(4))
+    candidates = [encoding] if encoding else FALLBACK_ENCODINGS
+    for candidate in candidates:
+        stream.seek(start + bom_length)
+        try:
+            return "".join(iter_decoded(stream, candidate, chunk_size=chunk_size)), candidate
+        except UnicodeDecodeError as e:
+            logger.debug(f"[decoding] not {candidate}: {e.reason} at byte {e.start}")
+    logger.warning(f"[decoding] none of {candidates} fits, undecodable bytes are replaced")
+    stream.seek(start + bom_length)
+    return "".join(iter_decoded(stream, candidates[0], errors="replace", chunk_size=chunk_size)), candidates[0]
+
+
+def decode_bytes(data:bytes, chunk_size:int=CHUNK_SIZE) -> tuple[str, str]:
+    """decode bytes in memory, see `decode_stream`. `data` is shared by the stream, not copied as a whole"""
+    return decode_stream(io.BytesIO(data), chunk_size)
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+from typing import *
+from collections import OrderedDict
+
+from .logg import logger
+from .client import HTTP_CLIENT, HTTPClientManager
+from .limiter import EMBEDDING_LIMITER, StageLimiter
+from .tokenizer import get_token_counter
+from .config import (
+    EMBEDDING_URL,
+    EMBEDDING_MODEL,
+    EMBEDDING_BATCH_CHARS,
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_SIZE,
+)
+
+
+class EmbeddingClient:
+    """
+    client of an OpenAI-compatible embeddings endpoint.
+
+    Texts are packed into batches of at most `batch_chars` characters, `batch_tokens` tokens and `batch_size` texts,
+    at most `limiter.concurrency` batches of a call are sent at once under `limiter`,
+    and embeddings of unchanged texts are served from an LRU cache.
+
+    Args:
+        url (str): url of the embeddings endpoint, like `http://127.0.0.1:9000/v1/embeddings`
+        model (str): embedding model name
+        batch_chars (int): max characters of all texts in a batch
+        batch_tokens (int): max tokens of all texts in a batch, counted by `get_token_counter()`. 0 to disable
+        batch_size (int): max texts in a batch
+        cache_size (int): max embeddings cached. 0 to disable cache
+        http_client (HTTPClientManager): shared http client
+        limiter (StageLimiter): limits concurrent embedding requests
+    """
+    def __init__(
+        self,
+        url:str,
+        model:str,
+        batch_chars:int=16000,
+        batch_tokens:int=0,
+        batch_size:int=64,
+        cache_size:int=100000,
+        http_client:HTTPClientManager=HTTP_CLIENT,
+        limiter:StageLimiter=EMBEDDING_LIMITER,
+    ):
+        self.url = url
+        self.model = model
+        self.batch_chars = batch_chars
+        self.batch_tokens = batch_tokens
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.http_client = http_client
+        self.limiter = limiter
+        self._cache:OrderedDict[str, list[float]] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _cache_key(self, text:str) -> str:
+        return hashlib.sha1(f"{self.model}\0{text}".encode("utf8")).hexdigest()
+
+    def _cache_get(self, key:str) -> Optional[list[float]]:
+        embedding = self._cache.get(key)
+        if embedding is not None:
+            self._cache.move_to_end(key)
+        return embedding
+
+    def _cache_put(self, key:str, embedding:list[float]):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = embedding
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def make_batches(self, texts:list[str], token_counts:Optional[list[int]]=None) -> list[list[int]]:
+        """
+        pack texts into batches by character and token budgets, in order.
+        A text longer than `batch_chars` or `batch_tokens` is sent in a batch of its own.
+        Args:
+            texts (list[str]): texts to embed
+            token_counts (list[int]): tokens of every text. Tokens are not limited if None
+        Returns:
+            list[list[int]]: indices of texts of every batch
+        """
+        batches = []
+        batch, batch_chars, batch_tokens = [], 0, 0
+        for i, text in enumerate(texts):
+            tokens = token_counts[i] if token_counts is not None else 0
+            if batch and (
+                batch_chars + len(text) > self.batch_chars
+                or (token_counts is not None and batch_tokens + tokens > self.batch_tokens)
+                or len(batch) >= self.batch_size
+            ):
+                batches.append(batch)
+                batch, batch_chars, batch_tokens = [], 0, 0
+            batch.append(i)
+            batch_chars += len(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _embed_batch(self, texts:list[str]) -> list[list[float]]:
+        payload = dict(model=self.model, input=texts, encoding_format="float")
+        async with self.limiter.acquire():
+            data = await self.http_client.request_json("POST", self.url, json=payload)
+        items = data.get("data", [])
+        if len(items) != len(texts):
+            raise ValueError(f"[embedding] {len(texts)} texts sent, but {len(items)} embeddings returned")
+        #NOTE embeddings are not guaranteed to be returned in order
+        items = sorted(items, key=lambda item: item["index"])
+        return [item["embedding"] for item in items]
+
+    async def aembed(self, texts:list[str]) -> list[list[float]]:
+        """
+        embed texts.
+        Args:
+            texts (list[str]): texts to embed
+        Returns:
+            list[list[float]]: embeddings, in the same order as texts
+        """
+        keys = [self._cache_key(text) for text in texts]
+        embeddings:list[Optional[list[float]]] = [self._cache_get(key) for key in keys]
+
+        #NOTE identical texts are only sent once
+        pending:dict[str, str] = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                pending.setdefault(key, text)
+        self.cache_hits += len(texts) - len(pending)
+        self.cache_misses += len(pending)
+
+        if pending:
+            pending_keys = list(pending.keys())
+            pending_texts = list(pending.values())
+            token_counts = None
+            if self.batch_tokens > 0:
+                token_counts = await asyncio.to_thread(get_token_counter().count_texts, pending_texts)
+            batches = self.make_batches(pending_texts, token_counts)
+            results:list[Optional[list[list[float]]]] = [None] * len(batches)
+            next_batches = iter(range(len(batches)))
+
+            async def worker():
+                #NOTE batches of this call are pulled by a bounded set of workers instead of all queued at once,
+                # so a large document does not queue its own batches behind each other in the limiter
+                for b in next_batches:
+                    results[b] = await self._embed_batch([pending_texts[i] for i in batches[b]])
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(self.limiter.concurrency, len(batches)))]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                raise
+            computed = {}
+            for batch, batch_embeddings in zip(batches, results):
+                for i, embedding in zip(batch, batch_embeddings):
+                    computed[pending_keys[i]] = embedding
+                    self._cache_put(pending_keys[i], embedding)
+            logger.info(
+                f"[embedding] {len(pending_texts)} texts embedded in {len(batches)} batches, "
+                f"{len(texts)-len(pending_texts)} from cache")
+            embeddings = [embedding if embedding is not None else computed[key]
+                          for key, embedding in zip(keys, embeddings)]
+        return embeddings
+
+    def stats(self) -> dict:
+        total = self.cache_hits + self.cache_misses
+        return dict(
+            cached=len(self._cache),
+            hits=self.cache_hits,
+            misses=self.cache_misses,
+            hit_rate=self.cache_hits / total if total else 0.0,
+        )
+
+
+EMBEDDING_CLIENT = EmbeddingClient(
+    url=EMBEDDING_URL,
+    model=EMBEDDING_MODEL,
+    batch_chars=EMBEDDING_BATCH_CHARS,
+    batch_tokens=EMBEDDING_BATCH_TOKENS,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    cache_size=EMBEDDING_CACHE_SIZE,
+)
+
+
+def get_slice_embedding_text(slice:dict) -> str:
+    """text of a slice to embed. The chapter is prepended as context"""
+    if slice["chapter"] and not slice["content"].startswith(slice["chapter"]):
+        return f"{slice['chapter']}\n{slice['content']}"
+    return slice["content"]
+
+
+async def embed_slices(slices:list[dict], client:EmbeddingClient=EMBEDDING_CLIENT) -> list[dict]:
+    """
+    add key `embedding` into every slice.
+    Raises:
+        ValueError: If `EMBEDDING_URL` is not set
+    """
+    if not client.url:
+        raise ValueError("`EMBEDDING_URL` is not set, cannot embed slices")
+    #NOTE empty slices (chapters without content) are not embedded
+    to_embed = [slice for slice in slices if slice["content"].strip()]
+    embeddings = await client.aembed([get_slice_embedding_text(slice) for slice in to_embed])
+    for slice in slices:
+        slice["embedding"] = None
+    for slice, embedding in zip(to_embed, embeddings):
+        slice["embedding"] = embedding
+    return slices
@@ -1,32 +1,47 @@
-from shutil import rmtree
+from typing import *
 from pathlib import Path
 from contextlib import asynccontextmanager
 
-import aiohttp
-
-from fastapi import APIRouter, Form
+from fastapi import APIRouter, Form, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
 from .logg import logger
-from .config import HTTP_CLIENT, TEMP_DIR
+from .config import remove_temp_dir
+from .client import HTTP_CLIENT, MINERU_BREAKER
 from .tools import async_wrapper, acheck_libreoffice
 from .schemas import SupportedFileTypes, ParsedFormData
-from .parse import preprocess_before_chunk
+from .parse import preprocess_before_chunk, PARSE_FLIGHT, CONVERT_FLIGHT
+from .tokenizer import get_token_count_stats
+from .numbering import get_numbering_cache_info
+from .pdf_layout import get_pdf_layout_cache_info
+from .ocr import get_ocr_cache_info, get_ocr_executor, shutdown_ocr_executor
+from .sandbox import EXTRACT_POOL, ExtractionError, merge_cache_stats
+from .limiter import OverloadedError, get_limiter_stats
+from .responses import negotiated_response
+from .timing import request_timer
+from .embedding import EMBEDDING_CLIENT
+from .store import CORPUS_STORE, CorpusStore
+from .versioning import VersionConflictError
 
 
 @asynccontextmanager
 async def lifespan(app:APIRouter):
-    global HTTP_CLIENT
     logger.info("[dd_parser api] start")
     await acheck_libreoffice()
-    HTTP_CLIENT = aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=False,),
-        timeout=aiohttp.ClientTimeout(sock_connect=3.0,sock_read=300.0)
-    )
+    await HTTP_CLIENT.start()
+    if CORPUS_STORE is not None:
+        await CORPUS_STORE.start()
     yield
     logger.info("[shuting down] remove duplicate components")
     await HTTP_CLIENT.close()
-    await async_wrapper(rmtree, TEMP_DIR) #NOTE I should delete all files under temp_dir manually
-    logger.info(f"[shuting down] temp_dir:({TEMP_DIR}) removed properly")
+    if CORPUS_STORE is not None:
+        await CORPUS_STORE.aclose()
+    await async_wrapper(shutdown_ocr_executor)
+    await async_wrapper(EXTRACT_POOL.shutdown)
+    #NOTE the temp dir is this worker's own directory (a subdirectory of WORK_DIR in multi-worker mode),
+    # so files of other workers sharing WORK_DIR are never touched. Nothing to remove if no file was uploaded
+    temp_dir = await async_wrapper(remove_temp_dir)
+    logger.info(f"[shuting down] temp_dir:({temp_dir}) removed properly")
     await logger.complete()
 
 router=APIRouter(
@@ -35,11 +50,112 @@ router=APIRouter(
 
 @router.post(
     "/parse/",
-    description=f"api to parse your document. Currently supported formats: {str(SupportedFileTypes.get_developed())}"
+    description=(
+        f"api to parse your document. Currently supported formats: {str(SupportedFileTypes.get_developed())}\n\n"
+        "Response is compressed by `Accept-Encoding` (zstd, gzip), "
+        "and serialized in msgpack if `Accept: application/msgpack` is given. "
+        "Milliseconds of every pipeline stage are reported by the `Server-Timing` header."
+    )
 )
 async def parse_api(
+    request: Request,
     form_data: ParsedFormData = Form(..., media_type="multipart/form-data")):
 
-    logger.info(f"[request received] {form_data.request_id}")
-    slices = await preprocess_before_chunk(form_data)
-    return slices
+    #NOTE every log of this request carries its request_id, including logs in worker threads
+    with logger.contextualize(request_id=form_data.request_id), request_timer() as timer:
+        logger.info(f"[request received] {form_data.request_id}")
+        try:
+            #NOTE admitted by `REQUEST_LIMITER` inside, where concurrent identical requests are coalesced
+            slices = await preprocess_before_chunk(form_data)
+        except OverloadedError as e:
+            logger.warning(f"[request rejected] {form_data.request_id} {e}")
+            raise HTTPException(
+                status_code=e.status_code,
+                detail=str(e),
+                headers={"Retry-After": str(int(e.retry_after))},
+            )
+        except ExtractionError as e:
+            #NOTE the job breached its limits and its worker was replaced, other requests are not affected
+            logger.warning(f"[extraction failed] {form_data.request_id} {e.reason}: {e}")
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        except VersionConflictError as e:
+            logger.warning(f"[version conflict] {form_data.request_id} {e}")
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        if isinstance(slices, str):
+            size_hint = len(slices)
+        elif isinstance(slices, dict) and "windows" in slices: #NOTE overlapping windows refer to slices
+            size_hint = sum(len(slice["content"]) for slice in slices["slices"])
+        elif isinstance(slices, dict): #NOTE diff against the last version
+            size_hint = sum(len(slice["content"]) for slice in slices["added"] + slices["changed"])
+        else:
+            size_hint = sum(len(slice["content"]) for slice in slices)
+        response = await negotiated_response(request, slices, payload_size_hint=size_hint, timer=timer)
+        logger.info(f"[timing] {timer.summary()}")
+        return response
+
+
+@router.get(
+    "/status/",
+    description="queue depth, in-flight jobs and wait time of every pipeline stage, state of circuit breakers, cache hit rates, coalesced requests, failures of sandboxed extraction workers and writes of the corpus store"
+)
+async def status_api():
+    #NOTE caches filled by extraction live in sandboxed workers, their stats are summed with the ones of this process
+    worker_caches = EXTRACT_POOL.cache_stats()
+    return dict(
+        stages=get_limiter_stats(),
+        circuits={MINERU_BREAKER.name: MINERU_BREAKER.state},
+        caches={
+            "embedding": EMBEDDING_CLIENT.stats(),
+            "token_counts": merge_cache_stats(get_token_count_stats(), worker_caches.get("token_counts")),
+            "docx_numbering": merge_cache_stats(get_numbering_cache_info(), worker_caches.get("docx_numbering")),
+            "pdf_layout": merge_cache_stats(get_pdf_layout_cache_info(), worker_caches.get("pdf_layout")),
+            "pdf_ocr": get_ocr_cache_info(),
+        },
+        coalescing={flight.name: flight.stats() for flight in [PARSE_FLIGHT, CONVERT_FLIGHT]},
+        sandboxes={pool.name: pool.stats() for pool in [EXTRACT_POOL, get_ocr_executor()]},
+        store=CORPUS_STORE.stats() if CORPUS_STORE is not None else None,
+    )
+
+
+async def get_corpus_store() -> CorpusStore:
+    """the corpus store with buffered documents written, so that they are found"""
+    if CORPUS_STORE is None:
+        raise HTTPException(status_code=404, detail="corpus store is disabled, set `STORE_PATH` to enable it")
+    await CORPUS_STORE.aflush()
+    return CORPUS_STORE
+
+
+@router.get(
+    "/store/export/",
+    description=(
+        "export stored slices as newline delimited json, one slice per line in document and slice order, "
+        "with `document_id` (the `document_id` given to `/parse/`, or the content hash), `filename` and `position`. "
+        "Requires `STORE_PATH`."
+    )
+)
+async def store_export_api(
+    document_id: Optional[List[str]] = Query(None, description="export only these documents, can be given multiple times"),
+    filename: Optional[str] = Query(None, description="export only documents whose filename matches this glob, like `*.pdf`"),
+    since: Optional[float] = Query(None, description="export only documents parsed since this unix timestamp"),
+    q: Optional[str] = Query(None, description="export only slices containing all these terms, separated by spaces")):
+
+    store = await get_corpus_store()
+    return StreamingResponse(
+        store.aiter_ndjson(document_ids=document_id, filename=filename, since=since, query=q),
+        media_type="application/x-ndjson")
+
+
+@router.get(
+    "/store/search/",
+    description="full-text search over stored slices, best matches first, with a `snippet` around the terms. Requires `STORE_PATH`."
+)
+async def store_search_api(
+    request: Request,
+    q: str = Query(..., min_length=1, description="terms separated by spaces, all of them must be found in a slice"),
+    limit: int = Query(20, ge=1, le=1000),
+    document_id: Optional[List[str]] = Query(None, description="search only in these documents"),
+    filename: Optional[str] = Query(None, description="search only in documents whose filename matches this glob")):
+
+    store = await get_corpus_store()
+    hits = await store.asearch(q, limit=limit, document_ids=document_id, filename=filename)
+    return await negotiated_response(request, hits, payload_size_hint=sum(len(hit["content"]) for hit in hits))
@@ -0,0 +1,157 @@
+import time
+import asyncio
+from typing import *
+from contextlib import asynccontextmanager
+
+from .logg import logger
+from .config import (
+    QUEUE_TIMEOUT,
+    RETRY_AFTER,
+    MAX_CONCURRENT_REQUESTS,
+    MAX_QUEUED_REQUESTS,
+    LIBREOFFICE_CONCURRENCY,
+    MINERU_CONCURRENCY,
+    EXTRACT_CONCURRENCY,
+    EMBEDDING_CONCURRENCY,
+)
+
+
+class OverloadedError(Exception):
+    """raised when a stage cannot admit more work. Should be returned as 429/503 with `Retry-After`"""
+    def __init__(self, stage:str, status_code:int, retry_after:float, message:str):
+        super().__init__(message)
+        self.stage = stage
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class StageLimiter:
+    """
+    concurrency limiter of a pipeline stage, with a bounded wait queue.
+
+    At most `concurrency` jobs run in the stage. Jobs beyond that wait in a queue of at most
+    `max_waiting` jobs (unbounded if None) for at most `wait_timeout` seconds.
+
+    Args:
+        name (str): stage name, shown in logs and stats
+        concurrency (int): max jobs running in the stage at the same time
+        max_waiting (int | None): max jobs waiting for the stage. Jobs beyond it are rejected with 429 immediately
+        wait_timeout (float | None): max seconds a job waits. Jobs waiting longer are rejected with 503
+        retry_after (float): seconds suggested to clients in `Retry-After` header once rejected
+    """
+    def __init__(
+        self,
+        name:str,
+        concurrency:int,
+        max_waiting:Optional[int]=None,
+        wait_timeout:Optional[float]=None,
+        retry_after:float=5.0,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        hold a slot of the stage in the context.
+        Raises:
+            OverloadedError: If the wait queue is full or waiting times out
+        """
+        if self._semaphore.locked() and self.max_waiting is not None and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise OverloadedError(
+                self.name, 429, self.retry_after,
+                f"[{self.name}] too many requests, {self.waiting} requests are waiting already")
+
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise OverloadedError(
+                self.name, 503, self.retry_after,
+                f"[{self.name}] service busy, waited more than {self.wait_timeout}s")
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > 0.1:
+            logger.debug(f"[{self.name}] waited {waited:.3f}s in queue, {self.waiting} still waiting")
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        """queue depth and wait time of the stage"""
+        return dict(
+            concurrency=self.concurrency,
+            in_flight=self.in_flight,
+            waiting=self.waiting,
+            max_waiting=self.max_waiting,
+            admitted=self.admitted,
+            rejected=self.rejected,
+            avg_wait=self.total_wait / self.admitted if self.admitted else 0.0,
+            max_wait=self.max_wait,
+        )
+
+
+#NOTE admission of whole `/parse/` requests. The bounded queue is here,
+# stage limiters below do not need one since admitted requests are bounded already
+REQUEST_LIMITER = StageLimiter(
+    "request",
+    concurrency=MAX_CONCURRENT_REQUESTS,
+    max_waiting=MAX_QUEUED_REQUESTS,
+    wait_timeout=QUEUE_TIMEOUT,
+    retry_after=RETRY_AFTER,
+)
+LIBREOFFICE_LIMITER = StageLimiter(
+    "libreoffice",
+    concurrency=LIBREOFFICE_CONCURRENCY,
+    wait_timeout=QUEUE_TIMEOUT,
+    retry_after=RETRY_AFTER,
+)
+MINERU_LIMITER = StageLimiter(
+    "mineru",
+    concurrency=MINERU_CONCURRENCY,
+    wait_timeout=QUEUE_TIMEOUT,
+    retry_after=RETRY_AFTER,
+)
+EXTRACT_LIMITER = StageLimiter(
+    "extract",
+    concurrency=EXTRACT_CONCURRENCY,
+    wait_timeout=QUEUE_TIMEOUT,
+    retry_after=RETRY_AFTER,
+)
+
+#NOTE no wait timeout: batches belong to requests admitted already, failing one of them midway
+# would waste the batches embedded before it
+EMBEDDING_LIMITER = StageLimiter(
+    "embedding",
+    concurrency=EMBEDDING_CONCURRENCY,
+    retry_after=RETRY_AFTER,
+)
+
+LIMITERS = [REQUEST_LIMITER, LIBREOFFICE_LIMITER, MINERU_LIMITER, EXTRACT_LIMITER, EMBEDDING_LIMITER]
+
+
+def get_limiter_stats() -> dict[str, dict]:
+    return {limiter.name: limiter.stats() for limiter in LIMITERS}
@@ -1,42 +1,115 @@
 import os
 import sys
+import time
+from pathlib import Path
+from contextlib import suppress
+from collections import Counter
 
 from loguru import logger
 
-from .config import LOG_LEVEL
+from .config import LOG_LEVEL, LOG_MODE, LOG_SAMPLE_EVERY
 
 folder_ = "./log/"
 rotation_ = "10 MB"
-retention_ = "30 days"
+retention_days_ = 30
+retention_ = f"{retention_days_} days"
 encoding_ = "utf-8"
-backtrace_ = True
-diagnose_ = True
+#NOTE `diagnose` renders variable values into tracebacks, which is slow and may leak document texts. Only in dev mode
+backtrace_ = LOG_MODE != "prod"
+diagnose_ = LOG_MODE != "prod"
+serialize_ = LOG_MODE == "prod" #NOTE one json object per line in prod mode, with `request_id` in `extra`
+#NOTE no debug logs in prod mode
+level_ = LOG_LEVEL if LOG_MODE != "prod" or logger.level(LOG_LEVEL).no >= logger.level("INFO").no else "INFO"
 
-logger.remove() #NOTE remove all preset logger
+#NOTE `request_id` is bound by `logger.contextualize(request_id=...)`, which is backed by contextvars,
+# so it follows the request across awaits and `asyncio.to_thread`. "-" outside of requests
+logger.configure(extra={"request_id": "-"})
 # 格式里面添加了process和thread记录，方便查看多进程和线程程序
 format_ = (
 '<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> '
-# '| <magenta>{process}</magenta>:<yellow>{thread}</yellow> ' #NOTE 
+# '| <magenta>{process}</magenta>:<yellow>{thread}</yellow> ' #NOTE
+'| <magenta>{extra[request_id]}</magenta> '
 '| <cyan>{file}</cyan>:<yellow>{line}</yellow>@<cyan>{function}</cyan> - <level>{message}</level>'
 ) #NOTE {file}:{line}@{function} allows you to directly trace back to the executing line in vscode.
 
+_initialized = False
+#NOTE checked before building per-line log messages in hot loops. loguru logs DEBUG by default before `init_logging`
+DEBUG_ENABLED = True
 
-logger.add(
-    sys.stderr,
-    level=LOG_LEVEL,
-    format=format_,
-    colorize=True,
-    backtrace=backtrace_, diagnose=diagnose_,
-    # filter=lambda record: record["level"].no >= logger.level("CRITICAL").no
-)
-
-logger.add(
-    folder_+"logs/app_{time:YYYY-MM-DD}.log",
-    level=LOG_LEVEL,
-    format=format_,
-    colorize=False, #NOTE logging into file cannot set color. You don't want your log file contains text like `[32m2025-10-26 12:58:59[0m ``
-    backtrace=backtrace_, diagnose=diagnose_,
-    enqueue=True, #NOTE to avoid logging everywhere in multi processing or asyncio program.
-    encoding=encoding_,
-    rotation=rotation_,retention=retention_,
-)
\ No newline at end of file
+
+def init_logging(enqueue:bool=True):
+    """
+    add stderr and file sinks. Called once by entry points (api server, batch CLI) instead of on import,
+    so importing `dd_parser` as a library creates no log files.
+
+    Args:
+        enqueue (bool): write logs in a background thread. Given False in processes which may be killed at any time
+        (sandboxed workers), whose queues would leak their semaphores
+    """
+    global _initialized, DEBUG_ENABLED
+    if _initialized:
+        return
+    _initialized = True
+    logger.remove() #NOTE remove all preset logger
+    logger.add(
+        sys.stderr,
+        level=level_,
+        format=format_,
+        colorize=not serialize_,
+        serialize=serialize_,
+        backtrace=backtrace_, diagnose=diagnose_,
+        enqueue=enqueue, #NOTE writing to stderr happens in a background thread, never blocks the event loop
+        # filter=lambda record: record["level"].no >= logger.level("CRITICAL").no
+    )
+
+    #NOTE every process (api workers, sandboxed workers, batch workers) writes and rotates a file of its own,
+    # processes sharing a file would rotate it under each other
+    _remove_expired_logs()
+    logger.add(
+        folder_+"logs/app_{time:YYYY-MM-DD}_"+str(os.getpid())+".log",
+        level=level_,
+        format=format_,
+        colorize=False, #NOTE logging into file cannot set color. You don't want your log file contains text like `[32m2025-10-26 12:58:59[0m ``
+        serialize=serialize_,
+        backtrace=backtrace_, diagnose=diagnose_,
+        enqueue=enqueue, #NOTE to avoid logging everywhere in multi processing or asyncio program.
+        encoding=encoding_,
+        rotation=rotation_,retention=retention_,
+    )
+    DEBUG_ENABLED = logger.level(level_).no <= logger.level("DEBUG").no
+
+
+def _remove_expired_logs():
+    """
+    remove log files not modified for `retention_days_`. The retention of a sink only cleans files of its own process,
+    so files of processes gone (like replaced workers) are cleaned here
+    """
+    deadline = time.time() - retention_days_ * 24 * 3600
+    for filepath in Path(folder_, "logs").glob("app_*.log*"):
+        with suppress(OSError): #NOTE removed by another process meanwhile
+            if filepath.stat().st_mtime < deadline:
+                filepath.unlink()
+
+
+class SampledLogger:
+    """
+    logs 1 of every `every` messages per key, for per-line logs in hot loops.
+    Messages are formatted lazily by loguru (`{}` placeholders), so skipped messages cost a counter increment.
+
+    Args:
+        every (int): log 1 of every `every` messages of a key
+    """
+    def __init__(self, every:int):
+        self.every = max(every, 1)
+        self._counts = Counter()
+
+    def debug(self, key:str, message:str, *args):
+        if not DEBUG_ENABLED:
+            return
+        count = self._counts[key]
+        self._counts[key] = count + 1
+        if count % self.every == 0:
+            logger.opt(depth=1).debug(f"{message} [sampled, {count + 1} so far]", *args)
+
+
+sampled_logger = SampledLogger(LOG_SAMPLE_EVERY)
@@ -0,0 +1,265 @@
+from typing import *
+from collections import Counter
+
+import regex as re
+
+from .logg import logger
+from .offsets import LineOffsets
+
+
+#NOTE `auto`: markdown headings for markdown sources (.md files, MinerU markdown), regex patterns for others
+SplitMode:TypeAlias = Literal["auto", "regex", "markdown"]
+
+
+def resolve_split_mode(split_mode:SplitMode, markdown_source:bool) -> Literal["regex", "markdown"]:
+    if split_mode == "auto":
+        return "markdown" if markdown_source else "regex"
+    return split_mode
+
+
+class MarkdownBlock(NamedTuple):
+    kind: Literal["heading", "paragraph", "code", "table", "list"]
+    level: Optional[int] # heading level, None for other blocks
+    text: str
+    first_line: int # indices of the first and last line of the block in `text.splitlines()`, see `LineOffsets`
+    last_line: int
+
+
+atx_heading_pattern = re.compile(r"^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+setext_underline_pattern = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+fence_pattern = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+thematic_break_pattern = re.compile(r"^ {0,3}(?:(?:\*[ \t]*){3,}|(?:-[ \t]*){3,}|(?:_[ \t]*){3,})$")
+list_item_pattern = re.compile(r"^[ \t]*(?:[-+*]|\d{1,9}[.)])(?:[ \t]+|$)")
+table_delimiter_pattern = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+
+
+def _count_cells(row:str) -> int:
+    return len(row.strip().strip("|").split("|"))
+
+
+def iter_markdown_blocks(
+    text:str,
+    ignore_patterns:List[re.Pattern]=[],
+) -> Iterator[MarkdownBlock]:
+    """
+    single-pass line scanner of markdown, in linear time without building a syntax tree.
+
+    Recognizes ATX (`## title`) and setext (`title` underlined by `===`/`---`) headings, fenced code blocks,
+    pipe tables and lists. Headings inside code blocks are code. Code blocks and tables are yielded whole,
+    lines of paragraphs and lists are stripped. Blocks keep indices of their first and last lines.
+
+    Args:
+        text (str): markdown text
+        ignore_patterns (List[re.Pattern]): heading, paragraph and list lines are ignored once matched.\
+        Lines of code blocks and tables are kept as is
+    Yields:
+        MarkdownBlock: blocks in document order
+    """
+    paragraph:list[str] = []
+    paragraph_lines:list[int] = [] #NOTE line indices of the paragraph, its last line may become a table header
+    buffer:list[str] = [] #NOTE lines of the open code block, table or list
+    buffer_first = buffer_last = 0
+    open_kind:Optional[str] = None
+    fence = ""
+    list_blank = False #NOTE a blank line inside a list, the list goes on if the next line is indented or an item
+
+    def ignored(line:str) -> bool:
+        return bool(ignore_patterns) and any(pattern.search(line) for pattern in ignore_patterns)
+
+    def flush_paragraph() -> Iterator[MarkdownBlock]:
+        if paragraph:
+            yield MarkdownBlock("paragraph", None, "\n".join(paragraph), paragraph_lines[0], paragraph_lines[-1])
+            paragraph.clear()
+            paragraph_lines.clear()
+
+    for i, line in enumerate(text.splitlines()):
+        if open_kind == "code":
+            buffer.append(line)
+            stripped = line.strip()
+            if stripped:
+                buffer_last = i
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                yield MarkdownBlock("code", None, "\n".join(buffer), buffer_first, buffer_last)
+                buffer, open_kind = [], None
+            continue
+        stripped = line.strip()
+        if open_kind == "table":
+            if stripped and "|" in stripped:
+                buffer.append(stripped)
+                buffer_last = i
+                continue
+            yield MarkdownBlock("table", None, "\n".join(buffer), buffer_first, buffer_last)
+            buffer, open_kind = [], None
+        elif open_kind == "list":
+            if not stripped:
+                list_blank = True
+                continue
+            #NOTE items and indented lines continue the list, and so do lazy continuation lines right after a list line
+            lazy = not list_blank and not (
+                fence_pattern.match(line) or atx_heading_pattern.match(line) or thematic_break_pattern.match(line))
+            if list_item_pattern.match(line) or line[:1] in (" ", "\t") or lazy:
+                list_blank = False
+                if not ignored(stripped):
+                    if not buffer:
+                        buffer_first = i
+                    buffer.append(line.rstrip())
+                    buffer_last = i
+                continue
+            if buffer:
+                yield MarkdownBlock("list", None, "\n".join(buffer), buffer_first, buffer_last)
+            buffer, open_kind, list_blank = [], None, False
+
+        if not stripped:
+            yield from flush_paragraph()
+            continue
+        #NOTE most lines are paragraph lines, patterns are only tried on lines starting with their markers
+        first = stripped[0]
+        if first in "`~":
+            matched = fence_pattern.match(line)
+            if matched:
+                yield from flush_paragraph()
+                fence, open_kind, buffer = matched.group(1), "code", [line]
+                buffer_first = buffer_last = i
+                continue
+        elif first == "#":
+            matched = atx_heading_pattern.match(line)
+            if matched:
+                yield from flush_paragraph()
+                if not ignored(stripped):
+                    yield MarkdownBlock("heading", len(matched.group(1)), (matched.group(2) or "").strip(), i, i)
+                continue
+        if paragraph and first in "=-":
+            matched = setext_underline_pattern.match(line)
+            if matched:
+                level = 1 if matched.group(1)[0] == "=" else 2
+                heading = " ".join(paragraph)
+                heading_first = paragraph_lines[0]
+                paragraph.clear()
+                paragraph_lines.clear()
+                yield MarkdownBlock("heading", level, heading, heading_first, i)
+                continue
+        if paragraph and "|" in stripped and "|" in paragraph[-1] \
+                and table_delimiter_pattern.match(line) and _count_cells(stripped) == _count_cells(paragraph[-1]):
+            #NOTE the last paragraph line is the header row of the table
+            header = paragraph.pop()
+            buffer_first, buffer_last = paragraph_lines.pop(), i
+            yield from flush_paragraph()
+            open_kind, buffer = "table", [header, stripped]
+            continue
+        if first in "-*_" and thematic_break_pattern.match(line):
+            yield from flush_paragraph()
+            continue
+        if (first in "-+*" or first.isdigit()) and list_item_pattern.match(line):
+            yield from flush_paragraph()
+            open_kind, buffer, list_blank = "list", [], False
+            if not ignored(stripped):
+                buffer.append(line.rstrip())
+                buffer_first = buffer_last = i
+            continue
+        if not ignored(stripped):
+            paragraph.append(stripped)
+            paragraph_lines.append(i)
+
+    yield from flush_paragraph()
+    if buffer:
+        #NOTE an unclosed code block runs to the end of the document
+        yield MarkdownBlock(open_kind, None, "\n".join(buffer), buffer_first, buffer_last)
+
+
+def get_chapter_level(levels:Iterable[int]) -> Optional[int]:
+    """
+    heading level of chapters: the top level used by more than one heading,
+    so a single document title above the chapters does not turn the whole document into one chapter.
+    """
+    counts = Counter(levels)
+    if not counts:
+        return None
+    repeated = [level for level, count in counts.items() if count > 1]
+    return min(repeated) if repeated else min(counts)
+
+
+def split_by_headings(
+    items:Iterable[tuple[Optional[int], str, int, int]],
+    span:Optional[Callable[[int, int], tuple[int, int]]]=None,
+) -> Optional[list[dict[str,str]]]:
+    """
+    split blocks into slices by their heading levels.
+
+    Headings at or above the chapter level (see `get_chapter_level`) become chapters,
+    and deeper headings become articles (the nearest heading above a block).
+    As with `double_patterns_preprocess`, chapter lines are not in contents, article lines are the first line of their contents.
+    Blocks are never split. Slices span the offsets of their blocks, and a chapter without content its heading.
+
+    Args:
+        items (Iterable[tuple[Optional[int], str, int, int]]): heading level (None for other blocks), text,\
+        and the first and last position of blocks, `[start, end)` character offsets unless `span` is given
+        span (Callable): converts the first position of the first block and the last position of the last block of a slice\
+        into its character offsets, like `LineOffsets.span` of line indices. Only called once per slice
+    Returns:
+        list[dict[str,str]]: slices with `start`/`end` offsets, None if there is no heading
+    """
+    items = list(items)
+    chapter_level = get_chapter_level(level for level, *_ in items if level is not None)
+    if chapter_level is None:
+        return None
+
+    last_chapter = ""
+    last_article = ""
+    buffer = []
+    buffer_first = buffer_last = chapter_first = chapter_last = 0
+    slices = []
+    span = span or (lambda start, end: (start, end))
+    def add_slice(chapter:str, article:str, content:str, first:int, last:int):
+        start, end = span(first, last)
+        slices.append({"chapter": chapter, "article": article, "content": content, "start": start, "end": end})
+
+    def flush_chapter():
+        if buffer:
+            add_slice(last_chapter, last_article, "\n".join(buffer), buffer_first, buffer_last)
+            buffer.clear()
+        elif last_chapter and (not slices or slices[-1]["chapter"] != last_chapter):
+            #NOTE a chapter without any content still gets a slice, like `double_patterns_preprocess`
+            add_slice(last_chapter, "", "", chapter_first, chapter_last)
+
+    for level, text, first, last in items:
+        if level is None:
+            if not buffer:
+                buffer_first = first
+            buffer.append(text)
+            buffer_last = last
+        elif level <= chapter_level:
+            flush_chapter()
+            last_chapter, last_article = text.replace("\n", " "), ""
+            chapter_first, chapter_last = first, last
+        else:
+            if buffer:
+                add_slice(last_chapter, last_article, "\n".join(buffer), buffer_first, buffer_last)
+                buffer.clear()
+            last_article = text.replace("\n", " ")
+            buffer.append(last_article)
+            buffer_first, buffer_last = first, last
+    flush_chapter()
+    return slices
+
+
+def markdown_to_slices(
+    text:str,
+    ignore_patterns:List[re.Pattern]=[],
+) -> Optional[list[dict[str,str]]]:
+    """
+    split markdown into slices by its heading hierarchy (see `split_by_headings`).
+    Tables and code blocks are never split, and headings inside code blocks are not headings.
+
+    Args:
+        text (str): markdown text
+        ignore_patterns (List[re.Pattern]): lines are ignored once matched, see `iter_markdown_blocks`
+    Returns:
+        list[dict[str,str]]: slices, None if there is no heading and regex patterns are required
+    """
+    slices = split_by_headings(
+        ((block.level, block.text, block.first_line, block.last_line)
+         for block in iter_markdown_blocks(text, ignore_patterns) if block.text),
+        span=LineOffsets(text).span)
+    if slices is not None:
+        logger.info(f"✅ [markdown] {len(slices)} slices split by markdown headings")
+    return slices
@@ -0,0 +1,175 @@
+from typing import *
+from html import unescape
+
+import regex as re
+
+from .logg import logger
+from .spreadsheet import format_row
+from .markdown import split_by_headings
+from .offsets import UnitIndex
+
+#NOTE page furniture, never part of the content
+DISCARDED_TYPES = {"header", "footer", "page_number", "page_footnote", "aside_text", "discarded"}
+
+
+#NOTE MinerU tables are flat `<table><tr><td>` markup, scanned by regex instead of a full html parser
+table_row_pattern = re.compile(r"<tr[^>]*>(.*?)</tr>", re.S | re.I)
+table_cell_pattern = re.compile(r"<t[dh][^>]*>(.*?)</t[dh]>", re.S | re.I)
+html_tag_pattern = re.compile(r"<[^>]+>")
+
+
+def format_html_table(html:str) -> str:
+    """format an html table into rows of `cell | cell`, like pdf tables and spreadsheets. Spanned cells are kept once"""
+    rows = []
+    for row in table_row_pattern.findall(html):
+        cells = [unescape(html_tag_pattern.sub(" ", cell)) for cell in table_cell_pattern.findall(row)]
+        row = format_row(cells)
+        if row:
+            rows.append(row)
+    return "\n".join(rows)
+
+
+def _get_block_text(block:dict) -> str:
+    block_type = block.get("type")
+    if block_type == "text" or block_type == "title" or block_type == "equation":
+        #NOTE fast path, most blocks are paragraphs
+        text = block.get("text")
+        return text.strip() if text else ""
+    match block_type:
+        case "table":
+            #NOTE MinerU gives tables as html. Tables recognized as images only have captions
+            parts = [
+                *block.get("table_caption", []),
+                format_html_table(block.get("table_body") or ""),
+                *block.get("table_footnote", [])]
+        case "image" | "chart":
+            parts = [*block.get("image_caption", []), *block.get("image_footnote", [])]
+        case "list":
+            parts = block.get("list_items", [])
+        case _:
+            parts = [block.get("text") or ""]
+    return "\n".join(part.strip() for part in parts if part and part.strip())
+
+
+def _get_middle_block_text(block:dict) -> str:
+    """text of a `para_block` of MinerU `middle.json`: spans joined by lines, html of table spans"""
+    lines = []
+    for sub_block in block.get("blocks") or [block]:
+        for line in sub_block.get("lines", []):
+            spans = []
+            for span in line.get("spans", []):
+                if span.get("html"):
+                    lines.append(format_html_table(span["html"]))
+                elif span.get("content"):
+                    spans.append(span["content"])
+            if spans:
+                lines.append("".join(spans))
+    return "\n".join(line for line in lines if line.strip())
+
+
+def _from_middle_json(pages:list[dict]) -> list[dict]:
+    """convert `pdf_info` of MinerU `middle.json` into blocks of `content_list.json`"""
+    blocks = []
+    for page in pages:
+        for block in page.get("para_blocks", []):
+            text = _get_middle_block_text(block)
+            if block.get("type") == "title":
+                blocks.append(dict(type="text", text=text, text_level=block.get("level", 1), page_idx=page.get("page_idx")))
+            else:
+                blocks.append(dict(type="text", text=text, page_idx=page.get("page_idx")))
+    return blocks
+
+
+def get_content_list(result:Any) -> Optional[list[dict]]:
+    """
+    blocks of a MinerU result in the format of `content_list.json`, like
+    `{"type": "text", "text": "第一章 总则", "text_level": 1, "page_idx": 0}`.
+
+    Args:
+        result (Any): response of `request_mineru`. `data` is taken if the response wraps it
+    Returns:
+        list[dict]: blocks in reading order, None if the result is not structured (markdown)
+    """
+    if isinstance(result, dict) and "data" in result:
+        result = result["data"]
+    if isinstance(result, dict):
+        if "content_list" in result:
+            result = result["content_list"]
+        elif "pdf_info" in result:
+            return _from_middle_json(result["pdf_info"])
+    if isinstance(result, list) and all(isinstance(block, dict) for block in result):
+        return result
+    return None
+
+
+def _iter_block_texts(blocks:list[dict]) -> Iterator[tuple[dict, str, int]]:
+    #NOTE blocks kept in the text of `get_mineru_text`, with the offsets of their texts in it
+    offset = 0
+    for block in blocks:
+        if block.get("type") in DISCARDED_TYPES:
+            continue
+        text = _get_block_text(block)
+        if text:
+            yield block, text, offset
+            offset += len(text) + 1
+
+
+def get_mineru_text(result:Any) -> str:
+    """plain text of a MinerU result, markdown as is, or blocks joined by lines"""
+    blocks = get_content_list(result)
+    if blocks is None:
+        if isinstance(result, dict) and "data" in result:
+            result = result["data"]
+        return result if isinstance(result, str) else ""
+    return "\n".join(text for _, text, _ in _iter_block_texts(blocks))
+
+
+def get_page_index(blocks:Optional[list[dict]]) -> Optional[UnitIndex]:
+    """
+    offsets where pages start in the text of `get_mineru_text`, by `page_idx` of blocks. Pages are numbered from 1.
+    None if the result is markdown or its blocks have no page.
+    """
+    if not blocks:
+        return None
+    starts, numbers = [], []
+    for block, _, offset in _iter_block_texts(blocks):
+        page = block.get("page_idx")
+        if page is not None and (not numbers or numbers[-1] != int(page) + 1):
+            starts.append(offset)
+            numbers.append(int(page) + 1)
+    return UnitIndex(starts, numbers) if starts else None
+
+
+def get_heading_level(block:dict) -> Optional[int]:
+    """heading level of a block, 1 for the top level. None if it is not a heading"""
+    text_level = block.get("text_level")
+    if text_level:
+        return int(text_level)
+    return 1 if block.get("type") == "title" else None
+
+
+def content_list_to_slices(
+    blocks:list[dict],
+    ignore_patterns:List[re.Pattern]=[],
+) -> Optional[list[dict[str,str]]]:
+    """
+    split MinerU blocks into slices by heading levels MinerU detected, without scanning texts by regex.
+    Slices follow the heading hierarchy like markdown (see `split_by_headings`),
+    and tables are kept inside their slices as rows of `cell | cell`.
+
+    Args:
+        blocks (list[dict]): blocks in the format of `content_list.json`
+        ignore_patterns (List[re.Pattern]): blocks are ignored once matched
+    Returns:
+        list[dict[str,str]]: slices with `start`/`end` offsets in the text of `get_mineru_text`,\
+        None if no heading is found and regex patterns are required
+    """
+    items = []
+    for block, text, offset in _iter_block_texts(blocks):
+        if ignore_patterns and any(pattern.search(text) for pattern in ignore_patterns):
+            continue
+        items.append((get_heading_level(block), text, offset, offset + len(text)))
+    slices = split_by_headings(items)
+    if slices is not None:
+        logger.info(f"[mineru] {len(slices)} slices split by heading levels of MinerU")
+    return slices
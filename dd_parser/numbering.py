@@ -0,0 +1,236 @@
+import hashlib
+import zipfile
+from typing import *
+from pathlib import Path
+from collections import OrderedDict
+
+import regex as re
+
+from .logg import logger
+from .config import NUMBERING_CACHE_SIZE
+from .numerals import int_to_chinese
+
+if TYPE_CHECKING:
+    from lxml.etree import _Element
+
+W_NAMESPACE = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+#NOTE word supports 9 levels per list, ilvl 0..8
+MAX_LEVELS = 9
+
+level_placeholder_pattern = re.compile(r"%([1-9])")
+
+
+def _w(tag:str) -> str:
+    return f"{{{W_NAMESPACE}}}{tag}"
+
+
+def _to_letters(n:int) -> str:
+    #NOTE word repeats the letter instead of counting in base 26: 26 -> Z, 27 -> AA, 53 -> AAA
+    if n <= 0:
+        return str(n)
+    return chr(ord("A") + (n - 1) % 26) * ((n - 1) // 26 + 1)
+
+
+ROMAN_NUMERALS = [
+    (1000, "M"), (900, "CM"), (500, "D"), (400, "CD"), (100, "C"), (90, "XC"),
+    (50, "L"), (40, "XL"), (10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I"),
+]
+
+def _to_roman(n:int) -> str:
+    if n <= 0:
+        return str(n)
+    chars = []
+    for value, numeral in ROMAN_NUMERALS:
+        count, n = divmod(n, value)
+        chars.append(numeral * count)
+    return "".join(chars)
+
+
+ENCLOSED_CIRCLES = "①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳"
+HEAVENLY_STEMS = "甲乙丙丁戊己庚辛壬癸"
+
+#NOTE formatters of `w:numFmt`, see https://learn.microsoft.com/en-us/dotnet/api/documentformat.openxml.wordprocessing.numberformatvalues
+NUMBER_FORMATTERS:dict[str, Callable[[int], str]] = {
+    "decimal": str,
+    "decimalZero": lambda n: f"{n:02d}",
+    "decimalFullWidth": lambda n: str(n).translate(str.maketrans("0123456789", "０１２３４５６７８９")),
+    "decimalEnclosedCircle": lambda n: ENCLOSED_CIRCLES[n - 1] if 0 < n <= len(ENCLOSED_CIRCLES) else str(n),
+    "decimalEnclosedCircleChinese": lambda n: ENCLOSED_CIRCLES[n - 1] if 0 < n <= len(ENCLOSED_CIRCLES) else str(n),
+    "upperLetter": _to_letters,
+    "lowerLetter": lambda n: _to_letters(n).lower(),
+    "upperRoman": _to_roman,
+    "lowerRoman": lambda n: _to_roman(n).lower(),
+    "chineseCounting": int_to_chinese,
+    "chineseCountingThousand": int_to_chinese,
+    "ideographDigital": int_to_chinese,
+    "japaneseCounting": int_to_chinese,
+    "taiwaneseCounting": int_to_chinese,
+    "taiwaneseCountingThousand": int_to_chinese,
+    "chineseLegalSimplified": lambda n: int_to_chinese(n, upper=True),
+    "ideographLegalTraditional": lambda n: int_to_chinese(n, upper=True),
+    "ideographTraditional": lambda n: HEAVENLY_STEMS[(n - 1) % len(HEAVENLY_STEMS)] if n > 0 else str(n),
+    "bullet": lambda n: "",
+    "none": lambda n: "",
+}
+
+
+class NumberingLevel(NamedTuple):
+    start: int
+    #NOTE literal texts and (level, formatter) of the `%1`..`%9` placeholders of `w:lvlText`, compiled once per template
+    parts: tuple[Union[str, tuple[int, Callable[[int], str]]], ...]
+
+    def format(self, counters:Sequence[Optional[int]], starts:Sequence[int]) -> str:
+        """prefix text of a list item, levels not started yet are formatted as their start values"""
+        if len(self.parts) == 1 and isinstance(self.parts[0], str):
+            return self.parts[0]
+        texts = []
+        for part in self.parts:
+            if isinstance(part, str):
+                texts.append(part)
+            else:
+                level, formatter = part
+                value = counters[level]
+                texts.append(formatter(value if value is not None else starts[level]))
+        return "".join(texts)
+
+
+class NumberingDefinition(NamedTuple):
+    levels: tuple[Optional[NumberingLevel], ...] # by ilvl, None if the level is not defined
+    starts: tuple[int, ...]
+
+
+def _compile_level_text(lvl_text:str, number_formats:Sequence[str]) -> tuple:
+    parts = []
+    for i, part in enumerate(level_placeholder_pattern.split(lvl_text)):
+        if i % 2 == 0:
+            if part:
+                parts.append(part)
+        else:
+            level = int(part) - 1
+            parts.append((level, NUMBER_FORMATTERS.get(number_formats[level], str)))
+    return tuple(parts) or ("",)
+
+
+def _get_val(element:"_Element", tag:str, default:Optional[str]=None) -> Optional[str]:
+    child = element.find(_w(tag))
+    return child.get(_w("val"), default) if child is not None else default
+
+
+def _compile_abstract_num(abstract_num:"_Element") -> dict[int, tuple[int, str, str]]:
+    #NOTE (start, numFmt, lvlText) by ilvl
+    levels = {}
+    for lvl in abstract_num.iterfind(_w("lvl")):
+        ilvl = int(lvl.get(_w("ilvl"), 0))
+        levels[ilvl] = (int(_get_val(lvl, "start", "1")), _get_val(lvl, "numFmt", "decimal"), _get_val(lvl, "lvlText", ""))
+    return levels
+
+
+def compile_numbering(numbering:"_Element") -> dict[int, NumberingDefinition]:
+    """
+    compile `word/numbering.xml` into a lookup table of list numbering, which can be reused by documents of the same template.
+
+    Every level of every list (`w:num`) is resolved to its abstract numbering (`w:abstractNum`) and start overrides (`w:startOverride`),
+    and its `w:lvlText` like `第%1章` or `%1.%2` is split into literal texts and per-level formatters of `w:numFmt`
+    (decimal, chinese counting, letters, roman numerals, ...), so numbering a paragraph never looks up the xml again.
+
+    Args:
+        numbering (_Element): root element of `word/numbering.xml`
+    Returns:
+        dict[int, NumberingDefinition]: numbering definitions by numId
+    """
+    abstract_levels = {
+        int(abstract_num.get(_w("abstractNumId"))): _compile_abstract_num(abstract_num)
+        for abstract_num in numbering.iterfind(_w("abstractNum"))
+    }
+    table = {}
+    for num in numbering.iterfind(_w("num")):
+        num_id = int(num.get(_w("numId")))
+        abstract_id = _get_val(num, "abstractNumId")
+        levels = dict(abstract_levels.get(int(abstract_id), {})) if abstract_id is not None else {}
+        for override in num.iterfind(_w("lvlOverride")):
+            ilvl = int(override.get(_w("ilvl"), 0))
+            start = _get_val(override, "startOverride")
+            if start is not None and ilvl in levels:
+                levels[ilvl] = (int(start),) + levels[ilvl][1:]
+        number_formats = [levels[ilvl][1] if ilvl in levels else "decimal" for ilvl in range(MAX_LEVELS)]
+        table[num_id] = NumberingDefinition(
+            levels=tuple(
+                NumberingLevel(levels[ilvl][0], _compile_level_text(levels[ilvl][2], number_formats)) if ilvl in levels else None
+                for ilvl in range(MAX_LEVELS)),
+            starts=tuple(levels[ilvl][0] if ilvl in levels else 1 for ilvl in range(MAX_LEVELS)),
+        )
+    return table
+
+
+_numbering_cache:OrderedDict[str, dict[int, NumberingDefinition]] = OrderedDict()
+cache_hits = 0
+cache_misses = 0
+
+
+def _read_part_blob(filepath:Union[str, Path], partname:str) -> Optional[bytes]:
+    try:
+        with zipfile.ZipFile(filepath) as package:
+            return package.read(partname.lstrip("/"))
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        logger.debug(f"[numbering] failed to read {partname} of {filepath}: {e}")
+        return None
+
+
+def get_numbering_table(filepath:Union[str, Path], numbering_part) -> dict[int, NumberingDefinition]:
+    """
+    compiled numbering of a .docx file, cached by the content hash of its `word/numbering.xml`.
+    Documents generated from the same template share the numbering part, and only the first of them compiles it.
+
+    Args:
+        filepath (str|Path): .docx filepath, whose raw numbering part is hashed
+        numbering_part (NumberingPart): numbering part of the document loaded by python-docx
+    Returns:
+        dict[int, NumberingDefinition]: numbering definitions by numId, see `compile_numbering`
+    """
+    global cache_hits, cache_misses
+    blob = _read_part_blob(filepath, str(numbering_part.partname))
+    if blob is None:
+        cache_misses += 1
+        return compile_numbering(numbering_part.element)
+
+    key = hashlib.sha1(blob).hexdigest()
+    table = _numbering_cache.get(key)
+    if table is not None:
+        cache_hits += 1
+        _numbering_cache.move_to_end(key)
+        return table
+    cache_misses += 1
+    table = compile_numbering(numbering_part.element)
+    _numbering_cache[key] = table
+    while len(_numbering_cache) > NUMBERING_CACHE_SIZE:
+        _numbering_cache.popitem(last=False)
+    return table
+
+
+class NumberingCounter:
+    """counters of list items while reading paragraphs in order, deeper levels restart once a shallower level goes on"""
+
+    def __init__(self, table:dict[int, NumberingDefinition]):
+        self.table = table
+        self.counters:dict[int, list[Optional[int]]] = {}
+
+    def next_prefix(self, num_id:int, ilvl:int) -> str:
+        """prefix text of the next list item of numId at level ilvl, empty if the list or level is not defined"""
+        definition = self.table.get(num_id)
+        if definition is None or not 0 <= ilvl < MAX_LEVELS or definition.levels[ilvl] is None:
+            return ""
+        counters = self.counters.setdefault(num_id, [None] * MAX_LEVELS)
+        counters[ilvl] = definition.starts[ilvl] if counters[ilvl] is None else counters[ilvl] + 1
+        for deeper in range(ilvl + 1, MAX_LEVELS):
+            counters[deeper] = None
+        return definition.levels[ilvl].format(counters, definition.starts)
+
+
+def get_numbering_cache_info() -> dict:
+    total = cache_hits + cache_misses
+    return dict(
+        templates=len(_numbering_cache),
+        hits=cache_hits,
+        misses=cache_misses,
+        hit_rate=cache_hits / total if total else 0.0,
+    )
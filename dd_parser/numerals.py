@@ -0,0 +1,139 @@
+import re
+from typing import *
+
+CHN_DIGITS = "零一二三四五六七八九"
+CHN_UPPER_DIGITS = "零壹贰叁肆伍陆柒捌玖"
+CHN_UNITS = ["", "十", "百", "千"]
+CHN_UPPER_UNITS = ["", "拾", "佰", "仟"]
+CHN_GROUP_UNITS = ["", "万", "亿", "万亿"]
+
+
+def _group_to_chinese(n:int, digits:str, units:list[str]) -> str:
+    """chinese numeral of 0 < n < 10000, a 零 for every run of zeros between digits"""
+    chars = []
+    zero = False
+    for position in range(3, -1, -1):
+        digit = n // 10 ** position % 10
+        if digit == 0:
+            zero = bool(chars)
+            continue
+        if zero:
+            chars.append(digits[0])
+            zero = False
+        chars.append(digits[digit] + units[position])
+    return "".join(chars)
+
+
+def int_to_chinese(n:int, upper:bool=False) -> str:
+    """
+    chinese numeral of an integer, like 十一, 二十, 一百零一 and 一万零三百.
+
+    Args:
+        n (int): non-negative integer below 10^16
+        upper (bool): financial numerals (壹贰叁) instead of 一二三
+    Returns:
+        str: chinese numeral, `n` in arabic digits if out of range
+    """
+    digits, units = (CHN_UPPER_DIGITS, CHN_UPPER_UNITS) if upper else (CHN_DIGITS, CHN_UNITS)
+    if n == 0:
+        return digits[0]
+    if n < 0 or n >= 10 ** 16:
+        return str(n)
+    groups = []
+    while n:
+        n, group = divmod(n, 10000)
+        groups.append(group)
+    chars = []
+    zero = False
+    for index in range(len(groups) - 1, -1, -1):
+        group = groups[index]
+        if group == 0:
+            zero = bool(chars)
+            continue
+        #NOTE 一万零三百: a 零 when zeros lead the group or a whole group is zero
+        if chars and (zero or group < 1000):
+            chars.append(digits[0])
+        chars.append(_group_to_chinese(group, digits, units) + CHN_GROUP_UNITS[index])
+        zero = False
+    text = "".join(chars)
+    #NOTE 十一 instead of 一十一, but 一百一十一
+    if not upper and text.startswith("一十"):
+        text = text[1:]
+    return text
+
+
+#NOTE values of numeral characters: digits below 10 (arabic digits, halfwidth and fullwidth, too), units 十百千 below 10^4,
+# and group units 万亿 from 10^4, so that every character is read by a single lookup
+NUMERAL_VALUES:dict[str, int] = {
+    **{char: value for value, char in enumerate(CHN_DIGITS)},
+    **{char: value for value, char in enumerate(CHN_UPPER_DIGITS)},
+    **{str(value): value for value in range(10)},
+    **{chr(ord("０") + value): value for value in range(10)},
+    "〇": 0, "两": 2,
+    "十": 10, "拾": 10, "百": 100, "佰": 100, "千": 1000, "仟": 1000,
+    "万": 10 ** 4, "萬": 10 ** 4, "亿": 10 ** 8, "億": 10 ** 8,
+}
+NUMERAL_CHARS = "".join(NUMERAL_VALUES)
+#NOTE max numerals read character by character kept in the table of `chinese_to_int`
+NUMERAL_TABLE_SIZE = 20000
+
+#NOTE the numeral a heading starts with, like `第十二条`, `第1章`, `（三）` and `一、`. Numbers like `2.1` of multilevel headings
+# are not matched, their first numeral repeats. Matched by `re` instead of `regex`, which is several times slower for such a plain pattern
+heading_numeral_pattern = re.compile(
+    rf"\s*(?:第\s*([{NUMERAL_CHARS}]+)\s*[编章节条款项]|[（(]\s*([{NUMERAL_CHARS}]+)\s*[）)]|([{NUMERAL_CHARS}]+)\s*[、.．](?!\d))")
+_numeral_table:Optional[dict[str, int]] = None
+
+
+def _read_numeral(text:str) -> Optional[int]:
+    total = section = number = 0
+    for char in text:
+        value = NUMERAL_VALUES.get(char)
+        if value is None:
+            return None
+        if value < 10:
+            number = number * 10 + value
+        elif value < 10 ** 4:
+            #NOTE 十二 is 12, a unit without digit counts once
+            section += (number or 1) * value
+            number = 0
+        else:
+            if value > total:
+                #NOTE 一亿 (and 一万亿) scale everything before it
+                total = (total + section + number or 1) * value
+            else:
+                #NOTE 一亿二千万, the 万 scales 二千 only
+                total += (section + number or 1) * value
+            section = number = 0
+    return total + section + number
+
+
+def chinese_to_int(text:str) -> Optional[int]:
+    """
+    integer of a chinese numeral, like 十二, 一百零一, 一千零五十, 两万, 贰拾, 二〇二三 and mixed arabic digits like 1百2十.
+
+    Numerals below 1000 in their usual form (and in arabic digits) are looked up in a table. Others are read
+    character by character, a lookup each, and kept in the table (up to `NUMERAL_TABLE_SIZE`).
+    Runs of digits without units are read positionally (二〇二三 is 2023).
+
+    Args:
+        text (str): chinese numeral, arabic digits allowed
+    Returns:
+        int: the integer, None if `text` is empty or has a character which is not a numeral
+    """
+    global _numeral_table
+    if _numeral_table is None:
+        #NOTE built on first use, numbers of headings are mostly below 1000
+        _numeral_table = {form: n for n in range(1000) for form in (int_to_chinese(n), str(n))}
+    number = _numeral_table.get(text)
+    if number is not None or not text:
+        return number
+    number = _read_numeral(text)
+    if number is not None and len(_numeral_table) < NUMERAL_TABLE_SIZE:
+        _numeral_table[text] = number
+    return number
+
+
+def get_heading_number(line:str) -> Optional[int]:
+    """number of a heading line by its leading numeral, like 12 of `第十二条 ...`. None if it does not start with a numbered heading"""
+    matched = heading_numeral_pattern.match(line)
+    return chinese_to_int(matched.group(matched.lastindex)) if matched else None
@@ -0,0 +1,267 @@
+import asyncio
+import functools
+from typing import *
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Executor
+
+if TYPE_CHECKING:
+    import fitz  # PyMuPDF
+
+from .logg import logger
+from .sandbox import SandboxPool, ExtractionError, arun_extraction
+from .pdf_layout import get_pdf_layouts, get_pdf_layout_text, _get_document_key
+from .config import OCR_ENGINE, OCR_LANGUAGE, OCR_DPI, OCR_MAX_SIDE, OCR_WORKERS, OCR_TIMEOUT, OCR_CACHE_SIZE, EXTRACT_MEMORY_LIMIT
+
+#NOTE an OCR engine takes a pdf page, the dpi to render it at and the tesseract-style language, and returns the page text.
+# Engines run in worker processes: register module level functions, so they can be pickled
+OcrEngine:TypeAlias = Callable[["fitz.Page", int, str], str]
+
+
+def tesseract_engine(page:"fitz.Page", dpi:int, language:str) -> str:
+    """OCR by the tesseract built in PyMuPDF, the page is rendered at `dpi` and recognized as a whole"""
+    textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+    return page.get_text("text", textpage=textpage, sort=True).strip()
+
+
+OCR_ENGINES:dict[str, OcrEngine] = {"tesseract": tesseract_engine}
+
+
+def register_ocr_engine(name:str, engine:OcrEngine):
+    """register a local OCR engine, selected by `OCR_ENGINE=name`"""
+    OCR_ENGINES[name] = engine
+
+
+@functools.cache
+def ocr_available(engine:str=OCR_ENGINE, language:str=OCR_LANGUAGE) -> bool:
+    """whether the OCR engine can run here. Checked once, tesseract needs its language data (`TESSDATA_PREFIX`)"""
+    if engine not in OCR_ENGINES:
+        if engine != "none":
+            logger.warning(f"[ocr] unknown OCR engine `{engine}`, pages without text layer are left empty")
+        return False
+    if engine == "tesseract":
+        import fitz
+        try:
+            tessdata = fitz.get_tessdata()
+        except Exception:
+            tessdata = None
+        missing = [lang for lang in language.split("+") if not tessdata or not (Path(tessdata) / f"{lang}.traineddata").exists()]
+        if missing:
+            logger.warning(f"[ocr] tesseract language data {missing} not found, set `TESSDATA_PREFIX`. Pages without text layer are left empty")
+            return False
+    return True
+
+
+def get_render_dpi(width:float, height:float, dpi:int=OCR_DPI, max_side:int=OCR_MAX_SIDE) -> int:
+    """dpi to render a page of `width` x `height` pt at, lowered so that its longer side is at most `max_side` pixels"""
+    longer = max(width, height) / 72 #NOTE in inches
+    if longer <= 0:
+        return dpi
+    return max(1, min(dpi, int(max_side / longer)))
+
+
+def _ocr_pages(
+    file:str | bytes,
+    page_numbers:list[int],
+    engine:OcrEngine,
+    dpi:int,
+    max_side:int,
+    language:str,
+) -> list[str]:
+    #NOTE runs in worker processes, the pdf is opened once for a batch of pages
+    import fitz
+    pdf_doc = fitz.open(stream=file, filetype="pdf") if isinstance(file, bytes) else fitz.open(file)
+    texts = []
+    with pdf_doc:
+        for number in page_numbers:
+            page = pdf_doc[number]
+            try:
+                texts.append(engine(page, get_render_dpi(page.rect.width, page.rect.height, dpi, max_side), language))
+            except Exception as e:
+                logger.warning(f"[ocr] failed to recognize page {number}: {e!r}")
+                texts.append("")
+    return texts
+
+
+_ocr_cache:OrderedDict[tuple, str] = OrderedDict()
+cache_hits = 0
+cache_misses = 0
+_executor:Optional[SandboxPool] = None
+
+
+def get_ocr_executor() -> SandboxPool:
+    """sandboxed process pool of OCR, see `SandboxPool`. Workers are spawned on first scanned page"""
+    global _executor
+    if _executor is None:
+        #NOTE no CPU cap, tesseract may recognize a page in several threads. Batches are bounded by `OCR_TIMEOUT`
+        _executor = SandboxPool("ocr", workers=OCR_WORKERS, timeout=OCR_TIMEOUT, memory_limit=EXTRACT_MEMORY_LIMIT or None)
+    return _executor
+
+
+def shutdown_ocr_executor():
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+
+
+def _split_batches(page_numbers:list[int], workers:int) -> list[list[int]]:
+    #NOTE contiguous batches of even sizes, one per worker, so the pdf is sent to every worker once
+    workers = max(1, min(workers, len(page_numbers)))
+    size, extra = divmod(len(page_numbers), workers)
+    batches, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        batches.append(page_numbers[start:end])
+        start = end
+    return batches
+
+
+def _lookup_cache(file:str | Path | bytes, page_numbers:Iterable[int], engine:str) -> tuple[dict[int, str], list[int], Callable]:
+    global cache_hits
+    document_key = _get_document_key(file)
+    key = lambda number: (document_key, number, engine, OCR_DPI, OCR_MAX_SIDE, OCR_LANGUAGE)
+    texts, missing = {}, []
+    for number in page_numbers:
+        text = _ocr_cache.get(key(number))
+        if text is None:
+            missing.append(number)
+        else:
+            cache_hits += 1
+            _ocr_cache.move_to_end(key(number))
+            texts[number] = text
+    return texts, missing, key
+
+
+def _store_cache(texts:dict[int, str], batches:list[list[int]], results:list[Optional[list[str]]], key:Callable):
+    global cache_misses
+    for numbers, batch_texts in zip(batches, results):
+        cache_misses += len(numbers)
+        if batch_texts is None:
+            #NOTE pages of a failed batch are left empty, and recognized again next time
+            texts.update((number, "") for number in numbers)
+            continue
+        for number, text in zip(numbers, batch_texts):
+            texts[number] = text
+            _ocr_cache[key(number)] = text
+    while len(_ocr_cache) > OCR_CACHE_SIZE:
+        _ocr_cache.popitem(last=False)
+
+
+def ocr_pdf_pages(
+    file:str | Path | bytes,
+    page_numbers:list[int],
+    engine:str=OCR_ENGINE,
+    executor:Optional[Executor]=None,
+) -> dict[int, str]:
+    """
+    recognize pages of a pdf by the local OCR engine, cached per page by document content.
+
+    Args:
+        file(str| Path | bytes): PDF filepath or PDF file bytes
+        page_numbers(list[int]): pages to recognize, 0-based
+        engine(str): name of the OCR engine, see `OCR_ENGINES`
+        executor(Executor): pages are recognized in batches by it, or in this process if not given
+    Returns:
+        dict[int, str]: texts by page number
+    """
+    texts, missing, key = _lookup_cache(file, page_numbers, engine)
+    if not missing:
+        return texts
+    source = file if isinstance(file, bytes) else str(file)
+    args = (OCR_ENGINES[engine], OCR_DPI, OCR_MAX_SIDE, OCR_LANGUAGE)
+    if executor is None:
+        batches = [missing]
+        results = [_ocr_pages(source, missing, *args)]
+    else:
+        batches = _split_batches(missing, OCR_WORKERS)
+        futures = [executor.submit(_ocr_pages, source, batch, *args) for batch in batches]
+        results = []
+        for batch, future in zip(batches, futures):
+            try:
+                results.append(future.result())
+            except ExtractionError as e:
+                logger.warning(f"[ocr] pages {batch[0]}-{batch[-1]} failed: {e}")
+                results.append(None)
+    _store_cache(texts, batches, results, key)
+    return texts
+
+
+async def aocr_pdf_pages(
+    file:str | Path | bytes,
+    page_numbers:list[int],
+    engine:str=OCR_ENGINE,
+) -> dict[int, str]:
+    """async `ocr_pdf_pages` in the OCR process pool, pages are recognized in parallel batches"""
+    texts, missing, key = await asyncio.to_thread(_lookup_cache, file, page_numbers, engine)
+    if not missing:
+        return texts
+    source = file if isinstance(file, bytes) else str(file)
+    args = (OCR_ENGINES[engine], OCR_DPI, OCR_MAX_SIDE, OCR_LANGUAGE)
+    executor = get_ocr_executor()
+
+    async def recognize(batch:list[int]) -> Optional[list[str]]:
+        try:
+            return await executor.acall(_ocr_pages, source, batch, *args)
+        except ExtractionError as e:
+            logger.warning(f"[ocr] pages {batch[0]}-{batch[-1]} failed: {e}")
+            return None
+
+    batches = _split_batches(missing, OCR_WORKERS)
+    results = await asyncio.gather(*(recognize(batch) for batch in batches))
+    _store_cache(texts, batches, results, key)
+    return texts
+
+
+def get_scanned_pages(file:str | Path | bytes) -> list[int]:
+    """pages without text layer, like scanned pages. Page layouts are cached, see `get_pdf_layouts`"""
+    return [i for i, layout in enumerate(get_pdf_layouts(file)) if not layout["lines"] and not layout["tables"]]
+
+
+def get_pdf_text_with_ocr(file:str | Path | bytes, executor:Optional[Executor]=None) -> list[str]:
+    """
+    extract texts of all pages of a pdf locally: pages with text layer by layout (see `get_pdf_layout_text`),
+    and pages without text layer by the local OCR engine, if available.
+
+    Args:
+        file(str| Path | bytes): PDF filepath or PDF file bytes
+        executor(Executor): OCR runs in it, or in this process if not given (like in batch workers)
+    Returns:
+        out(list[str]): list of texts of all pdf pages.
+    """
+    texts = get_pdf_layout_text(file)
+    scanned = get_scanned_pages(file)
+    if scanned and ocr_available():
+        logger.info(f"[ocr] {len(scanned)} of {len(texts)} pages without text layer, recognizing by {OCR_ENGINE}")
+        for number, text in ocr_pdf_pages(file, scanned, executor=executor).items():
+            texts[number] = text
+    return texts
+
+
+def _get_layout_texts_and_scanned_pages(file:str | Path | bytes) -> tuple[list[str], list[int]]:
+    #NOTE one extraction job for both, the page layouts are cached in the worker
+    return get_pdf_layout_text(file), get_scanned_pages(file)
+
+
+async def aget_pdf_text_with_ocr(file:str | Path | bytes, affinity:Optional[str]=None) -> list[str]:
+    """
+    async `get_pdf_text_with_ocr`, layouts are extracted as a sandboxed extraction job (see `arun_extraction`)
+    and pages are recognized in the OCR pool. Jobs of the same `affinity` key, like the content hash of the pdf,
+    prefer the worker whose cache holds its page layouts.
+    """
+    texts, scanned = await arun_extraction(_get_layout_texts_and_scanned_pages, file, affinity=affinity)
+    if scanned and ocr_available():
+        logger.info(f"[ocr] {len(scanned)} of {len(texts)} pages without text layer, recognizing by {OCR_ENGINE}")
+        for number, text in (await aocr_pdf_pages(file, scanned)).items():
+            texts[number] = text
+    return texts
+
+
+def get_ocr_cache_info() -> dict:
+    total = cache_hits + cache_misses
+    return dict(
+        pages=len(_ocr_cache),
+        hits=cache_hits,
+        misses=cache_misses,
+        hit_rate=cache_hits / total if total else 0.0,
+    )
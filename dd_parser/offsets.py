@@ -0,0 +1,66 @@
+from typing import *
+from bisect import bisect_right
+from itertools import accumulate
+
+
+class LineOffsets:
+    """
+    character offsets of the lines of a text, like `str.splitlines`.
+    Splitters keep indices of the first and last line of a slice while scanning lines,
+    and only slice boundaries are converted to offsets, so scanning costs nothing per line.
+
+    Args:
+        text (str): the text
+        lines (list[str]): `text.splitlines()`, if already split
+    """
+    def __init__(self, text:str, lines:Optional[list[str]]=None):
+        self.lines = lines if lines is not None else text.splitlines()
+        #NOTE line lengths with line breaks are summed up in C, offsets of all lines cost a few ms for MBs of text
+        self.starts = [0, *accumulate(map(len, text.splitlines(keepends=True)))]
+
+    def span(self, first:int, last:int) -> tuple[int, int]:
+        """`[start, end)` offsets of lines `first`..`last` (inclusive), without their leading and trailing whitespaces"""
+        line = self.lines[first]
+        start = self.starts[first] + len(line) - len(line.lstrip())
+        return start, max(start, self.starts[last] + len(self.lines[last].rstrip()))
+
+
+class UnitIndex:
+    """
+    offsets where units of a text (pages, paragraphs) start, so slices are located in units
+    by bisecting their offsets, without searching their texts.
+
+    Args:
+        starts (list[int]): ascending offsets where units start in the text
+        numbers (list[int]): number of every unit, like page numbers
+    """
+    def __init__(self, starts:list[int], numbers:list[int]):
+        self.starts = starts
+        self.numbers = numbers
+
+    @classmethod
+    def from_texts(cls, texts:Sequence[str], separator:str="\n", first:int=0) -> "UnitIndex":
+        """units joined by `separator` into the text, numbered from `first`"""
+        starts, offset = [], 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + len(separator)
+        return cls(starts, list(range(first, first + len(starts))))
+
+    def locate(self, offset:int) -> Optional[int]:
+        """number of the unit the offset is in, None if there is no unit"""
+        if not self.starts:
+            return None
+        return self.numbers[max(bisect_right(self.starts, offset) - 1, 0)]
+
+    def locate_span(self, start:int, end:int) -> list[int]:
+        """numbers of the first and last unit of the `[start, end)` span"""
+        return [self.locate(start), self.locate(max(start, end - 1))]
+
+
+def add_unit_numbers(slices:list[dict], key:str, index:UnitIndex) -> list[dict]:
+    """set `slice[key]` to the first and last unit of every slice with offsets, like `pages: [3, 4]`"""
+    for slice in slices:
+        if "start" in slice:
+            slice[key] = index.locate_span(slice["start"], slice["end"])
+    return slices
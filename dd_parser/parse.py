@@ -1,55 +1,114 @@
+import os
+import json
+import uuid
+import hashlib
 from typing import *
 import regex as re
 from pathlib import Path
 
-from aiofiles import open as aopen
+
+if TYPE_CHECKING:
+    from .schemas import ParsedFormData
 
 if __name__ == '__main__':
     import sys
     sys.path.append(str(Path(__file__).parent.parent))
-    from dd_parser.logg import logger
-    from dd_parser.config import TEMP_DIR
-    from dd_parser.schemas import ParsedFormData
+    from dd_parser.logg import logger, sampled_logger
+    from dd_parser.config import (
+        get_temp_dir, SPREADSHEET_CHUNK_CHARS, SPREADSHEET_HEADER_ROWS, MINERU_URL, MINERU_OUTPUT_FORMAT, PDF_LOCAL_FALLBACK,
+        HEADING_MAX_GAP)
+    from dd_parser.limiter import EXTRACT_LIMITER, LIBREOFFICE_LIMITER, MINERU_LIMITER, REQUEST_LIMITER
+    from dd_parser.embedding import embed_slices
+    from dd_parser.versioning import VERSION_STORE
+    from dd_parser.store import CORPUS_STORE
+    from dd_parser.coalesce import SingleFlight
+    from dd_parser.spreadsheet import get_spreadsheet_slices, xlrd_available
+    from dd_parser.tokenizer import LimitUnit, count_lengths
+    from dd_parser.windowing import window_slices, format_txt_windows
+    from dd_parser.mineru import get_content_list, get_mineru_text, content_list_to_slices, get_page_index
+    from dd_parser.markdown import markdown_to_slices, resolve_split_mode
+    from dd_parser.decoding import decode_bytes
+    from dd_parser.ocr import aget_pdf_text_with_ocr
+    from dd_parser.sandbox import arun_extraction
+    from dd_parser.offsets import LineOffsets, add_unit_numbers, UnitIndex
+    from dd_parser.numerals import get_heading_number
+    from dd_parser.timing import stage_timer, request_timer, add_stage_timings
     from dd_parser.tools import (
         async_wrapper,
-        get_pure_docx_text,
+        get_docx_paragraphs,
         aconvert_docs_to_docxs,
         request_mineru,
     )
 else:
-    from .logg import logger
-    from .config import TEMP_DIR
-    from .schemas import ParsedFormData
+    from .logg import logger, sampled_logger
+    from .config import (
+        get_temp_dir, SPREADSHEET_CHUNK_CHARS, SPREADSHEET_HEADER_ROWS, MINERU_URL, MINERU_OUTPUT_FORMAT, PDF_LOCAL_FALLBACK,
+        HEADING_MAX_GAP)
+    from .limiter import EXTRACT_LIMITER, LIBREOFFICE_LIMITER, MINERU_LIMITER, REQUEST_LIMITER
+    from .embedding import embed_slices
+    from .versioning import VERSION_STORE
+    from .store import CORPUS_STORE
+    from .coalesce import SingleFlight
+    from .spreadsheet import get_spreadsheet_slices, xlrd_available
+    from .tokenizer import LimitUnit, count_lengths
+    from .windowing import window_slices, format_txt_windows
+    from .mineru import get_content_list, get_mineru_text, content_list_to_slices, get_page_index
+    from .markdown import markdown_to_slices, resolve_split_mode
+    from .decoding import decode_bytes
+    from .ocr import aget_pdf_text_with_ocr
+    from .sandbox import arun_extraction
+    from .offsets import LineOffsets, add_unit_numbers, UnitIndex
+    from .numerals import get_heading_number
+    from .timing import stage_timer, request_timer, add_stage_timings
     from .tools import (
         async_wrapper,
-        get_pure_docx_text,
+        get_docx_paragraphs,
         aconvert_docs_to_docxs,
         request_mineru,
     )
 
-savebytes_dir = TEMP_DIR / "save_bytes"
-doc_converted_dir = TEMP_DIR / "doc_converted"
-savebytes_dir.mkdir(exist_ok=True)
-doc_converted_dir.mkdir(exist_ok=True)
 
 
+def get_savebytes_dir() -> Path:
+    """directory of uploaded files, created on first use"""
+    savebytes_dir = get_temp_dir() / "save_bytes"
+    savebytes_dir.mkdir(exist_ok=True)
+    return savebytes_dir
+
+
+def get_doc_converted_dir() -> Path:
+    """directory of files converted by LibreOffice, created on first use"""
+    doc_converted_dir = get_temp_dir() / "doc_converted"
+    doc_converted_dir.mkdir(exist_ok=True)
+    return doc_converted_dir
+
+
+PARSE_FLIGHT = SingleFlight("parse")
+CONVERT_FLIGHT = SingleFlight("libreoffice")
+
+
+#NOTE numerals of headings, like 第一百零一条, 第两千条 and 第12条. Arabic digits are left out of `一、` and `（一）`,
+# where they would take numbered lists (`1、`) for headings
+CHN_NUMERAL = "[零〇一二两三四五六七八九十百千万]"
+CHN_OR_ARABIC_NUMERAL = r"[零〇一二两三四五六七八九十百千万\d]"
+
 regex_patterns = {
     #NOTE 第一章  第一条。。。
     "chapters_with_articles": dict(
-        chapter_pattern = re.compile(r"^第[一二三四五六七八九十百]+\s{0,1}章[^\n]*"),
-        article_pattern = re.compile(r"^第[一二三四五六七八九十百]+\s{0,1}条[^\n]*"),
+        chapter_pattern = re.compile(rf"^第{CHN_OR_ARABIC_NUMERAL}+\s{{0,1}}章[^\n]*"),
+        article_pattern = re.compile(rf"^第{CHN_OR_ARABIC_NUMERAL}+\s{{0,1}}条[^\n]*"),
         example = "第一章  第一条。。。",
     ),
     #NOTE 第一条  （一）。。。
     "articles_with_parentheses": dict(
-        chapter_pattern = re.compile(r"^第[一二三四五六七八九十百]+\s{0,1}条\s{0,1}[^\n]*"),
-        article_pattern = re.compile(r"^[（(][一二三四五六七八九十百]*?[）)][^\n]*"),
+        chapter_pattern = re.compile(rf"^第{CHN_OR_ARABIC_NUMERAL}+\s{{0,1}}条\s{{0,1}}[^\n]*"),
+        article_pattern = re.compile(rf"^[（(]{CHN_NUMERAL}*?[）)][^\n]*"),
         example = "第一条  （一）。。。",
     ),
     #NOTE 一、  （一）。。。
     "chinese_dots_with_articles": dict(
-        chapter_pattern = re.compile(r"^[一二三四五六七八九十百]+\s{0,1}、[^\n]*"),
-        article_pattern = re.compile(r"^[（(][一二三四五六七八九十百]*?[）)][^\n]*"),
+        chapter_pattern = re.compile(rf"^{CHN_NUMERAL}+\s{{0,1}}、[^\n]*"),
+        article_pattern = re.compile(rf"^[（(]{CHN_NUMERAL}*?[）)][^\n]*"),
         example = "一、  （一）。。。",
     ),
 }
@@ -91,24 +150,237 @@ def get_regex_pattern(pure_text: str) -> tuple[Optional[re.Pattern], Optional[re
 
             if round_chapter_pattern_detected and round_article_pattern_detected:
                 #NOTE if both patterns are detected in the same round, we consider it a match
-                print(f"Detected pattern: {key} ( {patterns['example']} )")
+                logger.info(f"Detected pattern: {key} ( {patterns['example']} )")
                 return chapter_pattern, article_pattern
 
         # reset for next line
         round_chapter_pattern_detected, round_article_pattern_detected = False, False
 
     if single_pattern:
-        print("Detected single pattern only, returning single pattern")
+        logger.info("Detected single pattern only, returning single pattern")
         return single_pattern
 
-    print("No matching pattern found.")
+    logger.info("No matching pattern found.")
     return None, None
 
 
+def sample_text(pure_text:str, prefix_chars:int=8192, window_chars:int=2048, windows:int=4) -> tuple[list[str], float]:
+    """
+    sample lines of the text: the first `prefix_chars` characters, and `windows` windows of `window_chars` characters
+    strided over the rest. Windows are aligned to line boundaries.
+    Returns:
+        tuple[list[str], float]: sampled lines, ratio of text covered by samples
+    """
+    if len(pure_text) <= prefix_chars + windows * window_chars:
+        return pure_text.splitlines(), 1.0
+    lines = pure_text[:pure_text.rfind("\n", 0, prefix_chars) + 1 or prefix_chars].splitlines()
+    covered = prefix_chars
+    stride = (len(pure_text) - prefix_chars) // windows
+    for i in range(windows):
+        start = pure_text.find("\n", prefix_chars + i * stride)
+        if start == -1:
+            break
+        end = pure_text.rfind("\n", start + 1, start + window_chars)
+        if end == -1:
+            continue
+        lines.extend(pure_text[start + 1:end].splitlines())
+        covered += end - start
+    return lines, covered / len(pure_text)
+
+
+def detect_regex_pattern(
+    pure_text:str,
+    prefix_chars:int=8192,
+    window_chars:int=2048,
+    windows:int=4,
+    min_hits:int=3,
+    min_confidence:float=0.6,
+    no_match_lines:int=50,
+) -> tuple[tuple[Optional[re.Pattern], Optional[re.Pattern]] | re.Pattern, float]:
+    """
+    detect regex pattern on samples of the text (see `sample_text`), instead of scanning the whole text.
+    Falls back to `get_regex_pattern` over the whole text if the confidence is lower than `min_confidence`.
+
+    Pattern families are detected in the same priority as `get_regex_pattern`. The confidence is
+    - 1.0 if samples cover the whole text
+    - `hits / min_hits` (at most 1.0) if a family has both patterns matched `hits` times in samples,
+      and no family of higher priority matched a chapter (whose articles could be in the rest of the text)
+    - `min_confidence` if no family matched any of at least `no_match_lines` sampled lines,
+      or no family has both patterns matched while a single pattern matched at least `min_hits` times
+    - 0.0 otherwise, like only a single pattern matched
+
+    Detection runs on the whole extracted text, and only saves the time of scanning it: extraction is not streamed
+    (pdf layouts, for one, are built and cached for the whole document before any text is returned).
+
+    Args:
+        pure_text (str): The pure text extracted from the document
+        prefix_chars (int): characters sampled from the beginning of the text
+        window_chars (int): characters of every strided window
+        windows (int): number of strided windows
+        min_hits (int): heading lines matched in samples to be fully confident
+        min_confidence (float): confidence below which the whole text is scanned
+        no_match_lines (int): sampled lines without any match to decide there is no pattern
+    Returns:
+        tuple: patterns detected (same as `get_regex_pattern`), confidence
+    """
+    lines, coverage = sample_text(pure_text, prefix_chars, window_chars, windows)
+    if coverage >= 1.0:
+        return get_regex_pattern(pure_text), 1.0
+
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if line]
+    partial_match_before = False #NOTE a family of higher priority matched chapters only
+    single_pattern, single_hits = None, 0
+    for key, patterns in regex_patterns.items():
+        chapter_hits = article_hits = 0
+        for line in lines:
+            if patterns["chapter_pattern"].search(line):
+                chapter_hits += 1
+            elif patterns["article_pattern"].search(line):
+                article_hits += 1
+            if chapter_hits and article_hits and chapter_hits + article_hits >= min_hits:
+                break #NOTE confident enough
+        if chapter_hits and article_hits:
+            confidence = 0.0 if partial_match_before else min(1.0, (chapter_hits + article_hits) / min_hits)
+            if confidence >= min_confidence:
+                logger.debug(
+                    f"Detected pattern on samples ({coverage:.1%} of text): {key} ( {patterns['example']} ), "
+                    f"confidence {confidence:.2f}")
+                return (patterns["chapter_pattern"], patterns["article_pattern"]), confidence
+            break
+        if chapter_hits:
+            #NOTE articles may follow in the rest of the text. While chapters precede their articles,
+            # so a family with articles but no chapters in samples has no chapters at all
+            partial_match_before = True
+        if single_pattern is None and (chapter_hits or article_hits):
+            #NOTE same as `get_regex_pattern`, single pattern is the first pattern matched
+            single_pattern = patterns["chapter_pattern"] if chapter_hits else patterns["article_pattern"]
+            single_hits = chapter_hits or article_hits
+    else:
+        if single_pattern is None and len(lines) >= no_match_lines:
+            #NOTE headings spread over the whole document, none of them in many sampled lines means no headings
+            logger.debug(f"No pattern matched in {len(lines)} sampled lines ({coverage:.1%} of text)")
+            return (None, None), min_confidence
+        if single_pattern is not None and single_hits >= min_hits:
+            logger.debug(f"Detected single pattern on samples ({coverage:.1%} of text), confidence {min_confidence:.2f}")
+            return single_pattern, min_confidence
+
+    logger.debug(f"Low confidence on samples ({coverage:.1%} of text), scan the whole text")
+    return get_regex_pattern(pure_text), 0.0
+
+
+def select_ordered_headings(
+    candidates:list[tuple[int, Optional[int]]],
+    restarts:Optional[list[int]]=None,
+    max_gap:int=HEADING_MAX_GAP,
+) -> list[int]:
+    """
+    select the headings of a level which follow its numbering, in a single pass.
+
+    A candidate is kept if it continues the numbering of the last heading kept (skipping at most `max_gap` numbers),
+    restarts it at 1 after a heading of the upper level, or is continued by the next candidate (like `第十一条` then `第十二条`),
+    so that a heading kept by mistake does not reject the headings after it. Other candidates are body text, like references to articles.
+
+    Args:
+        candidates (list[tuple[int, Optional[int]]]): positions and numbers of lines matched by the pattern of the level, in order.\
+        Candidates without number are always kept
+        restarts (list[int]): ascending positions of headings of the upper level, where numbering may restart at 1.\
+        None for the top level, whose numbering may restart at 1 anywhere
+        max_gap (int): max numbers skipped between consecutive headings
+    Returns:
+        list[int]: positions of candidates kept, ascending
+    """
+    kept = []
+    last = None
+    restarted = restarts is None
+    upper = 0 #NOTE index of the next heading of the upper level
+    for k, (position, number) in enumerate(candidates):
+        if restarts is not None:
+            while upper < len(restarts) and restarts[upper] < position:
+                upper += 1
+                restarted = True
+        if number is None:
+            kept.append(position)
+            continue
+        if (
+            last is None
+            or last < number <= last + 1 + max_gap
+            or (restarted and number == 1)
+            or (k + 1 < len(candidates) and candidates[k + 1][1] == number + 1)
+        ):
+            kept.append(position)
+            last = number
+            restarted = restarts is None
+    return kept
+
+
+def scan_heading_lines(
+    lines:list[str],
+    patterns:list[re.Pattern],
+    ignore_patterns:List[re.Pattern]=[],
+    ordered:bool=True,
+) -> list[tuple[int, str, int]]:
+    """
+    find heading lines by the patterns of every level, from chapters to articles.
+
+    Args:
+        lines (list[str]): lines of the text
+        patterns (list[re.Pattern]): pattern of chapters, and pattern of articles if any. Chapters are matched first
+        ignore_patterns (List[re.Pattern]): text patterns are ignored once matched
+        ordered (bool): headings numbered out of order are body text, see `select_ordered_headings`
+    Returns:
+        list[tuple[int, str, int]]: index, stripped text and level (1 for the first pattern, 0 for body text)\
+        of every non-blank line not ignored
+    """
+    chapter_pattern, article_pattern = patterns[0], patterns[1] if len(patterns) > 1 else None
+    entries = []
+    candidates:list[list[tuple[int, Optional[int]]]] = [[] for _ in patterns]
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+
+        detect_ignore=False
+        for ignore_pattern in ignore_patterns:
+            if ignore_pattern.search(line):
+                detect_ignore=True
+                break
+        if detect_ignore:
+            sampled_logger.debug("ignore_line", "detect ignore line: {}", line)
+            continue
+
+        if chapter_pattern.search(line):
+            level = 1
+        elif article_pattern is not None and article_pattern.search(line):
+            level = 2
+        else:
+            entries.append((i, line, 0))
+            continue
+        if ordered:
+            #NOTE only heading lines are parsed for numbers
+            candidates[level - 1].append((len(entries), get_heading_number(line)))
+        entries.append((i, line, level))
+
+    if ordered:
+        restarts = None
+        for level_candidates in candidates:
+            kept = select_ordered_headings(level_candidates, restarts)
+            if len(kept) < len(level_candidates):
+                kept_positions = set(kept)
+                for position, _ in level_candidates:
+                    if position not in kept_positions:
+                        i, line, _ = entries[position]
+                        entries[position] = (i, line, 0)
+                        sampled_logger.debug("unordered_heading", "heading out of order, taken as body text: {}", line)
+            restarts = kept
+    return entries
+
+
 def single_pattern_preprocess(
     pure_text:str,
     chapter_pattern:re.Pattern,
     ignore_patterns:List[re.Pattern]=[],
+    ordered:bool=True,
 ) -> list[dict[str,str]]:
     """
     Preprocess file to extract chapters by single pattern
@@ -128,41 +400,41 @@ def single_pattern_preprocess(
         pure_text (str): The pure text extracted from the document
         chapter_pattern (re.Pattern): The regex pattern for chapter
         ignore_patterns (List[re.Pattern]): text patterns are ignored once matched
+        ordered (bool): chapters numbered out of order are body text, see `select_ordered_headings`
+    Returns:
+        list[dict]: slices, with `start`/`end` character offsets of their lines in `pure_text`
     """
     slices = []
     lines = pure_text.splitlines()
+    offsets = LineOffsets(pure_text, lines)
     buffer = []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        detect_ignore=False
-        for ignore_pattern in ignore_patterns:
-            if ignore_pattern.search(line):
-                detect_ignore=True
-                break
-        if detect_ignore:
-            continue
-
-        if chapter_pattern.search(line):
+    buffer_first = buffer_last = 0 #NOTE indices of the first and last line of buffer
+    for i, line, level in scan_heading_lines(lines, [chapter_pattern], ignore_patterns, ordered):
+        if level:
             if buffer:
+                start, end = offsets.span(buffer_first, buffer_last)
                 slices.append({
                     "chapter": "",
                     "article": "",
-                    "content": "\n".join(buffer)
+                    "content": "\n".join(buffer),
+                    "start": start,
+                    "end": end,
                 })
                 buffer = []
-            buffer.append(line)
-        else:
-            buffer.append(line)
+        if not buffer:
+            buffer_first = i
+        buffer.append(line)
+        buffer_last = i
 
     #TODO save the last buffer if exists
     if buffer:
+        start, end = offsets.span(buffer_first, buffer_last)
         slices.append({
             "chapter": "",
             "article": "",
-            "content": "\n".join(buffer)
+            "content": "\n".join(buffer),
+            "start": start,
+            "end": end,
         })
     return slices
 
@@ -172,6 +444,7 @@ def double_patterns_preprocess(
     chapter_pattern:re.Pattern,
     article_pattern:re.Pattern,
     ignore_patterns: List[re.Pattern]=[],
+    ordered:bool=True,
 ) -> list[dict[str,str]]:
     """
     Preprocess file to extract chapters and articles by parent and child patterns.
@@ -196,47 +469,48 @@ def double_patterns_preprocess(
         chapter_pattern (re.Pattern): The regex pattern for chapter
         article_pattern (re.Pattern): The regex pattern for article
         ignore_patterns (List[re.Pattern]): text patterns are ignored once matched
+        ordered (bool): chapters and articles numbered out of order are body text, see `select_ordered_headings`
+    Returns:
+        list[dict]: slices, with `start`/`end` character offsets of their content lines in `pure_text`.\
+        A chapter without content is located at its chapter line
     """
     lines = pure_text.splitlines()
+    offsets = LineOffsets(pure_text, lines)
     last_chapter = ""
     last_article = None
     buffer = []
     slices = []
+    #NOTE indices of the first and last line of buffer and of the chapter line, converted to offsets once a slice is saved
+    buffer_first = buffer_last = chapter_line = 0
 
-    print("start processing chapters and articles...")
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        detect_ignore=False
-        for ignore_pattern in ignore_patterns:
-            if ignore_pattern.search(line):
-                detect_ignore=True
-                break
-        if detect_ignore:
-            logger.debug("detect ignore line: %s"%line)
-            continue
-
+    logger.debug("start processing chapters and articles...")
+    entries = scan_heading_lines(lines, [chapter_pattern, article_pattern], ignore_patterns, ordered)
+    for i, line, level in entries:
         # encounter new chapter
-        if chapter_pattern.search(line):
+        if level == 1:
             if buffer and not last_article:
                 #NOTE The content before the first chapter,
                 # or the content between chapters without articles, which belongs to the last chapter
+                start, end = offsets.span(buffer_first, buffer_last)
                 slices.append({
                     "chapter": last_chapter,
                     "article": "",
-                    "content": "\n".join(buffer)
+                    "content": "\n".join(buffer),
+                    "start": start,
+                    "end": end,
                 })
                 buffer = []
 
             elif last_article and buffer:
                 #NOTE You must save the last article before starting a new chapter
                 # otherwise the last article will be saved with the new chapter
+                start, end = offsets.span(buffer_first, buffer_last)
                 slices.append({
                     "chapter": last_chapter,
                     "article": last_article,
-                    "content": "\n".join(buffer)
+                    "content": "\n".join(buffer),
+                    "start": start,
+                    "end": end,
                 })
                 last_article = None
                 buffer = []
@@ -244,76 +518,93 @@ def double_patterns_preprocess(
             elif last_chapter and not buffer and not last_article:
                 #NOTE If there is no content between chapters, 
                 # or content and last chapter are on the same line
+                start, end = offsets.span(chapter_line, chapter_line)
                 slices.append({
                     "chapter": last_chapter,
                     "article": "",
-                    "content": ""
+                    "content": "",
+                    "start": start,
+                    "end": end,
                 })
             last_chapter = line
+            chapter_line = i
             continue
 
         # encounter new article
-        if article_pattern.search(line):
+        if level == 2:
             if last_article and buffer:
+                start, end = offsets.span(buffer_first, buffer_last)
                 slices.append({
                     "chapter": last_chapter,
                     "article": last_article,
-                    "content": "\n".join(buffer)
+                    "content": "\n".join(buffer),
+                    "start": start,
+                    "end": end,
                 })
             last_article = line
             buffer = [line]
+            buffer_first = i
         else:
+            if not buffer:
+                buffer_first = i
             buffer.append(line)
+        buffer_last = i
 
     #NOTE save the last article if exists and mostly exists
     # or the content after the last article
     if last_article or buffer:
+        start, end = offsets.span(buffer_first, buffer_last)
         slices.append({
             "chapter": last_chapter,
             "article": last_article,
-            "content": "\n".join(buffer)
+            "content": "\n".join(buffer),
+            "start": start,
+            "end": end,
         })
     return slices
 
 
-async def preprocess_before_chunk(formdata: ParsedFormData):
-    filename = formdata.file.filename
-    file_stream = await formdata.file.read()
-    temp_filepath = savebytes_dir / filename
-    async with aopen(str(temp_filepath), "wb") as awf:
-        await awf.write(file_stream)
-    match temp_filepath.suffix:
-        case ".docx":
-            text = await async_wrapper(get_pure_docx_text, temp_filepath)
-        case ".doc":
-            temp_store_docxs_dir = doc_converted_dir / formdata.request_id
-            await async_wrapper(temp_store_docxs_dir.mkdir, exist_ok=True, parents=False)
-            filepaths = await aconvert_docs_to_docxs(temp_filepath, temp_store_docxs_dir)
-            text = await async_wrapper(get_pure_docx_text, filepaths[0])
-        case ".pdf":
-            text = await request_mineru(
-                request_id=formdata.request_id,
-                output_format="markdown",
-                file_stream=file_stream,
-                filename=filename)
-        case ".md" | ".txt":
-            async with aopen(str(temp_filepath),'r') as arf:
-                text = await arf.read()
-        case _:
-            raise ValueError(f"Unsupported file format: {filename}")
-    patterns = formdata.re_matchers
+def split_text(
+    text:str,
+    re_matchers:Optional[List[str]]=None,
+    ignore_matchers:Optional[List[str]]=None,
+    split_mode:Literal["regex", "markdown"]="regex",
+) -> list[dict[str,str]]:
+    """
+    split pure text into slices by chapter/article patterns, or by markdown headings.
+
+    Args:
+        text (str): The pure text extracted from the document
+        re_matchers (List[str]): regular expressions of chapter (and article). Detected by predefined patterns if not given
+        ignore_matchers (List[str]): regular expressions of lines to be ignored
+        split_mode (Literal['regex', 'markdown']): `markdown` splits by the heading hierarchy of markdown,\
+        and falls back to regex patterns if there is no heading. `re_matchers` are always split by regex patterns
+    Returns:
+        list[dict]: slices of chapter, article and content, with `start`/`end` character offsets of their source in `text`
+    Raises:
+        ValueError: If more than 2 re_matchers are given
+    """
+    if split_mode == "markdown" and not re_matchers:
+        slices = markdown_to_slices(text, [re.compile(i) for i in ignore_matchers or []])
+        if slices is not None:
+            return slices
+        logger.info("No markdown heading found, split by regex patterns")
+
+    patterns = re_matchers
     if not patterns:
-        patterns = get_regex_pattern(text)
+        patterns, _ = detect_regex_pattern(text)
+        if isinstance(patterns, re.Pattern):
+            patterns = [patterns]
     else:
         patterns = [re.compile(i) for i in patterns]
 
-    ignore_patterns = formdata.ignore_matchers
+    ignore_patterns = ignore_matchers or []
     if ignore_patterns:
         ignore_patterns = [re.compile(i) for i in ignore_patterns]
 
     if len(patterns)==1:
-        print("✅ Detected only single pattern, jump to single patterns preprocess...")
-        slices = single_pattern_preprocess(text, patterns, ignore_patterns)
+        logger.info("✅ Detected only single pattern, jump to single patterns preprocess...")
+        slices = single_pattern_preprocess(text, patterns[0], ignore_patterns)
     elif len(patterns)==2:
         chapter_pattern, article_pattern = patterns
         if not chapter_pattern or not article_pattern:
@@ -321,7 +612,9 @@ async def preprocess_before_chunk(formdata: ParsedFormData):
             slices = [{
                 "chapter": "",
                 "article": "",
-                "content": text
+                "content": text,
+                "start": 0,
+                "end": len(text),
             }]
         else:
             logger.info("✅ Detected both chapter and article patterns, jump to double patterns preprocess...")
@@ -333,36 +626,274 @@ async def preprocess_before_chunk(formdata: ParsedFormData):
             )
     else:
         raise ValueError(f"`re_matchers` only support 2 patterns currently. You upload {len(patterns)} re_matchers.")
+    return slices
 
-    logger.info(f"✅ [preprocessing done] {len(slices)} chunks in total")
+
+def format_txt_slices(
+    slices:list[dict[str,str]],
+    filename:str="",
+    filename_in_chunk:bool=False,
+    length_limit:Optional[int]=None,
+    splitter:str="\n\n\n\n",
+    limit_unit:LimitUnit="char",
+) -> str:
+    """
+    format slices into text chunks separated by splitter.
+
+    Args:
+        slices (list[dict[str,str]]): slices to format
+        filename (str): filename inserted into chunks if `filename_in_chunk`
+        filename_in_chunk (bool): if True, set filename at the beginning of every chunk
+        length_limit (int): max length in a chunk. Slices are concatenated into a chunk as long as it fits
+        splitter (str): Text splitter for separating chunks
+        limit_unit (LimitUnit): unit of `length_limit`, characters or tokens
+    """
     # txt_slices=splitter.join([f"{filename}\n{slice['chapter']}\n{slice['content']}" for slice in slices])
-    output_format = formdata.output_format
-    filename_in_chunk = formdata.filename_in_chunk
+    if filename_in_chunk:
+        lines = [f"{filename}\n{slice['chapter']}\n{slice['content']}\n" for slice in slices]
+    else:
+        lines = [f"{slice['chapter']}\n{slice['content']}\n" for slice in slices]
+    if not length_limit:
+        return "".join(line + splitter for line in lines)
+
+    chunks = []
+    written_lines, written_length = [], 0
+    for line, length in zip(lines, count_lengths(lines, limit_unit)):
+        if written_length + length > length_limit and written_lines:
+            chunks.append("".join(written_lines))
+            written_lines, written_length = [], 0
+        written_lines.append(line)
+        written_length += length
+    #NOTE write into file for the last part && if whole document length < length_limit
+    return splitter.join(chunks + ["".join(written_lines)])
+
+
+def mineru_result_to_slices(
+    result:Any,
+    re_matchers:Optional[List[str]]=None,
+    ignore_matchers:Optional[List[str]]=None,
+) -> tuple[Optional[str], Optional[list[dict[str,str]]]]:
+    """
+    split a MinerU result by the heading levels of its blocks.
+    Regex patterns are used instead if `re_matchers` are given, or the result has no heading (or is markdown).
+
+    Returns:
+        tuple: text to be split by `split_text` and None, or None and slices split by headings
+    """
+    blocks = get_content_list(result)
+    if blocks is not None and not re_matchers:
+        slices = content_list_to_slices(blocks, [re.compile(i) for i in ignore_matchers or []])
+        if slices is not None:
+            return None, slices
+        logger.info("[mineru] no heading found in MinerU blocks, split by regex patterns")
+    return get_mineru_text(result), None
+
+
+def get_coalesce_key(content_hash:str, formdata:"ParsedFormData") -> str:
+    """requests with identical file content and parameters share one computation. `request_id` is excluded"""
+    params = formdata.model_dump(exclude={"request_id", "file"})
+    params["filename"] = formdata.file.filename #NOTE filename is inserted into chunks
+    return hashlib.sha256(f"{content_hash}\0{json.dumps(params, sort_keys=True)}".encode("utf8")).hexdigest()
+
+
+def save_content_addressed(file_stream:bytes, content_hash:str, suffix:str) -> Path:
+    """save bytes as `{content_hash}{suffix}`, so identical bytes are stored once"""
+    filepath = get_savebytes_dir() / f"{content_hash}{suffix}"
+    if not filepath.exists():
+        #NOTE write into a temp file and rename it, never expose a half-written file to concurrent requests
+        temp_filepath = filepath.with_name(f"{filepath.name}.{uuid.uuid4().hex}")
+        temp_filepath.write_bytes(file_stream)
+        os.replace(temp_filepath, filepath)
+    return filepath
+
+
+async def aconvert_content_addressed(filepath:Path, content_hash:str, convert_to:str="docx") -> Path:
+    """
+    convert .doc to .docx (or .xls to .xlsx) once per content by LibreOffice.
+    Concurrent conversions of identical bytes are coalesced
+    """
+    output_dir = get_doc_converted_dir() / content_hash
+    converted = list(output_dir.glob(f"*.{convert_to}")) if output_dir.exists() else []
+    if converted:
+        return converted[0]
+    async def convert():
+        async with LIBREOFFICE_LIMITER.acquire():
+            filepaths = await aconvert_docs_to_docxs(filepath, output_dir, convert_to=convert_to)
+        return filepaths[0]
+    return await CONVERT_FLIGHT.do(f"{content_hash}.{convert_to}", convert)
+
+
+def get_spreadsheet_length_limit(formdata: "ParsedFormData") -> int:
+    """max length of row groups of spreadsheets, leaving room for the sheet name (and filename) in txt chunks"""
+    if not formdata.length_limit:
+        return SPREADSHEET_CHUNK_CHARS
     length_limit = formdata.length_limit
-    splitter = formdata.chunk_splitter
-
-    if output_format == "txt":
-        # write to txt file
-        formated_text = ""
-        written_line=""
-        for slice in slices:
-            if filename_in_chunk:
-                line = f"{filename}\n{slice['chapter']}\n{slice['content']}\n"
-            else:
-                line = f"{slice['chapter']}\n{slice['content']}\n"
+    if formdata.output_format == "txt":
+        length_limit -= len(formdata.file.filename) + 1 if formdata.filename_in_chunk else 0
+        length_limit -= 32 #NOTE room for the sheet name line, sheet names are at most 31 characters
+    return max(length_limit, 1)
 
-            if length_limit:
-                if len(written_line+line)<=length_limit:
-                    written_line+=line
-                else:
-                    formated_text+=written_line+splitter
-                    written_line=line
+
+async def preprocess_before_chunk(formdata: "ParsedFormData"):
+    """
+    preprocess the uploaded file. Concurrent requests with identical file content and parameters
+    are coalesced into one computation, and share its result and its stage timings.
+
+    The computation holds a slot of `REQUEST_LIMITER` for as long as it runs, not the request that started it:
+    it stays admitted if that request is cancelled while others still wait for it, and coalesced requests take no slot.
+    Raises:
+        OverloadedError: If the computation is not admitted
+    """
+    with stage_timer("read"):
+        file_stream = await formdata.file.read()
+        if len(file_stream) > 1024 * 1024:
+            content_hash = await async_wrapper(lambda: hashlib.sha256(file_stream).hexdigest())
+        else:
+            content_hash = hashlib.sha256(file_stream).hexdigest()
+    result, stages = await PARSE_FLIGHT.do(
+        get_coalesce_key(content_hash, formdata),
+        lambda: _admitted_preprocess_before_chunk(formdata, file_stream, content_hash),
+    )
+    add_stage_timings(stages)
+    return result
+
+
+async def _admitted_preprocess_before_chunk(
+    formdata: "ParsedFormData", file_stream:bytes, content_hash:str) -> tuple[Any, dict[str, float]]:
+    #NOTE timed into a timer of its own, whose stages are added to the timers of all coalesced requests
+    with request_timer() as timer:
+        async with REQUEST_LIMITER.acquire():
+            result = await _preprocess_before_chunk(formdata, file_stream, content_hash)
+    return result, timer.stages
+
+
+async def _preprocess_before_chunk(formdata: "ParsedFormData", file_stream:bytes, content_hash:str):
+    filename = formdata.file.filename
+    suffix = Path(filename).suffix
+    #NOTE .md/.txt are decoded from memory and pdf bytes are sent to MinerU (or extracted from memory), only other files are saved for their parsers
+    if suffix in (".docx", ".doc", ".xlsx", ".xls"):
+        with stage_timer("save"):
+            temp_filepath = await async_wrapper(save_content_addressed, file_stream, content_hash, suffix)
+    markdown_source = suffix == ".md"
+    #NOTE units of the extracted text by slice key, like pages of pdfs. Slices are located in them by their offsets
+    units:dict[str, UnitIndex] = {}
+    match suffix:
+        case ".docx" | ".doc":
+            if suffix == ".doc":
+                with stage_timer("convert"):
+                    temp_filepath = await aconvert_content_addressed(temp_filepath, content_hash)
+            with stage_timer("extract"):
+                async with EXTRACT_LIMITER.acquire():
+                    paragraphs = await arun_extraction(get_docx_paragraphs, temp_filepath, affinity=content_hash)
+            text = "\n".join(paragraphs)
+            units["paragraphs"] = UnitIndex.from_texts(paragraphs)
+        case ".pdf":
+            result = None
+            if MINERU_URL or not PDF_LOCAL_FALLBACK:
+                try:
+                    with stage_timer("mineru"):
+                        async with MINERU_LIMITER.acquire():
+                            result = await request_mineru(
+                                request_id=formdata.request_id,
+                                output_format=MINERU_OUTPUT_FORMAT,
+                                file_stream=file_stream,
+                                filename=filename)
+                except Exception as e:
+                    if not PDF_LOCAL_FALLBACK:
+                        raise
+                    logger.warning(f"[mineru] failed, extracting {filename} locally instead: {e!r}")
+            if result is not None:
+                text, slices = mineru_result_to_slices(result, formdata.re_matchers, formdata.ignore_matchers)
+                markdown_source = True
+                page_index = get_page_index(get_content_list(result))
+                if page_index is not None:
+                    units["pages"] = page_index
             else:
-                formated_text+=line+splitter
-        if length_limit:
-            #NOTE write into file for the last part && if whole document length < length_limit
-            formated_text+=written_line
-        return formated_text
+                #NOTE text layers by layout and pages without text layer by local OCR, see `get_pdf_text_with_ocr`
+                with stage_timer("extract"):
+                    async with EXTRACT_LIMITER.acquire():
+                        pages = await aget_pdf_text_with_ocr(file_stream, affinity=content_hash)
+                text = "\n".join(pages)
+                units["pages"] = UnitIndex.from_texts(pages, first=1)
+        case ".md" | ".txt":
+            with stage_timer("decode"):
+                if len(file_stream) > 1024 * 1024:
+                    text, encoding = await async_wrapper(decode_bytes, file_stream)
+                else:
+                    text, encoding = decode_bytes(file_stream)
+            logger.debug(f"[decoding] {filename} decoded as {encoding}")
+        case ".xlsx" | ".xls":
+            text = None
+            if suffix == ".xls" and not xlrd_available():
+                with stage_timer("convert"):
+                    temp_filepath = await aconvert_content_addressed(temp_filepath, content_hash, convert_to="xlsx")
+            #NOTE rows are grouped into slices by sheet directly, no chapter/article to split by
+            with stage_timer("extract"):
+                async with EXTRACT_LIMITER.acquire():
+                    slices = await arun_extraction(
+                        get_spreadsheet_slices,
+                        temp_filepath,
+                        length_limit=get_spreadsheet_length_limit(formdata),
+                        header_rows=SPREADSHEET_HEADER_ROWS,
+                        limit_unit=formdata.limit_unit,
+                        affinity=content_hash)
+        case _:
+            raise ValueError(f"Unsupported file format: {filename}")
+    with stage_timer("split"):
+        if text is not None:
+            #NOTE .md files and MinerU markdown are markdown sources, texts extracted locally are not
+            split_mode = resolve_split_mode(formdata.split_mode, markdown_source=markdown_source)
+            slices = split_text(text, formdata.re_matchers, formdata.ignore_matchers, split_mode)
+        for key, index in units.items():
+            add_unit_numbers(slices, key, index)
+
+    logger.info(f"✅ [preprocessing done] {len(slices)} chunks in total")
+    if CORPUS_STORE is not None:
+        #NOTE buffered and written behind the request, see `CorpusStore`
+        with stage_timer("store"):
+            await CORPUS_STORE.aput(formdata.document_id or content_hash, filename, content_hash, slices)
+    if formdata.overlap is not None:
+        with stage_timer("window"):
+            windows = await async_wrapper(
+                window_slices,
+                slices,
+                length_limit=formdata.length_limit,
+                overlap=formdata.overlap,
+                filename=filename,
+                filename_in_chunk=formdata.filename_in_chunk,
+                limit_unit=formdata.limit_unit)
+        logger.info(f"✅ [windowing done] {len(windows)} overlapping windows")
+        if formdata.output_format == "txt":
+            return format_txt_windows(slices, windows, splitter=formdata.chunk_splitter)
+        return dict(slices=slices, windows=windows)
+    if formdata.document_id and formdata.output_format == "json":
+        #NOTE only added and changed slices are returned (and embedded)
+        with stage_timer("version"):
+            diff, version = await VERSION_STORE.adiff(formdata.document_id, slices)
+        if formdata.embed:
+            with stage_timer("embed"):
+                await embed_slices(diff["added"] + diff["changed"])
+        #NOTE saved once embedding succeeded, or a retry would find nothing to embed
+        with stage_timer("version"):
+            await VERSION_STORE.acommit(version)
+        return diff
+    if formdata.embed and formdata.output_format == "json":
+        with stage_timer("embed"):
+            slices = await embed_slices(slices)
+
+    if formdata.output_format == "txt":
+        format_kwargs = dict(
+            filename=filename,
+            filename_in_chunk=formdata.filename_in_chunk,
+            length_limit=formdata.length_limit,
+            splitter=formdata.chunk_splitter,
+            limit_unit=formdata.limit_unit,
+        )
+        with stage_timer("format"):
+            if formdata.length_limit and formdata.limit_unit == "token":
+                #NOTE encoding lines blocks, run it off the event loop
+                return await async_wrapper(format_txt_slices, slices, **format_kwargs)
+            return format_txt_slices(slices, **format_kwargs)
 
     return slices
     
@@ -384,5 +915,5 @@ if __name__ == '__main__':
         ignore_patterns=ignore_matchers)
     with open("dd_parser.json",'w') as f:
         json.dump(slices,f,ensure_ascii=False,indent=2)
-    from shutil import rmtree
-    rmtree(TEMP_DIR)
\ No newline at end of file
+    from dd_parser.config import remove_temp_dir
+    remove_temp_dir()
\ No newline at end of file
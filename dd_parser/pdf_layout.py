@@ -0,0 +1,227 @@
+import hashlib
+from typing import *
+from pathlib import Path
+from collections import Counter, OrderedDict
+
+import regex as re
+
+if TYPE_CHECKING:
+    import fitz  # PyMuPDF
+
+from .logg import logger
+from .config import PDF_LAYOUT_CACHE_SIZE
+
+#NOTE page numbers like `3`, `- 3 -`, `第 3 页`, `第3页 共10页`, `3 / 10`, `Page 3`
+page_number_pattern = re.compile(
+    r"^[-—–\s]*(?:第\s*\d+\s*页(?:\s*[,，/]?\s*共\s*\d+\s*页)?|(?:page\s*)?\d+(?:\s*/\s*\d+)?)[-—–\s]*$",
+    re.IGNORECASE)
+cjk_pattern = re.compile(r"[\p{Han}\p{P}]")
+
+#NOTE lines of at most this many lines from the top/bottom of a page are header/footer candidates
+HEADER_FOOTER_CANDIDATES = 3
+
+
+class PageLayout(TypedDict):
+    width: float
+    height: float
+    lines: list[tuple[float, float, float, float, str]] # (x0, y0, x1, y1, text), in reading order
+    tables: list[tuple[tuple[float, float, float, float], list[list[str]]]] # (bbox, rows)
+
+
+#NOTE keyed by (document key, find_tables, page number): a layout extracted without tables never serves a request for tables
+_layout_cache:OrderedDict[tuple[str, bool, int], PageLayout] = OrderedDict()
+_page_counts:dict[str, int] = {}
+cache_hits = 0
+cache_misses = 0
+
+
+def _get_document_key(file:str | Path | bytes) -> str:
+    if isinstance(file, bytes):
+        return hashlib.sha1(file).hexdigest()
+    stat = Path(file).stat()
+    return f"{Path(file).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _join_text(left:str, right:str) -> str:
+    #NOTE no space between CJK characters, a space between latin words
+    if not left or not right:
+        return left + right
+    if cjk_pattern.match(left[-1]) or cjk_pattern.match(right[0]):
+        return left + right
+    return f"{left} {right}"
+
+
+def _in_bbox(line:tuple, bbox:tuple) -> bool:
+    x0, y0, x1, y1 = line[:4]
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    return bbox[0] <= cx <= bbox[2] and bbox[1] <= cy <= bbox[3]
+
+
+def extract_page_layout(page:"fitz.Page", find_tables:bool=True) -> PageLayout:
+    """
+    extract lines and tables of a pdf page from PyMuPDF block/line data.
+
+    Spans of a line are joined, and lines split by PyMuPDF on the same row (like justified text) are merged back.
+    Lines inside tables are moved into table rows.
+    """
+    raw_lines = []
+    for block in page.get_text("dict", sort=True)["blocks"]:
+        if block["type"] != 0: #NOTE 0 is text block, 1 is image block
+            continue
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            if text:
+                raw_lines.append((*line["bbox"], text))
+
+    tables = []
+    if find_tables:
+        try:
+            for table in page.find_tables().tables:
+                rows = [[(cell or "").replace("\n", " ").strip() for cell in row] for row in table.extract()]
+                tables.append((tuple(table.bbox), rows))
+        except Exception as e:
+            #NOTE table detection is best effort, never fail the whole page for it
+            logger.warning(f"[pdf layout] failed to find tables on page {page.number}: {e!r}")
+        if tables:
+            raw_lines = [line for line in raw_lines if not any(_in_bbox(line, bbox) for bbox, _ in tables)]
+
+    #NOTE merge lines on the same row
+    raw_lines.sort(key=lambda line: (round(line[1]), line[0]))
+    lines = []
+    for line in raw_lines:
+        if lines:
+            x0, y0, x1, y1, text = lines[-1]
+            overlap = min(y1, line[3]) - max(y0, line[1])
+            if overlap > 0.5 * min(y1 - y0, line[3] - line[1]) and line[0] >= x1 - 1:
+                lines[-1] = (x0, min(y0, line[1]), line[2], max(y1, line[3]), _join_text(text, line[4]))
+                continue
+        lines.append(line)
+
+    return PageLayout(width=page.rect.width, height=page.rect.height, lines=lines, tables=tables)
+
+
+def get_pdf_layouts(file:str | Path | bytes, find_tables:bool=True) -> list[PageLayout]:
+    """
+    layouts of all pages of a pdf, cached per page by document content and `find_tables`.
+    """
+    global cache_hits, cache_misses
+    document_key = _get_document_key(file)
+    page_count = _page_counts.get(document_key)
+    if page_count is not None and all((document_key, find_tables, i) in _layout_cache for i in range(page_count)):
+        cache_hits += page_count
+        layouts = []
+        for i in range(page_count):
+            _layout_cache.move_to_end((document_key, find_tables, i))
+            layouts.append(_layout_cache[(document_key, find_tables, i)])
+        return layouts
+
+    import fitz #NOTE imported on first pdf, PyMuPDF is slow to import
+    if isinstance(file, bytes):
+        pdf_doc = fitz.open(stream=file, filetype="pdf")
+    else:
+        pdf_doc = fitz.open(str(file))
+    layouts = []
+    with pdf_doc:
+        _page_counts[document_key] = pdf_doc.page_count
+        for page in pdf_doc:
+            key = (document_key, find_tables, page.number)
+            layout = _layout_cache.get(key)
+            if layout is None:
+                cache_misses += 1
+                layout = extract_page_layout(page, find_tables=find_tables)
+                _layout_cache[key] = layout
+            else:
+                cache_hits += 1
+            _layout_cache.move_to_end(key)
+            layouts.append(layout)
+    while len(_layout_cache) > PDF_LAYOUT_CACHE_SIZE:
+        (evicted_key, _, _), _ = _layout_cache.popitem(last=False)
+        _page_counts.pop(evicted_key, None)
+    return layouts
+
+
+def _normalize_repeated_line(text:str) -> str:
+    #NOTE page numbers differ on every page, compare lines with digits masked
+    return re.sub(r"\d+", "#", re.sub(r"\s+", "", text))
+
+
+def detect_headers_footers(
+    layouts:list[PageLayout], min_repeat_ratio:float=0.5,
+) -> tuple[set[str], set[str]]:
+    """
+    detect repeated header and footer lines statistically across pages.
+
+    A line among the first (last) `HEADER_FOOTER_CANDIDATES` lines of a page is a header (footer)
+    if it repeats, with digits masked, on at least `min_repeat_ratio` of pages (and at least 2 pages).
+    Returns:
+        tuple[set[str], set[str]]: normalized header lines, normalized footer lines
+    """
+    header_counter, footer_counter = Counter(), Counter()
+    for layout in layouts:
+        lines = layout["lines"]
+        header_counter.update({_normalize_repeated_line(line[4]) for line in lines[:HEADER_FOOTER_CANDIDATES]})
+        footer_counter.update({_normalize_repeated_line(line[4]) for line in lines[-HEADER_FOOTER_CANDIDATES:]})
+    threshold = max(2, min_repeat_ratio * len(layouts))
+    headers = {text for text, count in header_counter.items() if count >= threshold}
+    footers = {text for text, count in footer_counter.items() if count >= threshold}
+    return headers, footers
+
+
+def format_table(rows:list[list[str]]) -> str:
+    return "\n".join(" | ".join(row) for row in rows if any(row))
+
+
+def get_pdf_layout_text(
+    file:str | Path | bytes,
+    exclude_header:bool = True,
+    exclude_footer:bool = True,
+    include_tables:bool = True,
+    min_repeat_ratio:float = 0.5,
+) -> list[str]:
+    """
+    extract text from a given PDF file by layout, with lines and tables rebuilt and headers/footers removed.
+
+    Unlike `get_pure_pdf_text`, headers and footers are detected by lines repeated across pages (and page numbers),
+    not by a fixed band. Page layouts are cached, so calling it again with other options does not parse the PDF again.
+
+    Args:
+        file(str| Path | bytes): PDF filepath or PDF file bytes
+        exclude_header(bool): given True to exclude repeated header lines
+        exclude_footer(bool): given True to exclude repeated footer lines and page numbers
+        include_tables(bool): given True to append tables as rows of `cell | cell`, in place of their lines
+        min_repeat_ratio(float): ratio of pages a line must repeat on to be header/footer
+    Returns:
+        out(list[str]): list of texts of all pdf pages.
+    """
+    layouts = get_pdf_layouts(file)
+    headers, footers = detect_headers_footers(layouts, min_repeat_ratio) if exclude_header or exclude_footer else (set(), set())
+
+    full_texts = []
+    for layout in layouts:
+        lines = layout["lines"]
+        head = HEADER_FOOTER_CANDIDATES
+        tail = max(len(lines) - HEADER_FOOTER_CANDIDATES, 0)
+        items = [] # (y0, text)
+        for i, line in enumerate(lines):
+            text = line[4]
+            if exclude_header and i < head and _normalize_repeated_line(text) in headers:
+                continue
+            if exclude_footer and i >= tail and (
+                _normalize_repeated_line(text) in footers or page_number_pattern.match(text)):
+                continue
+            items.append((line[1], text))
+        if include_tables:
+            items.extend((bbox[1], format_table(rows)) for bbox, rows in layout["tables"])
+            items.sort(key=lambda item: item[0])
+        full_texts.append("\n".join(text for _, text in items).strip())
+    return full_texts
+
+
+def get_pdf_layout_cache_info() -> dict:
+    total = cache_hits + cache_misses
+    return dict(
+        pages=len(_layout_cache),
+        hits=cache_hits,
+        misses=cache_misses,
+        hit_rate=cache_hits / total if total else 0.0,
+    )
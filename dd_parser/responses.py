@@ -0,0 +1,124 @@
+import gzip
+import json
+from typing import *
+from contextlib import nullcontext
+
+from fastapi import Request, Response
+
+from .tools import async_wrapper
+from .timing import StageTimer
+from .config import COMPRESS_MIN_SIZE, GZIP_LEVEL, ZSTD_LEVEL
+
+#NOTE optional encoders. Fall back to stdlib json / gzip if not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+#NOTE payloads larger than this are encoded and compressed in a thread, not to block the event loop
+OFFLOAD_SIZE = 256 * 1024
+
+
+def parse_header_qvalues(header:str) -> dict[str, float]:
+    """parse header like `gzip;q=0.8, zstd` into {"gzip": 0.8, "zstd": 1.0}"""
+    qvalues = {}
+    for item in header.split(","):
+        token, *params = item.strip().split(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[token] = q
+    return qvalues
+
+
+def choose_media_type(accept:str) -> str:
+    """`application/msgpack` if the client asks for it and msgpack is installed, else `application/json`"""
+    if msgpack is not None:
+        qvalues = parse_header_qvalues(accept)
+        for media_type in MSGPACK_MEDIA_TYPES:
+            if qvalues.get(media_type, 0.0) > 0 and qvalues[media_type] >= qvalues.get("application/json", 0.0):
+                return media_type
+    return "application/json"
+
+
+def choose_encoding(accept_encoding:str) -> Optional[str]:
+    """prefer zstd over gzip. Returns None if the client accepts neither"""
+    qvalues = parse_header_qvalues(accept_encoding)
+    candidates = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    candidates = [c for c in candidates if qvalues.get(c, qvalues.get("*", 0.0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: qvalues.get(c, qvalues.get("*", 0.0))) #NOTE `max` keeps the first on ties
+
+
+def serialize(payload:Any, media_type:str) -> bytes:
+    if media_type in MSGPACK_MEDIA_TYPES:
+        return msgpack.packb(payload, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+
+
+def compress(body:bytes, encoding:str) -> bytes:
+    match encoding:
+        case "zstd":
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        case "gzip":
+            return gzip.compress(body, compresslevel=GZIP_LEVEL)
+        case _:
+            raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def encode_payload(payload:Any, media_type:str, encoding:Optional[str]) -> tuple[bytes, Optional[str]]:
+    body = serialize(payload, media_type)
+    if encoding and len(body) >= COMPRESS_MIN_SIZE:
+        return compress(body, encoding), encoding
+    return body, None
+
+
+async def negotiated_response(
+    request:Request,
+    payload:Any,
+    payload_size_hint:int=0,
+    timer:Optional[StageTimer]=None,
+) -> Response:
+    """
+    encode payload by `Accept` (json or msgpack) and compress it by `Accept-Encoding` (zstd or gzip).
+
+    Args:
+        request (Request): the incoming request
+        payload (Any): json serializable result
+        payload_size_hint (int): approximate size of payload, to decide whether to encode it in a thread
+        timer (StageTimer): stage timings of the request, encoding included, are reported by `Server-Timing` header
+    """
+    media_type = choose_media_type(request.headers.get("accept", ""))
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    with timer.stage("encode") if timer is not None else nullcontext():
+        if payload_size_hint >= OFFLOAD_SIZE:
+            body, encoding = await async_wrapper(encode_payload, payload, media_type, encoding)
+        else:
+            body, encoding = encode_payload(payload, media_type, encoding)
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if timer is not None:
+        headers["Server-Timing"] = timer.server_timing()
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,335 @@
+import sys
+import signal
+import asyncio
+import threading
+import multiprocessing
+from typing import *
+from collections import Counter, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+try:
+    import resource #NOTE POSIX only, resource limits are skipped on Windows (timeouts still apply)
+except ImportError:
+    resource = None
+
+from .logg import logger, init_logging
+from .config import (
+    EXTRACT_SANDBOX,
+    EXTRACT_CONCURRENCY,
+    EXTRACT_TIMEOUT,
+    EXTRACT_CPU_LIMIT,
+    EXTRACT_MEMORY_LIMIT,
+)
+
+T = TypeVar("T")
+
+#NOTE caches filled by jobs in workers, by their names in `/status`: module and function returning their stats.
+# Stats are collected only from modules a worker has imported, and sent back with every result
+WORKER_CACHES = {
+    "docx_numbering": ("numbering", "get_numbering_cache_info"),
+    "pdf_layout": ("pdf_layout", "get_pdf_layout_cache_info"),
+    "token_counts": ("tokenizer", "get_token_count_stats"),
+}
+#NOTE affinity keys remembered per worker, see `SandboxPool.call`
+AFFINITY_KEYS = 64
+
+
+class ExtractionError(Exception):
+    """
+    raised when an extraction job breaches its limits or its worker dies. The worker is killed and respawned,
+    other jobs are not affected. Should be returned as 422, the document is likely malformed or hostile.
+    """
+    def __init__(self, job:str, reason:Literal["timeout", "cpu", "memory", "crashed"], message:str):
+        super().__init__(f"[{job}] {message}")
+        self.job = job
+        self.reason = reason
+        self.status_code = 422
+
+
+def apply_memory_limit(memory_limit:Optional[int]):
+    """cap the address space of this process to `memory_limit` MB, allocations beyond it raise MemoryError"""
+    if resource is None or not memory_limit:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = memory_limit * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _apply_cpu_limit(seconds:Optional[float]):
+    #NOTE RLIMIT_CPU counts the whole life of the process, so the soft limit is moved forward before every job.
+    # Once exceeded, the kernel sends SIGXCPU and the worker dies
+    if resource is None or not seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def merge_cache_stats(*stats:Optional[dict]) -> Optional[dict]:
+    """
+    stats of the same cache in several processes, like the api process and its sandboxed workers, in one.
+    Counts (like `hits`, `misses` and sizes) are summed and `hit_rate` is computed again, other values are taken from the first.
+
+    Returns:
+        dict | None: merged stats, None if no process has stats of the cache
+    """
+    stats = [item for item in stats if item]
+    if not stats:
+        return None
+    merged = {}
+    for item in stats:
+        for key, value in item.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, value)
+    hits, misses = merged.get("hits", 0), merged.get("misses", 0)
+    merged["hit_rate"] = hits / (hits + misses) if hits + misses else 0.0
+    return merged
+
+
+def _collect_cache_stats() -> dict[str, dict]:
+    stats = {}
+    for name, (module_name, function_name) in WORKER_CACHES.items():
+        module = sys.modules.get(f"{__package__}.{module_name}")
+        if module is not None:
+            item = getattr(module, function_name)()
+            if item is not None:
+                stats[name] = item
+    return stats
+
+
+def _worker_main(conn, cpu_limit:Optional[float], memory_limit:Optional[int]):
+    init_logging(enqueue=False)
+    apply_memory_limit(memory_limit)
+    while True:
+        try:
+            func, args, kwargs = conn.recv()
+        except (EOFError, OSError):
+            return
+        _apply_cpu_limit(cpu_limit)
+        try:
+            result = ("ok", func(*args, **kwargs))
+        except MemoryError:
+            result = ("memory", f"memory limit of {memory_limit} MB exceeded")
+        except Exception as e:
+            result = ("error", e)
+        cache_stats = _collect_cache_stats()
+        try:
+            conn.send(result + (cache_stats,))
+        except Exception as e: #NOTE unpicklable results or exceptions
+            conn.send(("error", RuntimeError(f"{type(result[1]).__name__}: {e}"), cache_stats))
+
+
+class _Worker:
+    def __init__(self, context, cpu_limit:Optional[float], memory_limit:Optional[int]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, cpu_limit, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        #NOTE stats of caches of the worker after its last job, see `WORKER_CACHES`
+        self.cache_stats:dict[str, dict] = {}
+        self.affinity_keys:deque[str] = deque(maxlen=AFFINITY_KEYS)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool(Executor):
+    """
+    pool of isolated worker processes for extraction jobs, like parsing a docx or pdf.
+
+    Every job has a wall-clock timeout and a CPU time cap (`RLIMIT_CPU`), and every worker an address space cap (`RLIMIT_AS`).
+    A worker breaching them, or dying, is killed and its job fails with `ExtractionError`, and a new worker is spawned for the next job.
+    Exceptions raised by jobs are raised as is. Workers are spawned on demand and reused.
+    Jobs and their results must be picklable, like module level functions.
+    Workers keep caches of their own (like docx numbering), their stats are sent back with every result, see `cache_stats`.
+
+    Args:
+        name (str): pool name, shown in logs, errors and stats
+        workers (int): max worker processes, jobs beyond it wait for a free worker
+        timeout (float | None): default wall-clock seconds of a job
+        cpu_limit (float | None): CPU seconds of a job, no cap if None
+        memory_limit (int | None): MB of address space of a worker, no cap if None
+    """
+    def __init__(
+        self,
+        name:str,
+        workers:int,
+        timeout:Optional[float]=None,
+        cpu_limit:Optional[float]=None,
+        memory_limit:Optional[int]=None,
+    ):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        #NOTE spawned, not forked: forking a process running threads (the event loop, uvicorn) is unsafe
+        self._context = multiprocessing.get_context("spawn")
+        self._idle:list[_Worker] = []
+        self._busy:set[_Worker] = set()
+        self._spawned = 0
+        self._condition = threading.Condition()
+        self._threads:Optional[ThreadPoolExecutor] = None
+
+        self.jobs = 0
+        self.failures:Counter[str] = Counter()
+        self.respawns = 0
+        #NOTE hits and misses of caches of workers gone, their caches are gone with them
+        self._retired_cache_stats:dict[str, dict] = {}
+
+    def _acquire(self, affinity:Optional[str]=None) -> _Worker:
+        with self._condition:
+            while not self._idle and self._spawned >= self.workers:
+                self._condition.wait()
+            if self._idle:
+                #NOTE the idle worker which served the same key last, its caches likely hold what the job needs
+                index = next((i for i, worker in enumerate(self._idle) if affinity in worker.affinity_keys), -1) if affinity else -1
+                worker = self._idle.pop(index)
+                self._busy.add(worker)
+                return worker
+            self._spawned += 1
+        try:
+            worker = _Worker(self._context, self.cpu_limit, self.memory_limit)
+        except BaseException:
+            with self._condition:
+                self._spawned -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._busy.add(worker)
+        return worker
+
+    def _retire(self, worker:_Worker):
+        #NOTE called with `_condition` held
+        for name, item in worker.cache_stats.items():
+            retired = self._retired_cache_stats.setdefault(name, {})
+            for key in ("hits", "misses"):
+                retired[key] = retired.get(key, 0) + item.get(key, 0)
+
+    def _release(self, worker:_Worker, healthy:bool):
+        if not healthy:
+            worker.kill()
+        with self._condition:
+            self._busy.discard(worker)
+            if healthy:
+                self._idle.append(worker)
+            else:
+                self._retire(worker)
+                self._spawned -= 1
+                self.respawns += 1
+            self._condition.notify()
+
+    def call(self, func:Callable[..., T], *args, timeout:Optional[float]=None, affinity:Optional[str]=None, **kwargs) -> T:
+        """
+        run `func(*args, **kwargs)` in a worker, blocking until it returns.
+        Jobs of the same `affinity` key (like the content hash of a document) prefer the idle worker which ran the last of them,
+        so that they hit its caches.
+
+        Raises:
+            ExtractionError: If the job times out, exceeds its CPU or memory limit, or its worker dies
+        """
+        job = getattr(func, "__name__", repr(func))
+        timeout = timeout if timeout is not None else self.timeout
+        worker = self._acquire(affinity)
+        if affinity:
+            worker.affinity_keys.append(affinity)
+        healthy = False
+        try:
+            self.jobs += 1
+            try:
+                worker.conn.send((func, args, kwargs))
+                if not worker.conn.poll(timeout):
+                    self.failures["timeout"] += 1
+                    raise ExtractionError(job, "timeout", f"no result within {timeout}s, worker killed")
+                status, payload, worker.cache_stats = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.process.join(1)
+                exitcode = worker.process.exitcode
+                reason = "cpu" if resource is not None and exitcode == -signal.SIGXCPU else "crashed"
+                self.failures[reason] += 1
+                message = f"CPU limit of {self.cpu_limit}s exceeded" if reason == "cpu" else f"worker died with exit code {exitcode}"
+                raise ExtractionError(job, reason, message) from None
+            if status == "memory":
+                #NOTE a worker recovered from MemoryError may hold a fragmented heap, it is replaced anyway
+                self.failures["memory"] += 1
+                raise ExtractionError(job, "memory", payload)
+            healthy = True
+            if status == "error":
+                raise payload
+            return payload
+        except ExtractionError as e:
+            logger.warning(f"[sandbox {self.name}] {e}")
+            raise
+        finally:
+            self._release(worker, healthy)
+
+    def submit(self, fn:Callable[..., T], /, *args, **kwargs) -> Future:
+        """`Executor.submit`, the job runs in a worker process and is waited for in a thread"""
+        with self._condition:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"sandbox_{self.name}")
+        return self._threads.submit(self.call, fn, *args, **kwargs)
+
+    async def acall(self, func:Callable[..., T], *args, timeout:Optional[float]=None, affinity:Optional[str]=None, **kwargs) -> T:
+        """async `call`, waiting in a thread"""
+        return await asyncio.to_thread(self.call, func, *args, timeout=timeout, affinity=affinity, **kwargs)
+
+    def shutdown(self, wait:bool=True, *, cancel_futures:bool=False):
+        with self._condition:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.shutdown(wait=wait, cancel_futures=cancel_futures)
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._spawned -= len(idle)
+            for worker in idle:
+                self._retire(worker)
+        for worker in idle:
+            worker.kill()
+
+    def stats(self) -> dict:
+        return dict(
+            workers=self._spawned,
+            idle=len(self._idle),
+            jobs=self.jobs,
+            failures=dict(self.failures),
+            respawns=self.respawns,
+        )
+
+    def cache_stats(self) -> dict[str, dict]:
+        """stats of caches of all workers by cache name (see `WORKER_CACHES`), counts summed like `merge_cache_stats`"""
+        with self._condition:
+            items = [worker.cache_stats for worker in [*self._idle, *self._busy]] + [self._retired_cache_stats]
+        names = {name for item in items for name in item}
+        return {name: merge_cache_stats(*(item.get(name) for item in items)) for name in names}
+
+
+EXTRACT_POOL = SandboxPool(
+    "extract",
+    workers=EXTRACT_CONCURRENCY,
+    timeout=EXTRACT_TIMEOUT,
+    cpu_limit=EXTRACT_CPU_LIMIT or None,
+    memory_limit=EXTRACT_MEMORY_LIMIT or None,
+)
+
+
+async def arun_extraction(func:Callable[..., T], *args, affinity:Optional[str]=None, **kwargs) -> T:
+    """
+    run an extraction job in `EXTRACT_POOL`, or in a thread of this process if `EXTRACT_SANDBOX` is off.
+    Jobs of the same `affinity` key prefer the same worker, see `SandboxPool.call`.
+
+    Raises:
+        ExtractionError: If the job breaches its limits, see `SandboxPool.call`
+    """
+    if EXTRACT_SANDBOX:
+        return await EXTRACT_POOL.acall(func, *args, affinity=affinity, **kwargs)
+    return await asyncio.to_thread(func, *args, **kwargs)
@@ -18,7 +18,7 @@ class SupportedFileTypes(enum.Enum):
     @classmethod
     def get_developed(cls):
         """get file types that are developed"""
-        return [cls.DOCX.value, cls.DOC.value, cls.PDF.value, cls.MD.value, cls.TXT.value]
+        return [cls.DOCX.value, cls.DOC.value, cls.PDF.value, cls.MD.value, cls.TXT.value, cls.XLSX.value, cls.XLS.value]
 
 
 OutputFormat:TypeAlias = Literal["json","txt"]
@@ -59,6 +59,16 @@ class ParsedFormData(BaseModel):
     )
     "regular matcher(s). To match the texts need to be ignored(deleted)."
 
+    split_mode: Literal["auto", "regex", "markdown"] = Field(
+        default="auto",
+        title="split mode",
+        description=(
+            "`markdown` splits by the heading hierarchy of markdown (ATX/setext headings), "
+            "tables and code blocks are never split. Falls back to regex patterns if there is no heading.\n\n"
+            "`regex` splits by chapter/article patterns (`re_matchers`, or detected).\n\n"
+            "`auto` uses `markdown` for .md files and MinerU markdown of pdf files, `regex` for others."),)
+    "`markdown` splits by markdown headings, `regex` by chapter/article patterns, `auto` by file type"
+
     filename_in_chunk: bool = Field(
         default=False,
         title="filename_in_chunk",
@@ -74,8 +84,29 @@ class ParsedFormData(BaseModel):
     length_limit: Optional[int] = Field(
         default=None,
         title="length limit",
-        description="max length in a chunk. Every length of chunk <= length_limit. **Only used when `output_format==txt`**",)
-    "max length in a chunk. Every length of chunk <= length_limit. **Only used when `output_format==txt`**"
+        description=(
+            "max length in a chunk. Every length of chunk <= length_limit. **Only used when `output_format==txt`**\n\n"
+            "[NOTE] For xlsx/xls files, it also bounds the row groups of every slice in `output_format==json`"),)
+    "max length in a chunk. Every length of chunk <= length_limit. **Only used when `output_format==txt`** (and spreadsheets)"
+
+    overlap: Optional[int] = Field(
+        default=None,
+        title="overlap",
+        description=(
+            "[Optional] max length (in `limit_unit`) of trailing slices of a chunk repeated at the beginning of the next chunk. "
+            "Once given, slices are grouped into overlapping windows of at most `length_limit`, "
+            "each prefixed by the chapter/article path of its first slice.\n\n"
+            "With `output_format==json`, returns `slices` and `windows` referring to slices by index range `[start, end)`."
+        ),)
+    "max length of trailing slices of a chunk repeated at the beginning of the next chunk. Requires `length_limit`"
+
+    limit_unit: Literal["char", "token"] = Field(
+        default="char",
+        title="length limit unit",
+        description=(
+            "unit of `length_limit`. `char` counts characters, "
+            "`token` counts tokens by the tokenizer at `TOKENIZER_PATH` (approximated if not configured)"),)
+    "unit of `length_limit`. `char` counts characters, `token` counts tokens by the tokenizer at `TOKENIZER_PATH`"
 
     chunk_splitter: str = Field(
         default="\n\n\n\n",
@@ -83,6 +114,23 @@ class ParsedFormData(BaseModel):
         description="Text splitter for separating content. Default is `\\n\\n\\n\\n`.  **Only used when `output_format==txt`**",)
     "Text splitter for separating content. Default is `\\n\\n\\n\\n`.  **Only used when `output_format==txt`**"
 
+    embed: bool = Field(
+        default=False,
+        title="embed",
+        description="add embedding of every slice by the embeddings endpoint configured. **Only used when `output_format==json`**",)
+    "add embedding of every slice by the embeddings endpoint configured. **Only used when `output_format==json`**"
+
+    document_id: Optional[str] = Field(
+        default=None,
+        title="document id",
+        description=(
+            "[Optional] identifier of the document, which stays the same across revisions. "
+            "Once given, slices are diffed against the last version parsed with the same document id, "
+            "and only added, changed and removed slices are returned, with stable slice ids.\n\n"
+            "**Only used when `output_format==json`**"
+        ),)
+    "identifier of the document, which stays the same across revisions. **Only used when `output_format==json`**"
+
     @model_validator(mode="after")
     def check_file_type_validation(self) -> Self: #NOTE `typing.Self` only applied in python311 or higher
         supported_extensions = SupportedFileTypes.get_developed()
@@ -92,6 +140,32 @@ class ParsedFormData(BaseModel):
                 "extension only support: supported_extensions. Yours: %s" % file_extension)
         return self
 
+    @model_validator(mode="after")
+    def check_overlap_validation(self) -> Self:
+        if self.overlap is None:
+            return self
+        if not self.length_limit:
+            raise ValueError("`overlap` requires `length_limit`")
+        if not 0 <= self.overlap < self.length_limit:
+            raise ValueError("`overlap` must be in [0, length_limit)")
+        if self.embed or self.document_id:
+            raise ValueError("`overlap` does not support `embed` or `document_id`, which work on slices")
+        return self
+
+    @model_validator(mode="after")
+    def check_split_mode_validation(self) -> Self:
+        if self.split_mode == "markdown" and self.re_matchers:
+            raise ValueError("`re_matchers` split by regex patterns, use `split_mode==regex` or `auto`")
+        return self
+
+    @model_validator(mode="after")
+    def check_json_only_validation(self) -> Self:
+        if self.embed and self.output_format != "json":
+            raise ValueError("`embed` only supports `output_format==json`")
+        if self.document_id and self.output_format != "json":
+            raise ValueError("`document_id` only supports `output_format==json`")
+        return self
+
 
 if __name__ == '__main__':
     x=ParsedFormData(request_id="etstresrtse")
@@ -0,0 +1,181 @@
+import datetime
+import importlib.util
+from typing import *
+from pathlib import Path
+
+from .logg import logger
+from .tokenizer import LimitUnit, get_length_function
+
+#NOTE cells of a row are joined like pdf tables, `cell | cell`
+CELL_SEPARATOR = " | "
+
+
+def format_cell(value:Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        #NOTE date cells are read as datetimes, like `2024-01-02 00:00:00`
+        return value.date().isoformat()
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).replace("\n", " ").strip()
+
+
+def format_row(values:Iterable[Any]) -> str:
+    """format a row into `cell | cell`, with trailing empty cells dropped. Empty rows are formatted into ''"""
+    cells = [format_cell(value) for value in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return CELL_SEPARATOR.join(cells)
+
+
+def iter_xlsx_sheets(filepath:Union[str, Path]) -> Iterator[tuple[str, Iterator[list]]]:
+    """
+    stream rows of every sheet in a .xlsx file, by `openpyxl` in read-only mode: sheet xml is parsed incrementally
+    as rows are iterated, instead of loaded at once. Cached values of formulas are read, and date cells are converted to dates.
+
+    Yields:
+        tuple[str, Iterator[list]]: sheet name, iterator of cell values of rows
+    """
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("`openpyxl` is required to read .xlsx files: pip install openpyxl") from None
+    workbook = openpyxl.load_workbook(str(filepath), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets: #NOTE chart sheets are not worksheets
+            #NOTE the dimension recorded in the file may be missing or wrong, rows beyond it would be dropped
+            sheet.reset_dimensions()
+            yield sheet.title, sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _from_excel_serial(serial:float, epoch:datetime.datetime) -> Union[datetime.datetime, datetime.date, datetime.time]:
+    value = epoch + datetime.timedelta(days=serial)
+    if serial < 1:
+        return value.time()
+    if serial.is_integer():
+        return value.date()
+    return value
+
+
+def xlrd_available() -> bool:
+    """whether `xlrd` is installed, checked without importing it"""
+    return importlib.util.find_spec("xlrd") is not None
+
+
+def iter_xls_sheets(filepath:Union[str, Path]) -> Iterator[tuple[str, Iterator[list]]]:
+    """
+    rows of every sheet in a .xls file, by `xlrd`. Sheets are loaded one at a time and unloaded after iterated.
+    A .xls sheet holds at most 65536 rows, so loading a whole sheet is bounded.
+    """
+    try:
+        import xlrd
+    except ImportError:
+        raise ImportError("`xlrd` is required to read .xls files without LibreOffice: pip install xlrd") from None
+    workbook = xlrd.open_workbook(str(filepath), on_demand=True)
+    try:
+        for sheet_index in range(workbook.nsheets):
+            sheet = workbook.sheet_by_index(sheet_index)
+            epoch = datetime.datetime(1904, 1, 1) if workbook.datemode else datetime.datetime(1899, 12, 30)
+            def iter_rows(sheet=sheet):
+                for row_index in range(sheet.nrows):
+                    values = []
+                    for cell in sheet.row(row_index):
+                        if cell.ctype == xlrd.XL_CELL_DATE:
+                            values.append(_from_excel_serial(cell.value, epoch))
+                        else:
+                            values.append(cell.value)
+                    yield values
+            yield sheet.name, iter_rows()
+            workbook.unload_sheet(sheet_index)
+    finally:
+        workbook.release_resources()
+
+
+def iter_sheet_slices(
+    sheet_name:str,
+    rows:Iterable[Iterable[Any]],
+    length_limit:int,
+    header_rows:int=1,
+    limit_unit:LimitUnit="char",
+) -> Iterator[dict]:
+    """
+    group rows of a sheet into slices, with header rows repeated at the beginning of every slice.
+
+    Only the header and the rows of the current slice are kept in memory, so memory stays constant
+    however many rows a sheet has.
+
+    Args:
+        sheet_name (str): set as `chapter` of slices
+        rows (Iterable[Iterable[Any]]): cell values of rows
+        length_limit (int): max length of `content` of a slice, header included. A single row longer than it makes a slice alone
+        header_rows (int): number of leading non-empty rows repeated in every slice
+        limit_unit (LimitUnit): unit of `length_limit`, characters or tokens (line breaks count 1 token each)
+    Yields:
+        dict: slices with `chapter` of sheet name, `article` of the row range like `rows 2-120`, and `content`
+    """
+    length_function = get_length_function(limit_unit)
+    header_lines:list[str] = []
+    header_length = 0
+    lines:list[str] = []
+    length = 0
+    start = end = 0
+    for row_number, values in enumerate(rows, start=1):
+        line = format_row(values)
+        if not line:
+            continue
+        if len(header_lines) < header_rows:
+            header_lines.append(line)
+            header_length += length_function(line) + 1
+            continue
+        line_length = length_function(line)
+        if lines and header_length + length + line_length + 1 > length_limit:
+            yield dict(chapter=sheet_name, article=f"rows {start}-{end}", content="\n".join(header_lines + lines))
+            lines, length = [], 0
+        if not lines:
+            start = row_number
+        lines.append(line)
+        length += line_length + 1
+        end = row_number
+    if lines:
+        yield dict(chapter=sheet_name, article=f"rows {start}-{end}", content="\n".join(header_lines + lines))
+    elif header_lines:
+        #NOTE sheets with header rows only
+        yield dict(chapter=sheet_name, article=None, content="\n".join(header_lines))
+
+
+def get_spreadsheet_slices(
+    filepath:Union[str, Path],
+    length_limit:int,
+    header_rows:int=1,
+    limit_unit:LimitUnit="char",
+) -> list[dict]:
+    """
+    parse a .xlsx or .xls file into slices of row groups, sheet by sheet.
+
+    Args:
+        filepath (str | Path): .xlsx or .xls filepath
+        length_limit (int): max length of `content` of a slice
+        header_rows (int): number of leading non-empty rows of every sheet repeated in every slice
+        limit_unit (LimitUnit): unit of `length_limit`, characters or tokens
+    Returns:
+        list[dict]: slices with `chapter` of sheet name, `article` of row range and `content` of rows in `cell | cell`
+    """
+    filepath = Path(filepath)
+    match filepath.suffix.lower():
+        case ".xlsx":
+            sheets = iter_xlsx_sheets(filepath)
+        case ".xls":
+            sheets = iter_xls_sheets(filepath)
+        case _:
+            raise ValueError(f"Unsupported spreadsheet type: {filepath}")
+    slices = []
+    for sheet_name, rows in sheets:
+        sheet_slices = list(iter_sheet_slices(sheet_name, rows, length_limit, header_rows, limit_unit))
+        logger.info(f"[spreadsheet] sheet {sheet_name}: {len(sheet_slices)} slices")
+        slices.extend(sheet_slices)
+    return slices
@@ -0,0 +1,431 @@
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from typing import *
+from pathlib import Path
+
+from .logg import logger
+from .tools import async_wrapper
+from .config import STORE_PATH, STORE_BATCH_SIZE, STORE_FLUSH_INTERVAL, STORE_MAX_RETRIES
+
+#NOTE keys of slices kept in their own columns, other keys (like `start`, `end`, `pages`) are kept as json in `metadata`.
+# Embeddings are not stored, re-indexing into a new vector store embeds again by its own model
+SLICE_COLUMNS = ("chapter", "article", "content")
+EXCLUDED_KEYS = {"embedding"}
+#NOTE trigram tokens match substrings of Chinese texts, which have no spaces between words.
+# Terms shorter than a trigram are searched by LIKE instead
+MIN_MATCH_CHARS = 3
+#NOTE primary result codes of a database busy or locked by another connection, extended codes keep them in their low byte
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    slice_count INTEGER NOT NULL,
+    parsed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slices (
+    id INTEGER PRIMARY KEY,
+    document INTEGER NOT NULL REFERENCES documents(id),
+    position INTEGER NOT NULL,
+    chapter TEXT NOT NULL,
+    article TEXT NOT NULL,
+    content TEXT NOT NULL,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS slices_document ON slices(document, position);
+CREATE TRIGGER IF NOT EXISTS slices_insert AFTER INSERT ON slices BEGIN
+    INSERT INTO slices_fts(rowid, chapter, article, content) VALUES (new.id, new.chapter, new.article, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS slices_delete AFTER DELETE ON slices BEGIN
+    INSERT INTO slices_fts(slices_fts, rowid, chapter, article, content) VALUES ('delete', old.id, old.chapter, old.article, old.content);
+END;
+"""
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS slices_fts USING fts5("
+    "chapter, article, content, content='slices', content_rowid='id', tokenize='{tokenizer}')"
+)
+
+
+def get_slice_row(document:int, position:int, slice:dict) -> tuple:
+    metadata = {key: value for key, value in slice.items() if key not in SLICE_COLUMNS and key not in EXCLUDED_KEYS}
+    return (
+        document,
+        position,
+        slice["chapter"] or "",
+        slice["article"] or "",
+        slice["content"],
+        json.dumps(metadata, ensure_ascii=False) if metadata else None,
+    )
+
+
+def is_busy_error(error:sqlite3.Error) -> bool:
+    """whether the database is busy or locked by another connection, which is transient"""
+    code = getattr(error, "sqlite_errorcode", None) #NOTE python 3.11+
+    if code is not None:
+        return code & 0xff in (SQLITE_BUSY, SQLITE_LOCKED)
+    return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+
+def escape_like(term:str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class CorpusStore:
+    """
+    sqlite store of parsed documents and their slices, with full-text search over slices (FTS5),
+    so that slices can be exported into a new knowledge base without parsing documents again.
+
+    Documents are written behind requests: `put` buffers them, and buffered documents are written in one transaction
+    once `batch_size` slices are buffered, or every `flush_interval` seconds after `start`. A document put again under the
+    same key replaces its slices. The database is in WAL mode, so exports and searches never block writers,
+    and workers sharing the file wait for each other's transactions. Exports and searches read by read-only connections.
+
+    Args:
+        path (str | Path): sqlite database filepath, created on first use
+        batch_size (int): buffered slices written in one transaction
+        flush_interval (float): seconds between writes of buffered documents, see `start`
+        max_retries (int): consecutive flushes failing on a busy database before buffered documents are dropped
+    """
+    def __init__(
+        self,
+        path:Union[str, Path],
+        batch_size:int=STORE_BATCH_SIZE,
+        flush_interval:float=STORE_FLUSH_INTERVAL,
+        max_retries:int=STORE_MAX_RETRIES,
+    ):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._pending:list[tuple[dict, list[dict]]] = []
+        self._pending_slices = 0
+        self._lock = threading.Lock()
+        #NOTE one writer per process, transactions of other processes are waited for by `busy_timeout`
+        self._write_lock = threading.Lock()
+        self._writer:Optional[sqlite3.Connection] = None
+        self._schema_ready = False
+        self._retries = 0
+        self._flusher:Optional[asyncio.Task] = None
+
+        self.documents_written = 0
+        self.slices_written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.documents_dropped = 0
+
+    def connect(self) -> sqlite3.Connection:
+        """new connection to the database, created with its schema if missing"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE name='slices_fts'").fetchone() is None:
+            try:
+                connection.execute(FTS_SCHEMA.format(tokenizer="trigram"))
+            except sqlite3.OperationalError:
+                #NOTE trigram tokenizer requires sqlite 3.34+, words of Chinese texts are matched by LIKE instead
+                logger.warning(f"[store] trigram tokenizer not supported by sqlite {sqlite3.sqlite_version}, use unicode61")
+                connection.execute(FTS_SCHEMA.format(tokenizer="unicode61"))
+        connection.executescript(SCHEMA)
+        self._schema_ready = True
+        return connection
+
+    def connect_reader(self) -> sqlite3.Connection:
+        """new read-only connection to the database. The schema is created once, by the connection of the writer"""
+        if not self._schema_ready:
+            with self._write_lock:
+                if self._writer is None:
+                    self._writer = self.connect()
+        return sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+
+    def put(self, key:str, filename:str, content_hash:str, slices:list[dict]) -> bool:
+        """
+        buffer a document and its slices to be written.
+
+        Args:
+            key (str): identifier of the document, like `document_id` or content hash. Replaces slices stored under it
+            filename (str): filename of the document
+            content_hash (str): content hash of the document
+            slices (list[dict]): slices of the document
+        Returns:
+            bool: True if `batch_size` slices are buffered, and `flush` should be called
+        """
+        document = dict(key=key, filename=filename, content_hash=content_hash, parsed_at=time.time())
+        with self._lock:
+            self._pending.append((document, slices))
+            self._pending_slices += len(slices)
+            return self._pending_slices >= self.batch_size
+
+    def flush(self) -> int:
+        """
+        write buffered documents in one transaction. Returns the number of documents written.
+
+        Documents failing on a busy or locked database stay buffered for the next flush, and are dropped after `max_retries`
+        consecutive failures. A transaction failing otherwise is written again document by document,
+        so a malformed document is dropped alone.
+        """
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self._pending_slices = 0
+            if not pending:
+                return 0
+            start = time.perf_counter()
+            try:
+                self._write_documents(pending)
+                self._retries = 0
+            except sqlite3.Error as e:
+                self.failures += 1
+                if is_busy_error(e):
+                    self._retry_later(pending, e)
+                    return 0
+                logger.error(f"[store] failed to write {len(pending)} documents, writing them one by one: {e!r}")
+                pending = self._write_one_by_one(pending)
+                if not pending:
+                    return 0
+            slice_count = sum(len(slices) for _, slices in pending)
+            self.documents_written += len(pending)
+            self.slices_written += slice_count
+            self.flushes += 1
+        logger.debug(
+            f"[store] {len(pending)} documents ({slice_count} slices) written in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return len(pending)
+
+    def _write_documents(self, pending:list[tuple[dict, list[dict]]]):
+        if self._writer is None:
+            self._writer = self.connect()
+        with self._writer:
+            for document, slices in pending:
+                self._write_document(self._writer, document, slices)
+
+    def _write_one_by_one(self, pending:list[tuple[dict, list[dict]]]) -> list[tuple[dict, list[dict]]]:
+        #NOTE returns documents written, documents failing alone are dropped
+        written = []
+        for i, item in enumerate(pending):
+            try:
+                self._write_documents([item])
+            except sqlite3.Error as e:
+                self.failures += 1
+                if is_busy_error(e):
+                    self._retry_later(pending[i:], e)
+                    break
+                self._drop([item], e)
+            else:
+                written.append(item)
+        return written
+
+    def _retry_later(self, pending:list[tuple[dict, list[dict]]], error:sqlite3.Error):
+        self._retries += 1
+        if self._retries > self.max_retries:
+            self._retries = 0
+            self._drop(pending, error)
+            return
+        #NOTE buffered again ahead of documents put meanwhile, which may replace them
+        with self._lock:
+            self._pending[:0] = pending
+            self._pending_slices += sum(len(slices) for _, slices in pending)
+        logger.warning(
+            f"[store] database busy, {len(pending)} documents kept for the next flush "
+            f"({self._retries}/{self.max_retries}): {error!r}")
+
+    def _drop(self, pending:list[tuple[dict, list[dict]]], error:sqlite3.Error):
+        self.documents_dropped += len(pending)
+        logger.error(f"[store] dropped {len(pending)} documents ({', '.join(document['key'] for document, _ in pending)}): {error!r}")
+
+    @staticmethod
+    def _write_document(connection:sqlite3.Connection, document:dict, slices:list[dict]):
+        connection.execute(
+            "INSERT INTO documents(key, filename, content_hash, slice_count, parsed_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET filename=excluded.filename, content_hash=excluded.content_hash, "
+            "slice_count=excluded.slice_count, parsed_at=excluded.parsed_at",
+            (document["key"], document["filename"], document["content_hash"], len(slices), document["parsed_at"]))
+        (document_rowid,) = connection.execute("SELECT id FROM documents WHERE key = ?", (document["key"],)).fetchone()
+        connection.execute("DELETE FROM slices WHERE document = ?", (document_rowid,))
+        connection.executemany(
+            "INSERT INTO slices(document, position, chapter, article, content, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+            [get_slice_row(document_rowid, position, slice) for position, slice in enumerate(slices)])
+
+    async def aput(self, key:str, filename:str, content_hash:str, slices:list[dict]):
+        """async `put`, full batches are written in a thread"""
+        if self.put(key, filename, content_hash, slices):
+            await async_wrapper(self.flush)
+
+    async def aflush(self) -> int:
+        if not self._pending:
+            return 0
+        return await async_wrapper(self.flush)
+
+    async def start(self):
+        """write buffered documents every `flush_interval` seconds, until `aclose`"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.aflush()
+
+    def close(self):
+        """write what is buffered, and close the connection of the writer"""
+        self.flush()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    async def aclose(self):
+        """stop writing periodically, and `close`"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await async_wrapper(self.close)
+
+    @staticmethod
+    def _get_filters(
+        document_ids:Optional[List[str]]=None,
+        filename:Optional[str]=None,
+        since:Optional[float]=None,
+        query:Optional[str]=None,
+    ) -> tuple[list[str], list, bool]:
+        #NOTE conditions over `d` (documents) and `s` (slices), and whether the full-text table `f` is joined
+        conditions, params = [], []
+        if document_ids:
+            conditions.append(f"d.key IN ({', '.join('?' * len(document_ids))})")
+            params.extend(document_ids)
+        if filename:
+            conditions.append("d.filename GLOB ?")
+            params.append(filename)
+        if since is not None:
+            conditions.append("d.parsed_at >= ?")
+            params.append(since)
+        terms = query.split() if query else []
+        matched = bool(terms) and all(len(term) >= MIN_MATCH_CHARS for term in terms)
+        if matched:
+            conditions.append("slices_fts MATCH ?")
+            params.append(" ".join('"{}"'.format(term.replace('"', '""')) for term in terms))
+        else:
+            for term in terms:
+                conditions.append("(s.chapter || ' ' || s.article || ' ' || s.content) LIKE ? ESCAPE '\\'")
+                params.append(f"%{escape_like(term)}%")
+        return conditions, params, matched
+
+    def search(
+        self,
+        query:str,
+        limit:int=20,
+        document_ids:Optional[List[str]]=None,
+        filename:Optional[str]=None,
+    ) -> list[dict]:
+        """
+        full-text search over slices, best matches first.
+
+        Args:
+            query (str): terms separated by spaces, all of them must be found in the chapter, article or content of a slice
+            limit (int): max number of slices
+            document_ids (List[str]): search only in these documents
+            filename (str): search only in documents whose filename matches this glob, like `*.pdf`
+        Returns:
+            list[dict]: slices with `document_id`, `filename`, `position` and a `snippet` of their content around the terms
+        """
+        conditions, params, matched = self._get_filters(document_ids, filename, query=query)
+        if matched:
+            sql = (
+                "SELECT d.key, d.filename, s.position, s.chapter, s.article, s.content, s.metadata, "
+                "snippet(slices_fts, 2, '[', ']', '…', 32) "
+                "FROM slices_fts f JOIN slices s ON s.id = f.rowid JOIN documents d ON d.id = s.document "
+                f"WHERE {' AND '.join(conditions)} ORDER BY bm25(slices_fts) LIMIT ?")
+        else:
+            sql = (
+                "SELECT d.key, d.filename, s.position, s.chapter, s.article, s.content, s.metadata, NULL "
+                "FROM slices s JOIN documents d ON d.id = s.document "
+                f"WHERE {' AND '.join(conditions) or '1'} ORDER BY s.id LIMIT ?")
+        connection = self.connect_reader()
+        try:
+            rows = connection.execute(sql, [*params, limit]).fetchall()
+        finally:
+            connection.close()
+        hits = []
+        for key, filename, position, chapter, article, content, metadata, snippet in rows:
+            hit = self._get_slice(key, filename, position, chapter, article, content, metadata)
+            hit["snippet"] = snippet if snippet is not None else content[:128]
+            hits.append(hit)
+        return hits
+
+    async def asearch(self, query:str, limit:int=20, document_ids:Optional[List[str]]=None, filename:Optional[str]=None) -> list[dict]:
+        return await async_wrapper(self.search, query, limit, document_ids, filename)
+
+    @staticmethod
+    def _get_slice(key, filename, position, chapter, article, content, metadata) -> dict:
+        return dict(
+            document_id=key,
+            filename=filename,
+            position=position,
+            chapter=chapter,
+            article=article,
+            content=content,
+            **(json.loads(metadata) if metadata else {}),
+        )
+
+    def iter_export(
+        self,
+        document_ids:Optional[List[str]]=None,
+        filename:Optional[str]=None,
+        since:Optional[float]=None,
+        query:Optional[str]=None,
+        batch_size:int=1000,
+    ) -> Iterator[list[dict]]:
+        """
+        stored slices in document and slice order, in batches of `batch_size`.
+
+        Args:
+            document_ids (List[str]): export only these documents
+            filename (str): export only documents whose filename matches this glob, like `制度/*.docx`
+            since (float): export only documents parsed since this unix timestamp
+            query (str): export only slices matching these terms, see `search`
+            batch_size (int): slices fetched at once
+        Returns:
+            Iterator[list[dict]]: batches of slices with `document_id`, `filename` and `position`
+        """
+        conditions, params, matched = self._get_filters(document_ids, filename, since, query)
+        join = "JOIN slices_fts f ON f.rowid = s.id " if matched else ""
+        sql = (
+            "SELECT d.key, d.filename, s.position, s.chapter, s.article, s.content, s.metadata "
+            f"FROM slices s JOIN documents d ON d.id = s.document {join}"
+            f"WHERE {' AND '.join(conditions) or '1'} ORDER BY s.document, s.position")
+        connection = self.connect_reader()
+        try:
+            cursor = connection.execute(sql, params)
+            while rows := cursor.fetchmany(batch_size):
+                yield [self._get_slice(*row) for row in rows]
+        finally:
+            connection.close()
+
+    async def aiter_ndjson(self, **filters) -> AsyncIterator[bytes]:
+        """`iter_export` as lines of json, batches are fetched in a thread"""
+        batches = self.iter_export(**filters)
+        try:
+            while batch := await async_wrapper(next, batches, None):
+                yield "".join(json.dumps(slice, ensure_ascii=False) + "\n" for slice in batch).encode("utf8")
+        finally:
+            await async_wrapper(batches.close)
+
+    def stats(self) -> dict:
+        return dict(
+            pending=self._pending_slices,
+            documents_written=self.documents_written,
+            slices_written=self.slices_written,
+            flushes=self.flushes,
+            failures=self.failures,
+            documents_dropped=self.documents_dropped,
+        )
+
+
+#NOTE disabled if `STORE_PATH` is not set
+CORPUS_STORE:Optional[CorpusStore] = CorpusStore(STORE_PATH) if STORE_PATH else None
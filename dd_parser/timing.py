@@ -0,0 +1,69 @@
+import time
+from typing import *
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    wall-clock milliseconds of the pipeline stages of a request, like extraction and splitting,
+    reported by the `Server-Timing` header of its response. A stage entered more than once is summed up.
+    """
+    def __init__(self):
+        self.stages:dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def total(self) -> float:
+        """milliseconds since the timer started"""
+        return (time.perf_counter() - self._start) * 1000
+
+    def server_timing(self) -> str:
+        """value of `Server-Timing` header, like `extract;dur=35.2, split;dur=1.3, total;dur=40.8`"""
+        metrics = [f"{name};dur={ms:.1f}" for name, ms in self.stages.items()]
+        return ", ".join(metrics + [f"total;dur={self.total():.1f}"])
+
+    def summary(self) -> str:
+        return ", ".join(f"{name} {ms:.1f}ms" for name, ms in [*self.stages.items(), ("total", self.total())])
+
+
+#NOTE tasks started in a request copy its context, so the coalesced computation of a request times into its timer
+_request_timer:ContextVar[Optional[StageTimer]] = ContextVar("request_timer", default=None)
+
+
+@contextmanager
+def request_timer() -> Iterator[StageTimer]:
+    """start timing stages of the current request, see `stage_timer`"""
+    timer = StageTimer()
+    token = _request_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _request_timer.reset(token)
+
+
+def add_stage_timings(stages:dict[str, float]):
+    """add stages timed elsewhere (like a computation shared by coalesced requests) into the timer of the current request"""
+    timer = _request_timer.get()
+    if timer is None:
+        return
+    for name, ms in stages.items():
+        timer.stages[name] = timer.stages.get(name, 0.0) + ms
+
+
+@contextmanager
+def stage_timer(name:str):
+    """time a stage into the timer of the current request. Nothing is timed outside requests, like in batch workers"""
+    timer = _request_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
@@ -0,0 +1,146 @@
+import threading
+from typing import *
+from collections import OrderedDict
+
+import regex as re
+
+from .logg import logger
+from .config import TOKENIZER_PATH, TOKEN_COUNT_CACHE_SIZE
+
+LimitUnit:TypeAlias = Literal["char", "token"]
+
+#NOTE a CJK character, a latin/digit run, or any other non-space character
+heuristic_token_pattern = re.compile(r"[\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}]|[\p{Latin}\d]+|[^\s\p{Latin}\d]")
+
+
+class HeuristicTokenizer:
+    """
+    approximates token counts without a tokenizer file: a CJK character or a punctuation counts 1 token,
+    and a latin/digit run counts 1 token per 4 characters.
+    """
+    name = "heuristic"
+
+    def count_batch(self, texts:list[str]) -> list[int]:
+        return [
+            sum((len(token) + 3) // 4 for token in heuristic_token_pattern.findall(text))
+            for text in texts]
+
+
+class FileTokenizer:
+    """
+    tokenizer loaded from a local `tokenizer.json` (the format of huggingface `tokenizers`), runs offline.
+
+    Args:
+        path (str): path of `tokenizer.json`, like the one shipped with the embedding model
+    """
+    def __init__(self, path:str):
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ImportError("`tokenizers` is required to count tokens by TOKENIZER_PATH: pip install tokenizers") from None
+        self.name = path
+        self.tokenizer = Tokenizer.from_file(path)
+        #NOTE `encode_batch_fast` (tokenizers>=0.20) skips computing offsets, which are not needed to count
+        self._encode_batch = getattr(self.tokenizer, "encode_batch_fast", self.tokenizer.encode_batch)
+
+    def count_batch(self, texts:list[str]) -> list[int]:
+        #NOTE special tokens are added once per input by the embedding model, not once per line
+        return [len(encoding.ids) for encoding in self._encode_batch(texts, add_special_tokens=False)]
+
+
+class TokenCounter:
+    """
+    counts tokens of texts line by line, with token counts of lines cached.
+
+    Chunks repeat the same lines (filename, chapter headings) and re-uploaded documents repeat most of their lines,
+    so only lines never seen are encoded, in one batch per call.
+
+    Args:
+        tokenizer (HeuristicTokenizer | FileTokenizer): tokenizer with `count_batch(texts) -> counts`
+        cache_size (int): max lines whose token counts are cached
+    """
+    def __init__(self, tokenizer:Union[HeuristicTokenizer, FileTokenizer], cache_size:int):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache:OrderedDict[str, int] = OrderedDict()
+        #NOTE counted in worker threads, encoding runs outside of the lock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count_lines(self, lines:list[str]) -> list[int]:
+        counts = {}
+        missing = []
+        with self._lock:
+            for line in lines:
+                if line in counts:
+                    continue
+                count = self._cache.get(line)
+                if count is None:
+                    counts[line] = None
+                    missing.append(line)
+                else:
+                    counts[line] = count
+                    self._cache.move_to_end(line)
+            self.misses += len(missing)
+            self.hits += len(lines) - len(missing)
+        if missing:
+            missing_counts = self.tokenizer.count_batch(missing)
+            with self._lock:
+                for line, count in zip(missing, missing_counts):
+                    counts[line] = count
+                    self._cache[line] = count
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [counts[line] for line in lines]
+
+    def count_texts(self, texts:list[str]) -> list[int]:
+        """token counts of texts, line breaks counted as 1 token each. All lines are encoded in one batch"""
+        texts_lines = [text.split("\n") for text in texts]
+        line_counts = iter(self.count_lines([line for lines in texts_lines for line in lines]))
+        return [sum(next(line_counts) for _ in lines) + len(lines) - 1 for lines in texts_lines]
+
+    def count(self, text:str) -> int:
+        return self.count_texts([text])[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return dict(
+            tokenizer=self.tokenizer.name,
+            size=len(self._cache),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / total if total else 0.0,
+        )
+
+
+_token_counter:Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    """token counter of `TOKENIZER_PATH`, created on first use. Falls back to `HeuristicTokenizer` if it is not set"""
+    global _token_counter
+    if _token_counter is None:
+        if TOKENIZER_PATH:
+            tokenizer = FileTokenizer(TOKENIZER_PATH)
+        else:
+            logger.warning("[tokenizer] TOKENIZER_PATH is not set, token counts are approximated")
+            tokenizer = HeuristicTokenizer()
+        _token_counter = TokenCounter(tokenizer, TOKEN_COUNT_CACHE_SIZE)
+    return _token_counter
+
+
+def get_token_count_stats() -> Optional[dict]:
+    """stats of the token counter, None if no token has been counted yet"""
+    return _token_counter.stats() if _token_counter is not None else None
+
+
+def count_lengths(texts:list[str], limit_unit:LimitUnit="char") -> list[int]:
+    """lengths of texts in characters or tokens"""
+    if limit_unit == "token":
+        return get_token_counter().count_texts(texts)
+    return [len(text) for text in texts]
+
+
+def get_length_function(limit_unit:LimitUnit="char") -> Callable[[str], int]:
+    return get_token_counter().count if limit_unit == "token" else len
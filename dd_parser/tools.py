@@ -1,17 +1,31 @@
 import os
+import time
+import signal
+import tempfile
 import asyncio
-import aiohttp
+import threading
 import subprocess
 import asyncio.subprocess as asubprocess
 from typing import *
 from pathlib import Path
-
-import fitz  # PyMuPDF
-from docx import Document
-from docx.oxml.ns import qn
+from contextlib import suppress, contextmanager
 
 from .logg import logger
-from .config import MINERU_URL, HTTP_CLIENT
+from .ocr import get_pdf_text_with_ocr
+from .decoding import decode_stream
+from .numbering import NumberingCounter, get_numbering_table
+from .sandbox import ExtractionError
+from .config import (
+    MINERU_URL,
+    MINERU_RETRIES,
+    MINERU_BACKOFF_BASE,
+    MINERU_BACKOFF_MAX,
+    get_temp_dir,
+    get_libreoffice_check_cache,
+    LIBREOFFICE_CHECK_TTL,
+    LIBREOFFICE_TIMEOUT,
+)
+from .client import HTTP_CLIENT, MINERU_BREAKER
 
 T = TypeVar("T")
 
@@ -31,36 +45,134 @@ def check_libreoffice():
     else:
         if process.returncode!=0:
             raise OSError("LibreOffice is not installed or unavailable. Please install LibreOffice and ensure it is in the system PATH.")
-        logger.info(f"[detect libreoffice] {process.stdout.decode("utf8")}")
+        logger.info(f"[detect libreoffice] {process.stdout.decode('utf8')}")
 
 
-async def acheck_libreoffice():
+def _read_libreoffice_check_cache() -> Optional[str]:
+    """returns cached `soffice --version` output, or None if cache is missing or expired"""
+    check_cache = get_libreoffice_check_cache()
     try:
-        #NOTE `asubprocess.create_subprocess_exec` on Windows pops up a terminal to output the result. I don't want it.
-        # process = await asubprocess.create_subprocess_exec(
-            # *["soffice", "--version"],stdout=asubprocess.PIPE, stderr=asubprocess.PIPE)
-        process = await asubprocess.create_subprocess_shell(
-            "soffice --version", stdout=asubprocess.PIPE, stderr=asubprocess.PIPE,)
-        stdout, stderr = await process.communicate()
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        raise OSError("LibreOffice is not installed or unavailable. Please install LibreOffice and ensure it is in the system PATH.")
-    else:
-        if process.returncode!=0:
+        stat = check_cache.stat()
+    except FileNotFoundError:
+        return None
+    if time.time() - stat.st_mtime > LIBREOFFICE_CHECK_TTL:
+        return None
+    return check_cache.read_text(encoding="utf8")
+
+
+def _write_libreoffice_check_cache(version:str):
+    #NOTE write into a temp file and rename it, so other workers never read a half-written cache
+    check_cache = get_libreoffice_check_cache()
+    temp_cache = check_cache.with_name(f"{check_cache.name}.{os.getpid()}")
+    temp_cache.write_text(version, encoding="utf8")
+    os.replace(temp_cache, check_cache)
+
+
+async def acheck_libreoffice(use_cache:bool=True):
+    """
+    check whether LibreOffice is available.
+
+    The successful result is cached in `get_libreoffice_check_cache()` for `LIBREOFFICE_CHECK_TTL` seconds,
+    so that workers started together only probe LibreOffice once.
+    Args:
+        use_cache (bool): given False to always probe LibreOffice
+    Raises:
+        OSError: If LibreOffice is not installed or unavailable
+    """
+    check_cache = get_libreoffice_check_cache()
+    lock_file = check_cache.with_name(check_cache.name + ".lock")
+    lock_fd = None
+    if use_cache:
+        cached_version = await async_wrapper(_read_libreoffice_check_cache)
+        if cached_version is None:
+            #NOTE only the worker holding the lock probes, others wait for its cache
+            try:
+                lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                with suppress(FileNotFoundError):
+                    if time.time() - os.path.getmtime(lock_file) > 60:
+                        logger.warning(f"[detect libreoffice] remove stale lock: {lock_file}")
+                        os.remove(lock_file)
+                for _ in range(100):
+                    await asyncio.sleep(0.2)
+                    cached_version = await async_wrapper(_read_libreoffice_check_cache)
+                    if cached_version is not None:
+                        break
+        if cached_version is not None:
+            logger.info(f"[detect libreoffice] (cached) {cached_version}")
+            return
+
+    try:
+        try:
+            #NOTE `asubprocess.create_subprocess_exec` on Windows pops up a terminal to output the result. I don't want it.
+            # process = await asubprocess.create_subprocess_exec(
+                # *["soffice", "--version"],stdout=asubprocess.PIPE, stderr=asubprocess.PIPE)
+            process = await asubprocess.create_subprocess_shell(
+                "soffice --version", stdout=asubprocess.PIPE, stderr=asubprocess.PIPE,)
+            stdout, stderr = await process.communicate()
+        except (FileNotFoundError, subprocess.CalledProcessError):
             raise OSError("LibreOffice is not installed or unavailable. Please install LibreOffice and ensure it is in the system PATH.")
-        logger.info(f"[detect libreoffice] {stdout.decode("utf8")}")
+        else:
+            if process.returncode!=0:
+                raise OSError("LibreOffice is not installed or unavailable. Please install LibreOffice and ensure it is in the system PATH.")
+            version = stdout.decode("utf8")
+            logger.info(f"[detect libreoffice] {version}")
+            if use_cache:
+                await async_wrapper(_write_libreoffice_check_cache, version)
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+            with suppress(FileNotFoundError):
+                os.remove(lock_file)
+
+
+def kill_process_tree(pid:int):
+    """kill a process started with `start_new_session=True` and all processes of its session (its process group)"""
+    with suppress(ProcessLookupError):
+        if os.name == "nt":
+            os.kill(pid, signal.SIGTERM)
+        else:
+            os.killpg(pid, signal.SIGKILL)
+
+
+_libreoffice_profiles_in_use:set[int] = set()
+_libreoffice_profiles_lock = threading.Lock()
+
+
+@contextmanager
+def libreoffice_profile() -> Iterator[str]:
+    """
+    `-env:UserInstallation` option of a LibreOffice user profile no other conversion of this process is using.
+
+    LibreOffice locks its user profile, so a conversion started while another one holds the default profile
+    exits early or hangs. Profiles live in the temp dir of this process and are reused by later conversions,
+    so there are at most as many of them as concurrent conversions.
+    """
+    with _libreoffice_profiles_lock:
+        slot = 0
+        while slot in _libreoffice_profiles_in_use:
+            slot += 1
+        _libreoffice_profiles_in_use.add(slot)
+    try:
+        yield f"-env:UserInstallation={(get_temp_dir() / f'lo_profile_{slot}').as_uri()}"
+    finally:
+        with _libreoffice_profiles_lock:
+            _libreoffice_profiles_in_use.discard(slot)
 
 
 def convert_docs_to_docxs(
-    input_directory_or_file:Union[str, Path], output_directory:Union[str,Path]=None) -> list[Path]:
+    input_directory_or_file:Union[str, Path], output_directory:Union[str,Path]=None, convert_to:str="docx") -> list[Path]:
     """
     single convert or batch convert all .doc files in the input_directory_or_file (including subdirectories) to .docx format
     using LibreOffice's command line interface.
     Args:
         input_directory_or_file (str | Path): input directory containing .doc files or filepath to a single .doc file
         output_directory (str | Path): output directory path where converted .docx files will be saved
+        convert_to (str): target format, like `docx` for .doc files or `xlsx` for .xls files
     Raises:
         ValueError: If the input directory does not exist or is not a directory
         OSError: If LibreOffice is not installed or unavailable
+        ExtractionError: If the conversion takes more than `LIBREOFFICE_TIMEOUT` seconds
     Returns:
         out(list[Path]): list of converted file paths
     """
@@ -79,12 +191,23 @@ def convert_docs_to_docxs(
     elif input_path.is_dir():
         file_option = str(f'{str(input_path)}/**/*.doc')
 
-    command = f'soffice --headless --convert-to docx --outdir "{str(output_dir)}" "{file_option}"'
     try:
-        logger.info("output_dir is ", str(output_dir))
+        logger.info(f"output_dir is {output_dir}")
         logger.info("start converting by LibreOffice...")
-        result=subprocess.run(command, shell=True, check=True,stderr=subprocess.PIPE, text=True, stdout=subprocess.PIPE)
-        logger.info("LibreOffice output:", result.stdout or result.stderr)
+        with libreoffice_profile() as profile_option:
+            command = f'soffice "{profile_option}" --headless --convert-to {convert_to} --outdir "{str(output_dir)}" "{file_option}"'
+            with subprocess.Popen(
+                command, shell=True, stderr=subprocess.PIPE, text=True, stdout=subprocess.PIPE, start_new_session=os.name != "nt") as process:
+                try:
+                    stdout, stderr = process.communicate(timeout=LIBREOFFICE_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    kill_process_tree(process.pid)
+                    process.communicate()
+                    raise ExtractionError("libreoffice", "timeout", f"conversion of {input_path.name} killed after {LIBREOFFICE_TIMEOUT}s")
+        result = subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+        logger.info(f"LibreOffice output: {result.stdout or result.stderr}")
         if result.returncode == 0:
             logger.info("Conversion successful")
         else:
@@ -92,12 +215,12 @@ def convert_docs_to_docxs(
     except subprocess.CalledProcessError as e:
         raise OSError(f"Error occurred during conversion: {e.stderr.strip()}") from e
     else:
-        docx_filepaths = list(output_dir.glob("*.docx"))
+        docx_filepaths = list(output_dir.glob(f"*.{convert_to}"))
     return docx_filepaths
 
 
 async def aconvert_docs_to_docxs(
-    input_directory_or_file:Union[str, Path], output_directory:Union[str,Path]=None) -> list[Path]:
+    input_directory_or_file:Union[str, Path], output_directory:Union[str,Path]=None, convert_to:str="docx") -> list[Path]:
     """
     **async version**
 
@@ -106,9 +229,11 @@ async def aconvert_docs_to_docxs(
     Args:
         input_directory_or_file (str | Path): input directory containing .doc files or filepath to a single .doc file
         output_directory (str | Path): output directory path where converted .docx files will be saved
+        convert_to (str): target format, like `docx` for .doc files or `xlsx` for .xls files
     Raises:
         ValueError: If the input directory does not exist or is not a directory
         OSError: If LibreOffice is not installed or unavailable
+        ExtractionError: If the conversion takes more than `LIBREOFFICE_TIMEOUT` seconds
     """
     input_path = Path(input_directory_or_file) if not isinstance(input_directory_or_file,Path) else input_directory_or_file
     output_dir = Path(output_directory) if not isinstance(output_directory, Path) else output_directory
@@ -123,16 +248,24 @@ async def aconvert_docs_to_docxs(
     elif input_path.is_dir():
         file_option = str(f'{str(input_path)}/**/*.doc')
 
-    command = [
-        'soffice','--headless','--convert-to docx','--outdir',output_dir, file_option ]
     try:
-        logger.info("output_dir is ", str(output_dir))
+        logger.info(f"output_dir is {output_dir}")
         logger.info("start converting by LibreOffice...")
-        process = await asubprocess.create_subprocess_exec(*command, stdout=asubprocess.PIPE, stderr=asubprocess.PIPE)
-        stdout, stderr = await process.communicate()
+        with libreoffice_profile() as profile_option:
+            command = [
+                'soffice',profile_option,'--headless','--convert-to',convert_to,'--outdir',output_dir, file_option ]
+            #NOTE a new session on POSIX, so that a hung conversion is killed with the processes soffice spawned
+            process = await asubprocess.create_subprocess_exec(
+                *command, stdout=asubprocess.PIPE, stderr=asubprocess.PIPE, start_new_session=os.name != "nt")
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), LIBREOFFICE_TIMEOUT)
+            except asyncio.TimeoutError:
+                kill_process_tree(process.pid)
+                await process.wait()
+                raise ExtractionError("libreoffice", "timeout", f"conversion of {input_path.name} killed after {LIBREOFFICE_TIMEOUT}s")
         stdout = stdout.decode("utf8")
         stderr = stderr.decode("utf8")
-        logger.info("LibreOffice output:", stdout or stderr)
+        logger.info(f"LibreOffice output: {stdout or stderr}")
         if process.returncode == 0:
             logger.info("Conversion successful")
         else:
@@ -140,7 +273,7 @@ async def aconvert_docs_to_docxs(
     except subprocess.CalledProcessError as e:
         raise OSError(f"Error occurred during conversion: {stderr}") from e
     else:
-        docx_filepaths = list(output_dir.glob("*.docx"))
+        docx_filepaths = list(output_dir.glob(f"*.{convert_to}"))
     return docx_filepaths
 
 def get_pure_pdf_text(
@@ -164,6 +297,7 @@ def get_pure_pdf_text(
     Returns:
         out(list[str]): list of pure texts extracted from all pdf pages.
     """
+    import fitz  # PyMuPDF. Imported on first use like other backends, so the CLI and api start fast
     full_texts=[]
     if isinstance(file, (str, Path,)):
         pdf_doc = fitz.open(str(file))
@@ -179,107 +313,106 @@ def get_pure_pdf_text(
             footer_area = fitz.Rect(rect.x0, rect.y1 - exclude_pixels, rect.x1, rect.y1)  # usually bottom 60pt, footer
 
         # extract main text（exclude header/footer）
-        page_text=[]
-        words = page.get_text("words")  # (x0, y0, x1, y1, word, block_no, line_no, word_no)
+        page_lines={} # key: (block_no, line_no), value: words of the line
+        words = page.get_text("words", sort=True)  # (x0, y0, x1, y1, word, block_no, line_no, word_no)
         for w in words:
-            if header_area and not header_area.intersects(fitz.Rect(w[:4])):
-                page_text.append(w[4])
-
-            if footer_area and not footer_area.intersects(fitz.Rect(w[:4])):
-                page_text.append(w[4])
-        # main_text = "\n".join(
-        #     w[4] for w in words if not header_area.intersects(fitz.Rect(w[:4]))
-        #                         and not footer_area.intersects(fitz.Rect(w[:4]))
-        # )
+            word_rect = fitz.Rect(w[:4])
+            if header_area and header_area.intersects(word_rect):
+                continue
+            if footer_area and footer_area.intersects(word_rect):
+                continue
+            page_lines.setdefault((w[5], w[6]), []).append(w[4])
+        #NOTE keep line structure, words in the same line are joined by a space
+        page_text=[" ".join(line_words) for line_words in page_lines.values()]
         page_text="\n".join(page_text)
         full_texts.append(page_text.strip())
 
     return full_texts
 
 
-digit_to_chn_digit={
-    1:"一",2:"二",3:"三",4:"四",5:"五",6:"六",7:"七",8:"八",9:"九",10:"十",0:"零"
-}
-
-def get_pure_docx_text(filepath: Union[str, Path]) -> str:
+def get_docx_paragraphs(filepath: Union[str, Path]) -> list[str]:
     """
-    extract pure text from a given .docx file, including **auto numbered list items**,
+    extract text of every paragraph of a given .docx file, including **auto numbered list items**,
     which cannot be extracted by simply reading the paragraph text.
+    Numbering of list items is compiled once per template, see `get_numbering_table`.
 
     Args:
         file_path (str): .docx filepath
     Returns:
-        str: pure text extracted, with line breaks between paragraphs 
+        list[str]: text of every paragraph, in the order of `Document.paragraphs`, so an index is a paragraph index
     Raises:
         ValueError: If the file path is not a valid .docx file
     """
+    from docx import Document
 
     doc = Document(filepath)
 
     try:
         #NOTE address auto numbered list items
-        numbering_part = doc.part.numbering_part._element
+        ###NOTE You may get raw numbering_part by converting docx to zip and `word/numbering.xml` is the file you want.
+        ####NOTE see https://learn.microsoft.com/zh-cn/previous-versions/office/ee922775%28v=office.14%29#%E6%A6%82%E8%BF%B0
+        ####NOTE see also https://blog.51cto.com/u_11866025/11202906
+        numbering_part = doc.part.numbering_part
     except BaseException as e:
-        print(f"[Warning] Failed to access numbering part in {filepath}, extracting plain text only.")
-        return '\n'.join([para.text for para in doc.paragraphs if para.text])
-
-    ##NOTE get numId to abstractNumId mapping, abstractNumId is the key to auto numbering format
-    numId2abstractId = {
-        num.numId: num.abstractNumId.val
-        for num in numbering_part.num_lst
-    }
-    ##NOTE get abstractNumId and ilvl to style mapping.
-    ###NOTE You may get raw numbering_part by converting docx to zip and `word/numbering.xml` is the file you want.
-    ####NOTE see https://learn.microsoft.com/zh-cn/previous-versions/office/ee922775%28v=office.14%29#%E6%A6%82%E8%BF%B0
-    ####NOTE see also https://blog.51cto.com/u_11866025/11202906
-    abstractNumId2style = {}
-    for abstractNumIdTag in numbering_part.findall(qn("w:abstractNum")):
-        abstractNumId = abstractNumIdTag.get(qn("w:abstractNumId"))
-        for lvlTag in abstractNumIdTag.findall(qn("w:lvl")):
-            ilvl = lvlTag.get(qn("w:ilvl"))
-            style = {tag.tag[tag.tag.rfind("}") + 1:]: tag.get(qn("w:val"))
-                    for tag in lvlTag.xpath("./*[@w:val]", namespaces=numbering_part.nsmap)}
-            abstractNumId2style[(int(abstractNumId), int(ilvl))] = style
-    
+        logger.warning(f"Failed to access numbering part in {filepath}, extracting plain text only.")
+        #NOTE empty paragraphs are kept as empty lines, they count in paragraph indices
+        return [para.text for para in doc.paragraphs]
+
+    numbering = NumberingCounter(get_numbering_table(filepath, numbering_part))
+
     #NOTE extract text, including auto numbered list items
-    abstract_count=dict()  # key: (numId, ilvl), value: count
     full_text=[]
     for paragraph in doc.paragraphs:
         prefix_text=""
-        numpr = paragraph._element.pPr.numPr
-        if numpr is not None and numpr.numId.val != 0:
-            numId = numpr.numId.val
-            ilvl = numpr.ilvl.val
-            abstractId = numId2abstractId[numId]
-            style = abstractNumId2style[(abstractId, ilvl)]
-            start_index = int(style.get("start", "1"))
-            abstract_count[(numId, ilvl)] = abstract_count.get((numId, ilvl), start_index)
-            chn_digit = digit_to_chn_digit[abstract_count[(numId, ilvl)]]
-            prefix_text=style.get("lvlText", "").replace("%1", chn_digit)
-
-            abstract_count[(numId, ilvl)] += 1 #NOTE increase index for next item
+        pPr = paragraph._element.pPr
+        numpr = pPr.numPr if pPr is not None else None
+        if numpr is not None and numpr.numId is not None and numpr.numId.val != 0:
+            ilvl = numpr.ilvl.val if numpr.ilvl is not None else 0
+            prefix_text = numbering.next_prefix(numpr.numId.val, ilvl)
 
         if paragraph.text!=None:
             text = prefix_text + " " + paragraph.text.strip()
             full_text.append(text)
 
-    return '\n'.join(full_text)
+    return full_text
+
+
+def get_pure_docx_text(filepath: Union[str, Path]) -> str:
+    """
+    extract pure text from a given .docx file, see `get_docx_paragraphs`.
+
+    Args:
+        file_path (str): .docx filepath
+    Returns:
+        str: pure text extracted, with line breaks between paragraphs 
+    """
+    return '\n'.join(get_docx_paragraphs(filepath))
 
 
-def get_pure_text(filepath: str) -> str:
+def get_pure_text(filepath: Union[str, Path]) -> str:
     """
-    extract pure text from a given .docx or .pdf file.
+    extract pure text from a given .docx, .doc, .pdf, .md or .txt file.
+    .doc files are converted to .docx by LibreOffice in a temporary directory first.
+    Pages of .pdf files without text layer are recognized by local OCR in this process.
 
     Args:
-        file_path (str): .docx or .pdf filepath
+        file_path (str | Path): filepath
     Returns:
         str: pure text extracted, with line breaks between paragraphs
     """
-    match filepath.lower().rsplit(".", 1)[-1]:
-        case "docx":
+    filepath = Path(filepath)
+    match filepath.suffix.lower():
+        case ".docx":
             return get_pure_docx_text(filepath)
-        case "pdf":
-            return get_pure_pdf_text(filepath)
+        case ".doc":
+            with tempfile.TemporaryDirectory(prefix="convert_docx_") as temp_dir:
+                convert_docs_to_docxs(filepath, output_directory=temp_dir)
+                return get_pure_docx_text(Path(temp_dir) / f"{filepath.stem}.docx")
+        case ".pdf":
+            return "\n".join(get_pdf_text_with_ocr(filepath))
+        case ".md" | ".txt":
+            with open(filepath, "rb") as f:
+                return decode_stream(f)[0]
         case _:
             raise ValueError(f"Unsupported file type: {filepath}")
 
@@ -290,14 +423,35 @@ async def request_mineru(
     file_stream:bytes,
     filename:str,
 ):
-    formdata = aiohttp.FormData()
-    formdata.add_field("file",file_stream,filename=filename,)
-    formdata.add_field("request_id",request_id)
-    formdata.add_field("output_format", output_format)
-    async with HTTP_CLIENT.post(MINERU_URL, data=formdata) as aresp:
-        aresp.raise_for_status()
-        data= await aresp.json()
-        return data
+    """
+    request MinerU service to parse the file.
+
+    Failed requests are retried with exponential backoff, and fail fast once the circuit of MinerU is open.
+    Raises:
+        ValueError: If `MINERU_URL` is not set
+        CircuitOpenError: If MinerU keeps failing and its circuit is open
+    """
+    if not MINERU_URL:
+        raise ValueError("`MINERU_URL` is not set, cannot parse the file by MinerU")
+
+    import aiohttp
+
+    def build_formdata():
+        formdata = aiohttp.FormData()
+        formdata.add_field("file",file_stream,filename=filename,)
+        formdata.add_field("request_id",request_id)
+        formdata.add_field("output_format", output_format)
+        return formdata
+
+    data = await HTTP_CLIENT.request_json(
+        "POST", MINERU_URL,
+        data_factory=build_formdata,
+        retries=MINERU_RETRIES,
+        backoff_base=MINERU_BACKOFF_BASE,
+        backoff_max=MINERU_BACKOFF_MAX,
+        breaker=MINERU_BREAKER,
+    )
+    return data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import *
+from pathlib import Path
+from contextlib import contextmanager, suppress
+
+import regex as re
+
+from .logg import logger
+from .tools import async_wrapper
+from .config import VERSION_STORE_DIR
+
+#NOTE numbering label at the beginning of a heading line, like `第十二条`, `（三）`, `一、`, `A.1.2`, `## 1.2`.
+# Slice ids are derived from labels instead of whole heading lines,
+# so that revising the text on the heading line keeps the id of the slice
+heading_label_pattern = re.compile(
+    r"^\s*(?:"
+    r"第[\d一二三四五六七八九十百千零〇两]+\s*[编章节条款项]"
+    r"|[（(][\d一二三四五六七八九十百千零〇两]+[）)]"
+    r"|#{1,6}\s*[\w.]+"
+    r"|(?:[A-Za-z]\.)?\d+(?:\.\d+)+"
+    r"|[\d一二三四五六七八九十百千零〇两]+\s*[、.．]"
+    r")"
+)
+
+
+def get_heading_label(heading:Optional[str]) -> str:
+    if not heading:
+        return ""
+    matched = heading_label_pattern.match(heading)
+    label = matched.group(0) if matched else heading
+    return re.sub(r"\s+", "", label)
+
+
+def get_slice_ids(slices:list[dict]) -> list[str]:
+    """
+    stable slice ids derived from the chapter/article path of slices.
+
+    Slices sharing the same path (like the content before the first chapter and the chapter itself)
+    are told apart by their occurrence order.
+    """
+    ids = []
+    occurrences:dict[str, int] = {}
+    for slice in slices:
+        path = "/".join([get_heading_label(slice["chapter"]), get_heading_label(slice["article"])])
+        occurrence = occurrences.get(path, 0)
+        occurrences[path] = occurrence + 1
+        ids.append(hashlib.sha1(f"{path}#{occurrence}".encode("utf8")).hexdigest()[:16])
+    return ids
+
+
+def get_content_hash(slice:dict) -> str:
+    return hashlib.sha1(
+        "\0".join([slice["chapter"] or "", slice["article"] or "", slice["content"]]).encode("utf8")
+    ).hexdigest()
+
+
+class VersionConflictError(Exception):
+    """
+    raised when another request saved a version of the document after this one made its diff.
+    Should be returned as 409, parsing the document again diffs it against the version saved.
+    """
+    def __init__(self, document_id:str, expected:int, found:int):
+        super().__init__(
+            f"[version] {document_id} was saved as v{found} by another request while this one was based on v{expected}, "
+            "please parse it again")
+        self.document_id = document_id
+        self.status_code = 409
+
+
+@contextmanager
+def file_lock(lock_file:Path, timeout:float=30.0, stale:float=10.0):
+    """
+    hold a lock file, shared by all processes using the same directory.
+    A lock file older than `stale` seconds is left behind by a killed process and removed.
+    Raises:
+        TimeoutError: If the lock is not acquired in `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            with suppress(FileNotFoundError):
+                if time.time() - os.path.getmtime(lock_file) > stale:
+                    logger.warning(f"[version] remove stale lock: {lock_file}")
+                    os.remove(lock_file)
+                    continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"[version] lock {lock_file} not acquired in {timeout}s")
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(lock_fd)
+        with suppress(FileNotFoundError):
+            os.remove(lock_file)
+
+
+class VersionStore:
+    """
+    stores the slice list of the last version of every document, to diff re-parsed documents against.
+
+    A new version is made by `adiff` and saved by `acommit` once the stages after the diff (like embedding) succeeded,
+    so a failed request leaves the last version as it was and its retry gets the same diff.
+    Every document is saved in its own json file, replaced atomically under a lock file, so workers sharing
+    the directory never read a half-written version nor save two versions on the same one.
+
+    Args:
+        store_dir (str | Path): directory to save versions into
+    """
+    def __init__(self, store_dir:Union[str, Path]):
+        self.store_dir = Path(store_dir)
+
+    def _get_filepath(self, document_id:str) -> Path:
+        return self.store_dir / f"{hashlib.sha1(document_id.encode('utf8')).hexdigest()}.json"
+
+    def load(self, document_id:str) -> Optional[dict]:
+        filepath = self._get_filepath(document_id)
+        if not filepath.exists():
+            return None
+        with open(filepath, "r", encoding="utf8") as f:
+            return json.load(f)
+
+    def save(self, document_id:str, version:dict):
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        filepath = self._get_filepath(document_id)
+        temp_filepath = filepath.with_name(f"{filepath.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(temp_filepath, "w", encoding="utf8") as f:
+            json.dump(version, f, ensure_ascii=False)
+        os.replace(temp_filepath, filepath)
+
+    def diff(self, document_id:str, slices:list[dict]) -> tuple[dict, dict]:
+        """
+        diff slices against the last version of the document. Nothing is saved, see `commit`.
+
+        Args:
+            document_id (str): identifier of the document, stays the same across revisions
+            slices (list[dict]): slices of the new version
+        Returns:
+            dict: `added` and `changed` slices (with key `id`), `removed` slices (id, chapter and article only),
+            count of `unchanged` slices, and the new `version` number
+            dict: the new version, to save by `commit`
+        """
+        previous = self.load(document_id)
+        previous_slices = {s["id"]: s for s in previous["slices"]} if previous else {}
+        previous_version = previous["version"] if previous else 0
+
+        added, changed, version_slices = [], [], []
+        unchanged = 0
+        for slice_id, slice in zip(get_slice_ids(slices), slices):
+            content_hash = get_content_hash(slice)
+            version_slices.append(dict(
+                id=slice_id, hash=content_hash, chapter=slice["chapter"], article=slice["article"]))
+            previous_slice = previous_slices.pop(slice_id, None)
+            if previous_slice is None:
+                added.append(dict(id=slice_id, **slice))
+            elif previous_slice["hash"] != content_hash:
+                changed.append(dict(id=slice_id, **slice))
+            else:
+                unchanged += 1
+        removed = [dict(id=s["id"], chapter=s["chapter"], article=s["article"]) for s in previous_slices.values()]
+
+        version = previous_version + 1
+        logger.info(
+            f"[version] {document_id} v{previous_version} -> v{version}: "
+            f"{len(added)} added, {len(changed)} changed, {len(removed)} removed, {unchanged} unchanged")
+        diff = dict(
+            document_id=document_id,
+            version=version,
+            previous_version=previous_version,
+            added=added,
+            changed=changed,
+            removed=removed,
+            unchanged=unchanged,
+        )
+        return diff, dict(document_id=document_id, version=version, slices=version_slices)
+
+    def commit(self, version:dict):
+        """
+        save a new version made by `diff`.
+        Raises:
+            VersionConflictError: If another version of the document was saved since the diff
+        """
+        document_id = version["document_id"]
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = self._get_filepath(document_id).with_suffix(".lock")
+        with file_lock(lock_file):
+            current = self.load(document_id)
+            current_version = current["version"] if current else 0
+            if current_version != version["version"] - 1:
+                raise VersionConflictError(document_id, version["version"] - 1, current_version)
+            self.save(document_id, version)
+        logger.info(f"[version] {document_id} v{version['version']} saved")
+
+    async def adiff(self, document_id:str, slices:list[dict]) -> tuple[dict, dict]:
+        """**async version** of `diff`"""
+        return await async_wrapper(self.diff, document_id, slices)
+
+    async def acommit(self, version:dict):
+        """**async version** of `commit`"""
+        await async_wrapper(self.commit, version)
+
+
+VERSION_STORE = VersionStore(VERSION_STORE_DIR)
@@ -0,0 +1,115 @@
+from typing import *
+
+from .tokenizer import LimitUnit, count_lengths
+from .versioning import get_heading_label
+
+#NOTE separates filename, chapter and article in context headers, like `制度.docx > 第一章 总则 > 第三条`
+PATH_SEPARATOR = " > "
+
+
+class Window(TypedDict):
+    context: str # context header, the chapter/article path of the first slice
+    start: int # index of the first slice
+    end: int # index after the last slice
+
+
+def get_context_header(slice:dict, filename:str="") -> str:
+    """chapter/article path of a slice. Articles are shortened to their numbering labels, like `第三条`"""
+    path = [filename, slice["chapter"] or "", get_heading_label(slice["article"])]
+    return PATH_SEPARATOR.join(part for part in path if part)
+
+
+def iter_windows(
+    lengths:list[int],
+    header_lengths:list[int],
+    length_limit:int,
+    overlap:int,
+) -> Iterator[tuple[int, int]]:
+    """
+    two-pointer sliding windows over consecutive slices, in O(n).
+
+    A window takes slices as long as its header and slices fit in `length_limit` (at least one slice).
+    The next window starts from the trailing slices of the previous window whose total length is at most `overlap`,
+    dropping more of them if the next new slice would not fit otherwise. Both pointers only move forward.
+
+    Args:
+        lengths (list[int]): length of every slice in a window
+        header_lengths (list[int]): length of the context header of a window starting at every slice
+        length_limit (int): max length of a window, header included
+        overlap (int): max length of slices repeated from the previous window
+    Yields:
+        tuple[int, int]: start and end (exclusive) indexes of slices of windows
+    """
+    start = end = 0
+    total = 0
+    while start < len(lengths):
+        while end < len(lengths) and (end == start or header_lengths[start] + total + lengths[end] <= length_limit):
+            total += lengths[end]
+            end += 1
+        yield start, end
+        if end == len(lengths):
+            return
+        total -= lengths[start]
+        start += 1
+        while start < end and (total > overlap or header_lengths[start] + total + lengths[end] > length_limit):
+            total -= lengths[start]
+            start += 1
+
+
+def get_window_slice_text(slices:list[dict], i:int) -> str:
+    #NOTE chapter lines are not part of contents, keep the chapter line where the chapter changes inside a window
+    slice = slices[i]
+    if i > 0 and slice["chapter"] and slice["chapter"] != slices[i - 1]["chapter"]:
+        return f"{slice['chapter']}\n{slice['content']}"
+    return slice["content"]
+
+
+def window_slices(
+    slices:list[dict],
+    length_limit:int,
+    overlap:int,
+    filename:str="",
+    filename_in_chunk:bool=False,
+    limit_unit:LimitUnit="char",
+) -> list[Window]:
+    """
+    group slices into overlapping windows. Windows refer to slices by index ranges instead of copying their texts.
+
+    Args:
+        slices (list[dict]): slices in document order
+        length_limit (int): max length of a window, context header included
+        overlap (int): max length of trailing slices of a window repeated at the beginning of the next window
+        filename (str): filename set at the beginning of context headers if `filename_in_chunk`
+        filename_in_chunk (bool): if True, set filename at the beginning of context headers
+        limit_unit (LimitUnit): unit of `length_limit` and `overlap`, characters or tokens
+    Returns:
+        list[Window]: windows with context header and index range of slices
+    """
+    headers = [get_context_header(slice, filename if filename_in_chunk else "") for slice in slices]
+    texts = [get_window_slice_text(slices, i) for i in range(len(slices))]
+    lengths = count_lengths(texts + headers, limit_unit)
+    #NOTE every slice is followed by a line break, and a header by a line break if not empty
+    slice_lengths = [length + 1 for length in lengths[:len(slices)]]
+    header_lengths = [length + 1 if length else 0 for length in lengths[len(slices):]]
+    return [
+        Window(context=headers[start], start=start, end=end)
+        for start, end in iter_windows(slice_lengths, header_lengths, length_limit, overlap)]
+
+
+def format_txt_windows(
+    slices:list[dict],
+    windows:list[Window],
+    splitter:str="\n\n\n\n",
+) -> str:
+    """
+    format windows into text chunks separated by splitter, every chunk prefixed by its context header.
+    Slice texts are built once and shared by all windows covering them.
+    """
+    texts = [get_window_slice_text(slices, i) for i in range(len(slices))]
+    chunks = []
+    for window in windows:
+        start, end = window["start"], window["end"]
+        #NOTE the chapter of the first slice is in the context header already
+        body = [slices[start]["content"], *texts[start + 1:end]]
+        chunks.append("\n".join([window["context"], *body] if window["context"] else body))
+    return splitter.join(chunks)
@@ -0,0 +1,465 @@
+"""
+load test of the `/parse/` endpoint with a mixed-format workload, against a local MinerU stub.
+
+Example:
+    ```
+    python loadtest.py --mix docx=4,pdf=2,md=1,txt=2 --concurrency 1 4 16 --duration 30 --mineru-latency 0.5 --mineru-error-rate 0.05
+    python loadtest.py --url http://10.0.0.2:8000 --files 审计规章制度 --mix docx=3,doc=1,pdf=2 --concurrency 8 32
+    python loadtest.py --compare loadtest-results/1.0.0.json loadtest-results/1.1.0.json
+    ```
+    Every concurrency level is a stage of closed-loop clients, each sending the next request once the previous one returns.
+    Latency percentiles, throughput and error rate are reported per file type and stage, and saved into `--output`
+    for comparison across releases.
+
+    Without `--url`, the api (`backend.app`) is served in this process, with `MINERU_URL` pointed at the MinerU stub,
+    so run it from the repository root like `backend.py`. It requires LibreOffice as the api does.
+    Give `--url` to load a running deployment, start its MinerU stub by `python loadtest.py --stub-only --stub-port 18770`
+    and set `MINERU_URL=http://<this host>:18770/parse` on the deployment.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+FILE_TYPES = ["docx", "doc", "pdf", "md", "txt", "xlsx", "xls"]
+#NOTE types generated when no file of them is given by `--files`. .doc/.xls require real files, they are converted by LibreOffice
+GENERATED_TYPES = ["docx", "pdf", "md", "txt"]
+PERCENTILES = [50, 95, 99]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="load test of the /parse/ endpoint with a mixed-format workload")
+    parser.add_argument("--url", default=None, help="base url of a running api. The api is served in this process if not given")
+    parser.add_argument(
+        "--mix", default="docx=4,pdf=2,md=1,txt=2",
+        help="weights of file types in the workload, like `docx=4,doc=1,pdf=2`. Types: " + ", ".join(FILE_TYPES))
+    parser.add_argument("--files", default=None, help="directory of sample documents, subdirectories included. Generated if not given")
+    parser.add_argument("--size", type=int, default=60, help="articles of every generated document")
+    parser.add_argument("--variants", type=int, default=20, help="generated documents per file type")
+    parser.add_argument(
+        "--repeat", action="store_true",
+        help="send identical bytes for repeated documents. By default pdf/md/txt uploads are made unique, so caches of document content do not hit")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="concurrent clients of every stage")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of every stage")
+    parser.add_argument("--requests", type=int, default=None, help="requests of every stage, instead of --duration")
+    parser.add_argument("--warmup", type=int, default=4, help="requests before the first stage, not measured")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds of a request before it counts as an error")
+    parser.add_argument("--format", choices=["txt", "json"], default="json", help="`output_format` of requests")
+    parser.add_argument("--form", action="append", default=[], help="extra form field of requests, like `length_limit=2000`")
+    parser.add_argument("--mineru-latency", type=float, default=0.5, help="mean seconds of a MinerU stub response")
+    parser.add_argument("--mineru-jitter", type=float, default=0.5, help="latency of the stub varies by this fraction of the mean")
+    parser.add_argument("--mineru-error-rate", type=float, default=0.0, help="fraction of stub responses failing with 503")
+    parser.add_argument("--no-stub", action="store_false", dest="stub", help="use the `MINERU_URL` configured instead of the stub")
+    parser.add_argument("--stub-port", type=int, default=0, help="port of the MinerU stub. A free port if 0")
+    parser.add_argument("--stub-only", action="store_true", help="only serve the MinerU stub, for loading a running api by --url")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the workload")
+    parser.add_argument("--label", default=None, help="label of this run, like the release. Default is the git commit")
+    parser.add_argument("--output", default=None, help="json file of results. Default is loadtest-results/<time>.json")
+    parser.add_argument("--baseline", default=None, help="json file of a previous run, compared against after this run")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None, help="compare two saved runs, without loading")
+    return parser.parse_args()
+
+
+def parse_mix(mix:str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        suffix, _, weight = item.strip().partition("=")
+        suffix = suffix.lstrip(".").lower()
+        if suffix not in FILE_TYPES:
+            raise SystemExit(f"unsupported file type `{suffix}` in --mix, supported: {FILE_TYPES}")
+        weights[suffix] = float(weight or 1)
+    return {suffix: weight for suffix, weight in weights.items() if weight > 0}
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+### documents ###
+
+def _articles(index:int, size:int) -> list[tuple[str, list[str]]]:
+    from dd_parser.numerals import int_to_chinese
+    chapters = []
+    for chapter in range(max(1, size // 10)):
+        articles = [
+            f"第{int_to_chinese(chapter * 10 + i + 1)}条 文档{index}的第{chapter * 10 + i + 1}项规定，"
+            + "审计机关应当依法履行职责，对被审计单位的财政收支、财务收支进行审计监督。" * (1 + (i + index) % 3)
+            for i in range(min(10, size - chapter * 10))]
+        chapters.append((f"第{int_to_chinese(chapter + 1)}章 总则{index}", articles))
+    return chapters
+
+
+def make_document(suffix:str, index:int, size:int) -> bytes:
+    """bytes of a generated document of chapters and articles, numbered like regulations"""
+    chapters = _articles(index, size)
+    if suffix == "txt":
+        return "\n".join(line for title, articles in chapters for line in [title, *articles]).encode("utf-8")
+    if suffix == "md":
+        return "\n\n".join(
+            line for title, articles in chapters for line in [f"## {title}", *articles]).encode("utf-8")
+    if suffix == "docx":
+        from docx import Document
+        doc = Document()
+        for title, articles in chapters:
+            doc.add_heading(title, level=1)
+            for article in articles:
+                doc.add_paragraph(article)
+        stream = io.BytesIO()
+        doc.save(stream)
+        return stream.getvalue()
+    if suffix == "pdf":
+        import fitz
+        doc = fitz.open()
+        lines = [line for title, articles in chapters for line in [title, *articles]]
+        for start in range(0, len(lines), 20):
+            page = doc.new_page()
+            #NOTE every page gets its own page number, so no line repeats on every page like headers and footers
+            text = "\n\n".join(lines[start:start + 20] + [f"- {start // 20 + 1} -"])
+            page.insert_textbox(page.rect + (50, 50, -50, -50), text, fontsize=9, fontname="china-s")
+        return doc.tobytes()
+    raise ValueError(f"cannot generate .{suffix} documents, give samples of them by --files")
+
+
+def make_unique(suffix:str, data:bytes, nonce:int) -> bytes:
+    #NOTE documents are cached and coalesced by content, unique bytes measure a cold parse. Trailing bytes
+    # are a comment after `%%EOF` of a pdf, and a last line of text
+    if suffix == "pdf":
+        return data + f"\n%loadtest {nonce}\n".encode()
+    if suffix in ("txt", "md"):
+        return data + f"\n\nloadtest {nonce}".encode()
+    return data
+
+
+class Workload:
+    """documents to upload by file type, picked by the weights of `--mix`"""
+
+    def __init__(self, weights:dict[str, float], documents:dict[str, list[tuple[str, bytes]]], repeat:bool, seed:int):
+        self.weights = weights
+        self.documents = documents
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.nonce = 0
+
+    @classmethod
+    def load(cls, weights:dict[str, float], files_dir:str|None, size:int, variants:int, repeat:bool, seed:int) -> "Workload":
+        documents:dict[str, list[tuple[str, bytes]]] = defaultdict(list)
+        if files_dir:
+            for path in sorted(Path(files_dir).rglob("*")):
+                suffix = path.suffix.lstrip(".").lower()
+                if path.is_file() and suffix in weights:
+                    documents[suffix].append((path.name, path.read_bytes()))
+        for suffix in weights:
+            if documents[suffix]:
+                continue
+            if suffix not in GENERATED_TYPES:
+                raise SystemExit(f"no .{suffix} file under --files, .{suffix} documents cannot be generated")
+            documents[suffix] = [(f"loadtest-{i}.{suffix}", make_document(suffix, i, size)) for i in range(variants)]
+        return cls(weights, dict(documents), repeat, seed)
+
+    def next(self) -> tuple[str, str, bytes]:
+        """(file type, filename, bytes) of the next upload"""
+        suffix = self.random.choices(list(self.weights), weights=list(self.weights.values()))[0]
+        filename, data = self.random.choice(self.documents[suffix])
+        if not self.repeat:
+            self.nonce += 1
+            data = make_unique(suffix, data, self.nonce)
+        return suffix, filename, data
+
+
+### MinerU stub ###
+
+def create_mineru_stub(latency:float, jitter:float, error_rate:float, seed:int=0) -> web.Application:
+    """
+    MinerU stub answering like the MinerU service, after `latency` seconds on average and failing `error_rate` of requests with 503.
+    `json` requests get a `content_list` of headings and paragraphs, `markdown` requests the same as markdown.
+    """
+    rng = random.Random(seed)
+    stats = dict(requests=0, errors=0)
+
+    async def parse(request:web.Request):
+        form = await request.post()
+        stats["requests"] += 1
+        await asyncio.sleep(max(0.0, latency * (1 + jitter * (2 * rng.random() - 1))))
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            return web.Response(status=503, text="stub error")
+        filename = form["file"].filename
+        blocks = []
+        for chapter in range(3):
+            blocks.append(dict(type="text", text=f"第{'一二三'[chapter]}章 {filename}", text_level=1, page_idx=chapter))
+            blocks.extend(
+                dict(type="text", text=f"第{chapter * 5 + i + 1}条 审计机关应当依法对{filename}进行审计监督。", page_idx=chapter)
+                for i in range(5))
+        if form.get("output_format") == "markdown":
+            data = "\n\n".join(("# " if "text_level" in block else "") + block["text"] for block in blocks)
+        else:
+            data = blocks
+        return web.json_response(dict(request_id=form.get("request_id"), data=data))
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post("/parse", parse)
+    app["stats"] = stats
+    return app
+
+
+async def start_site(app:web.Application, port:int, host:str="127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+### load ###
+
+def percentile(values:list[float], q:float) -> float:
+    """nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(records:list[tuple[str, float, str]], elapsed:float) -> dict[str, dict]:
+    """latency percentiles (ms), throughput (req/s) and error rate of records `(file type, seconds, status)`, by file type and `all`"""
+    by_type = defaultdict(list)
+    for record in records:
+        by_type[record[0]].append(record)
+        by_type["all"].append(record)
+    summary = {}
+    for suffix, items in sorted(by_type.items(), key=lambda item: (item[0] == "all", item[0])):
+        latencies = sorted(seconds * 1000 for _, seconds, _ in items)
+        statuses = defaultdict(int)
+        for _, _, status in items:
+            statuses[status] += 1
+        errors = sum(count for status, count in statuses.items() if status != "200")
+        summary[suffix] = dict(
+            requests=len(items),
+            errors=errors,
+            error_rate=errors / len(items),
+            throughput=len(items) / elapsed if elapsed else 0.0,
+            mean=sum(latencies) / len(latencies),
+            **{f"p{q}": percentile(latencies, q) for q in PERCENTILES},
+            statuses=dict(statuses),
+        )
+    return summary
+
+
+async def post_parse(session:aiohttp.ClientSession, url:str, filename:str, data:bytes, fields:dict[str, str]) -> str:
+    formdata = aiohttp.FormData()
+    formdata.add_field("file", data, filename=filename)
+    for key, value in fields.items():
+        formdata.add_field(key, value)
+    try:
+        async with session.post(url, data=formdata) as response:
+            await response.read()
+            return str(response.status)
+    except asyncio.TimeoutError:
+        return "timeout"
+    except aiohttp.ClientError as e:
+        return type(e).__name__
+
+
+async def run_stage(
+    session:aiohttp.ClientSession,
+    url:str,
+    workload:Workload,
+    concurrency:int,
+    fields:dict[str, str],
+    duration:float,
+    requests:int|None,
+) -> tuple[list[tuple[str, float, str]], float]:
+    records = []
+    remaining = requests
+    start = time.perf_counter()
+    deadline = start + duration
+
+    async def client():
+        nonlocal remaining
+        while True:
+            if requests is not None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            elif time.perf_counter() >= deadline:
+                return
+            suffix, filename, data = workload.next()
+            sent = time.perf_counter()
+            status = await post_parse(session, url, filename, data, fields)
+            records.append((suffix, time.perf_counter() - sent, status))
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return records, time.perf_counter() - start
+
+
+async def get_status(session:aiohttp.ClientSession, base_url:str) -> dict|None:
+    try:
+        async with session.get(f"{base_url}/status/") as response:
+            return await response.json() if response.status == 200 else None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return None
+
+
+def print_stage(concurrency:int, summary:dict[str, dict]):
+    print(f"\nconcurrency {concurrency}")
+    print(f"{'type':>6} {'requests':>9} {'req/s':>8} {'errors':>7} {'mean':>8} " + " ".join(f"{f'p{q}':>8}" for q in PERCENTILES))
+    for suffix, row in summary.items():
+        print(
+            f"{suffix:>6} {row['requests']:>9} {row['throughput']:>8.2f} {row['error_rate']:>7.1%} {row['mean']:>8.0f} "
+            + " ".join(f"{row[f'p{q}']:>8.0f}" for q in PERCENTILES))
+
+
+async def run_load(args, workload:Workload) -> dict:
+    fields = dict(output_format=args.format)
+    for field in args.form:
+        key, _, value = field.partition("=")
+        fields[key] = value
+
+    stub_runner = server = server_task = None
+    if args.stub:
+        stub_port = args.stub_port or get_free_port()
+        stub = create_mineru_stub(args.mineru_latency, args.mineru_jitter, args.mineru_error_rate, args.seed)
+        stub_runner = await start_site(stub, stub_port)
+        #NOTE read by `dd_parser.config` on import, the api is imported below
+        os.environ["MINERU_URL"] = f"http://127.0.0.1:{stub_port}/parse"
+    base_url = args.url.rstrip("/") if args.url else None
+    if base_url is None:
+        import uvicorn
+        from backend import app
+        port = get_free_port()
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if server_task.done():
+                raise SystemExit(f"api failed to start: {server_task.exception()!r}")
+            await asyncio.sleep(0.05)
+        base_url = f"http://127.0.0.1:{port}"
+
+    results = dict(
+        label=args.label or get_git_commit(),
+        commit=get_git_commit(),
+        started_at=datetime.now().isoformat(timespec="seconds"),
+        target=args.url or "in-process",
+        host=dict(platform=platform.platform(), python=platform.python_version(), cpus=os.cpu_count()),
+        workload=dict(
+            mix=workload.weights, files=args.files, size=args.size, variants=args.variants, repeat=args.repeat, fields=fields,
+            documents={suffix: len(documents) for suffix, documents in workload.documents.items()}),
+        mineru=dict(stub=args.stub, latency=args.mineru_latency, jitter=args.mineru_jitter, error_rate=args.mineru_error_rate),
+        stages=[],
+    )
+    url = f"{base_url}/parse/"
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            if args.warmup:
+                await run_stage(session, url, workload, 1, fields, 0, args.warmup)
+            for concurrency in args.concurrency:
+                stub_before = dict(stub_runner.app["stats"]) if stub_runner is not None else None
+                records, elapsed = await run_stage(session, url, workload, concurrency, fields, args.duration, args.requests)
+                summary = summarize(records, elapsed)
+                print_stage(concurrency, summary)
+                stage = dict(concurrency=concurrency, seconds=elapsed, summary=summary, status=await get_status(session, base_url))
+                if stub_runner is not None:
+                    stage["mineru_stub"] = {key: value - stub_before[key] for key, value in stub_runner.app["stats"].items()}
+                results["stages"].append(stage)
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        if stub_runner is not None:
+            await stub_runner.cleanup()
+    return results
+
+
+### compare ###
+
+def _delta(old:float, new:float) -> str:
+    return f"{(new - old) / old:+.1%}" if old else "n/a"
+
+
+def compare_results(old:dict, new:dict):
+    """print throughput, p95 latency and error rate of every stage and file type of two runs"""
+    print(f"\n{old['label']} ({old['started_at']}) -> {new['label']} ({new['started_at']})")
+    old_stages = {stage["concurrency"]: stage["summary"] for stage in old["stages"]}
+    if not any(stage["concurrency"] in old_stages for stage in new["stages"]):
+        print("no concurrency level in common, run both with the same --concurrency")
+    for stage in new["stages"]:
+        concurrency = stage["concurrency"]
+        if concurrency not in old_stages:
+            continue
+        print(f"\nconcurrency {concurrency}")
+        print(f"{'type':>6} {'req/s':>22} {'p95 ms':>24} {'errors':>16}")
+        for suffix, row in stage["summary"].items():
+            before = old_stages[concurrency].get(suffix)
+            if before is None:
+                continue
+            print(
+                f"{suffix:>6} {before['throughput']:>7.2f} -> {row['throughput']:>6.2f} {_delta(before['throughput'], row['throughput']):>7} "
+                f"{before['p95']:>8.0f} -> {row['p95']:>6.0f} {_delta(before['p95'], row['p95']):>7} "
+                f"{before['error_rate']:>6.1%} -> {row['error_rate']:>6.1%}")
+
+
+def load_results(filepath:str) -> dict:
+    with open(filepath, encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def serve_stub(args):
+    port = args.stub_port or 18770
+    await start_site(create_mineru_stub(args.mineru_latency, args.mineru_jitter, args.mineru_error_rate, args.seed), port, "0.0.0.0")
+    print(f"MinerU stub on http://0.0.0.0:{port}/parse, latency {args.mineru_latency}s, error rate {args.mineru_error_rate:.1%}")
+    await asyncio.Event().wait()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare_results(load_results(args.compare[0]), load_results(args.compare[1]))
+        return
+    if args.stub_only:
+        asyncio.run(serve_stub(args))
+        return
+
+    if args.url is None:
+        #NOTE logs of every request would flood the report and slow down the api served in this process
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        sys.path.insert(0, str(Path(__file__).parent))
+    workload = Workload.load(parse_mix(args.mix), args.files, args.size, args.variants, args.repeat, args.seed)
+    print(f"workload: {workload.weights}, documents {({suffix: len(docs) for suffix, docs in workload.documents.items()})}")
+    results = asyncio.run(run_load(args, workload))
+
+    output = Path(args.output or f"loadtest-results/{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nresults saved into {output}")
+    if args.baseline:
+        compare_results(load_results(args.baseline), results)
+
+
+if __name__ == "__main__":
+    main()
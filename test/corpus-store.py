@@ -0,0 +1,123 @@
+"""
+check the sqlite corpus store: batched writes, replacing documents, full-text search (trigram and short terms),
+filtered export as NDJSON, retrying or dropping batches failing to be written, and compare writing in batches against
+a transaction per document.
+
+Example:
+    ```
+    python test/corpus-store.py --documents 500 --articles 40
+    ```
+"""
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from loadtest import make_document
+from dd_parser.parse import split_text
+from dd_parser.store import CorpusStore
+
+
+def write_documents(store:CorpusStore, documents:list[tuple[str, list[dict]]]) -> float:
+    start = time.perf_counter()
+    for key, slices in documents:
+        if store.put(key, f"{key}.txt", key, slices):
+            store.flush()
+    store.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--articles", type=int, default=40)
+    args = parser.parse_args()
+
+    slices = split_text(make_document("txt", 0, args.articles).decode("utf-8"))
+    documents = [(f"doc{i}", [dict(s, content=f"{s['content']} 编号{i:05d}") for s in slices]) for i in range(args.documents)]
+    total = sum(len(s) for _, s in documents)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        #NOTE a transaction per document against transactions of `batch_size` slices
+        per_document = write_documents(CorpusStore(Path(tmp) / "per_document.sqlite3", batch_size=1), documents)
+        store = CorpusStore(Path(tmp) / "corpus.sqlite3", batch_size=5000)
+        batched = write_documents(store, documents)
+        print(
+            f"{args.documents} documents, {total} slices: a transaction per document {per_document:.2f}s "
+            f"({total / per_document:.0f} slices/s), batched {batched:.2f}s ({total / batched:.0f} slices/s)")
+        assert store.documents_written == args.documents and store.slices_written == total
+
+        #NOTE a document put again replaces its slices, in the index too
+        store.put("doc0", "doc0.txt", "doc0", [dict(chapter="第一章 附则", article="", content="本办法自发布之日起施行。", start=0, end=12)])
+        store.close()
+        exported = [s for batch in store.iter_export(document_ids=["doc0"]) for s in batch]
+        assert exported == [dict(
+            document_id="doc0", filename="doc0.txt", position=0, chapter="第一章 附则", article="",
+            content="本办法自发布之日起施行。", start=0, end=12)], exported
+        assert not store.search("编号00000"), "slices replaced must be removed from the index"
+
+        hits = store.search("编号00007 审计监督", limit=5)
+        assert hits and all(hit["document_id"] == "doc7" for hit in hits), hits
+        print(f"search '编号00007 审计监督': {len(hits)} hits, {hits[0]['snippet'][:60]!r}")
+        #NOTE terms shorter than a trigram are searched by LIKE
+        short = store.search("附则")
+        assert [hit["document_id"] for hit in short] == ["doc0"], short
+        assert len(store.search("审计", limit=1000, filename="doc1*.txt")) > 0
+
+        start = time.perf_counter()
+        count = sum(len(batch) for batch in store.iter_export())
+        seconds = time.perf_counter() - start
+        assert count == total - len(slices) + 1
+        print(f"export {count} slices in {seconds:.2f}s ({count / seconds:.0f} slices/s)")
+        assert sum(len(batch) for batch in store.iter_export(filename="doc1?.txt")) == 10 * len(slices)
+        assert sum(len(batch) for batch in store.iter_export(since=time.time() + 60)) == 0
+
+        async def read_ndjson() -> list[dict]:
+            chunks = [chunk async for chunk in store.aiter_ndjson(document_ids=["doc1", "doc2"], query="编号00002")]
+            return [json.loads(line) for line in b"".join(chunks).decode("utf8").splitlines()]
+
+        lines = asyncio.run(read_ndjson())
+        assert len(lines) == len(slices) and {line["document_id"] for line in lines} == {"doc2"}
+        assert [line["position"] for line in lines] == list(range(len(slices)))
+        print(f"ndjson export of doc2 by query: {len(lines)} lines, keys {list(lines[0])}")
+
+        #NOTE a batch failing on a locked database stays buffered, and is written by the next flush
+        locked = CorpusStore(store.path, batch_size=5000, max_retries=1)
+        locked.put("doc1", "doc1.txt", "doc1", slices[:1])
+        locked._writer = locked.connect()
+        locked._writer.execute("PRAGMA busy_timeout=0")
+        blocker = sqlite3.connect(store.path)
+        blocker.execute("BEGIN IMMEDIATE")
+        assert locked.flush() == 0 and locked.failures == 1 and locked.documents_written == 0
+        assert locked._pending_slices == 1, "a failed batch must stay buffered"
+        blocker.rollback()
+        assert locked.flush() == 1 and locked.documents_written == 1
+        assert len([s for batch in store.iter_export(document_ids=["doc1"]) for s in batch]) == 1
+        print("a batch failing on a locked database is written by the next flush")
+
+        #NOTE and is dropped once the database stays locked for more than `max_retries` flushes
+        locked.put("doc1", "doc1.txt", "doc1", slices[:2])
+        blocker.execute("BEGIN IMMEDIATE")
+        assert locked.flush() == 0 and locked.flush() == 0
+        assert locked._pending_slices == 0 and locked.documents_dropped == 1, locked.stats()
+        blocker.rollback()
+        blocker.close()
+
+        #NOTE a malformed document fails its transaction, the other documents of the batch are written one by one
+        locked.put("malformed", "malformed.txt", "malformed", [dict(chapter="", article="", content=None)])
+        locked.put("valid", "valid.txt", "valid", slices[:1])
+        assert locked.flush() == 1 and locked.documents_dropped == 2, locked.stats()
+        locked.close()
+        assert [len(batch) for batch in store.iter_export(document_ids=["malformed", "valid"])] == [1]
+        assert store.search(slices[0]["content"][:8], document_ids=["valid"])
+        print(f"retries and malformed documents: {locked.stats()}")
+
+
+if __name__ == '__main__':
+    main()
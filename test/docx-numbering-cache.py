@@ -0,0 +1,133 @@
+"""
+check numbering of list items in .docx files (chinese counting above ten, multi-level `%1.%2`, restarts, start overrides),
+and compare compiling numbering parts per document against the numbering cache, for documents of the same templates.
+Hit rates of the caches of sandboxed workers are checked to be reported by their pool.
+
+Example:
+    ```
+    python test/docx-numbering-cache.py --documents 200 --templates 4
+    ```
+"""
+import sys
+import time
+import tempfile
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from docx import Document
+from docx.oxml import parse_xml
+
+from dd_parser import numbering
+from dd_parser.numbering import compile_numbering, get_numbering_cache_info
+from dd_parser.tools import get_pure_docx_text, get_docx_paragraphs
+from dd_parser.sandbox import SandboxPool
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+LEVELS = [("chineseCounting", "第%1章"), ("chineseCounting", "第%2条"), ("decimal", "%2.%3"), ("lowerLetter", "(%4)")]
+
+
+def abstract_num_xml(abstract_id:int, extra_levels:int) -> str:
+    levels = LEVELS + [("upperRoman", f"%{i + 1}.") for i in range(len(LEVELS), len(LEVELS) + extra_levels)]
+    lvls = "".join(
+        f'<w:lvl w:ilvl="{ilvl}"><w:start w:val="1"/><w:numFmt w:val="{fmt}"/><w:lvlText w:val="{text}"/></w:lvl>'
+        for ilvl, (fmt, text) in enumerate(levels))
+    return f'<w:abstractNum xmlns:w="{W}" w:abstractNumId="{abstract_id}">{lvls}</w:abstractNum>'
+
+
+def num_xml(num_id:int, abstract_id:int, start_override:int=None) -> str:
+    override = f'<w:lvlOverride w:ilvl="0"><w:startOverride w:val="{start_override}"/></w:lvlOverride>' if start_override else ""
+    return f'<w:num xmlns:w="{W}" w:numId="{num_id}"><w:abstractNumId w:val="{abstract_id}"/>{override}</w:num>'
+
+
+def numbered_paragraph(doc, text:str, num_id:int, ilvl:int):
+    paragraph = doc.add_paragraph(text)
+    paragraph._element.get_or_add_pPr().append(parse_xml(
+        f'<w:numPr xmlns:w="{W}"><w:ilvl w:val="{ilvl}"/><w:numId w:val="{num_id}"/></w:numPr>'))
+
+
+def make_template(doc, template:int, lists:int=50):
+    #NOTE a template with many lists, like real ones, so compiling its numbering part takes measurable time
+    element = doc.part.numbering_part.element
+    for i in range(lists):
+        element.insert(0, parse_xml(abstract_num_xml(100 + i, extra_levels=min(template, 5))))
+    for i in range(lists):
+        element.append(parse_xml(num_xml(100 + i, 100 + i, start_override=3 if i == 1 else None)))
+
+
+def make_document(path:Path, template:int, index:int):
+    doc = Document()
+    make_template(doc, template)
+    for chapter in range(3):
+        numbered_paragraph(doc, "总则", 100, 0)
+        for article in range(12):
+            numbered_paragraph(doc, f"文档{index}的条款", 100, 1)
+            if article == 0:
+                numbered_paragraph(doc, "细则", 100, 2)
+                numbered_paragraph(doc, "要点", 100, 3)
+                numbered_paragraph(doc, "细则", 100, 2)
+    numbered_paragraph(doc, "附则", 101, 0)
+    doc.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--templates", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = []
+        for i in range(args.documents):
+            paths.append(Path(temp_dir) / f"{i}.docx")
+            make_document(paths[-1], i % args.templates, i)
+
+        lines = get_pure_docx_text(paths[0]).splitlines()
+        print("\n".join(lines[:8]))
+        assert lines[0] == "第一章 总则" and lines[1] == "第一条 文档0的条款"
+        #NOTE every placeholder is formatted by the format of its own level
+        assert lines[2] == "一.1 细则" and lines[3] == "(a) 要点" and lines[4] == "一.2 细则"
+        assert "第十一条 文档0的条款" in lines and "第十二条 文档0的条款" in lines, "chinese numerals above ten"
+        assert lines[16] == "第二章 总则" and lines[17] == "第一条 文档0的条款", "articles restart in every chapter"
+        assert lines[-1] == "第三章 附则", "start override"
+
+        parts = [Document(path).part.numbering_part for path in paths]
+        #NOTE compiling every document, as without the cache
+        start = time.perf_counter()
+        for part in parts:
+            compile_numbering(part.element)
+        compile_seconds = time.perf_counter() - start
+
+        numbering._numbering_cache.clear()
+        numbering.cache_hits = numbering.cache_misses = 0
+        start = time.perf_counter()
+        for path, part in zip(paths, parts):
+            numbering.get_numbering_table(path, part)
+        cached_seconds = time.perf_counter() - start
+        info = get_numbering_cache_info()
+        print(
+            f"{args.documents} documents of {args.templates} templates: numbering compiled per document in {compile_seconds * 1000:.0f} ms, "
+            f"cached in {cached_seconds * 1000:.0f} ms ({compile_seconds / cached_seconds:.1f}x), {info}")
+        assert info["misses"] == args.templates and info["templates"] == args.templates
+
+        start = time.perf_counter()
+        for path in paths:
+            get_pure_docx_text(path)
+        elapsed = time.perf_counter() - start
+        print(f"get_pure_docx_text: {elapsed / args.documents * 1000:.1f} ms per document, {get_numbering_cache_info()}")
+
+        #NOTE numbering parts are cached in sandboxed workers, their stats come back with every result
+        pool = SandboxPool("test", workers=2)
+        for path in paths[:8]:
+            pool.call(get_docx_paragraphs, path, affinity="template")
+        worker_info = pool.cache_stats()["docx_numbering"]
+        pool.shutdown()
+        print(f"8 documents in sandboxed workers of one affinity key: {worker_info}")
+        assert worker_info["hits"] + worker_info["misses"] == 8
+        assert worker_info["misses"] == min(8, args.templates), "a worker compiles every template once"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+check batching, ordering and caching of `EmbeddingClient` against a local fake embeddings server.
+
+The fake server returns embeddings in reversed order, to check that they are reordered by `index`.
+
+run: python test/fake-embeddings-server.py
+"""
+import sys
+import asyncio
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.append(str(Path(__file__).parent.parent))
+from dd_parser.client import HTTP_CLIENT
+from dd_parser.limiter import StageLimiter
+from dd_parser.embedding import EmbeddingClient, embed_slices
+
+FAKE_PORT = 18766
+requests_seen = [] # number of texts of every request received
+max_in_flight = 0
+in_flight = 0
+
+
+def fake_embedding(text:str) -> list[float]:
+    return [float(len(text)), float(sum(map(ord, text)) % 997)]
+
+
+async def fake_embeddings(request:web.Request):
+    global in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    payload = await request.json()
+    requests_seen.append(len(payload["input"]))
+    await asyncio.sleep(0.05)
+    data = [dict(object="embedding", index=i, embedding=fake_embedding(text))
+            for i, text in enumerate(payload["input"])]
+    in_flight -= 1
+    return web.json_response(dict(object="list", model=payload["model"], data=data[::-1]))
+
+
+async def main():
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", fake_embeddings)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", FAKE_PORT).start()
+    await HTTP_CLIENT.start()
+    client = EmbeddingClient(
+        f"http://127.0.0.1:{FAKE_PORT}/v1/embeddings", "fake",
+        batch_chars=100, batch_size=8, limiter=StageLimiter("embedding", 2))
+    try:
+        texts = [f"第{i}条 " + "内容" * (i % 20) for i in range(60)]
+        embeddings = await client.aembed(texts)
+        assert embeddings == [fake_embedding(text) for text in texts], "embeddings out of order"
+        assert all(n <= 8 for n in requests_seen), requests_seen
+        assert max_in_flight <= 2, max_in_flight
+        print(f"60 texts -> {len(requests_seen)} requests {requests_seen}, max in flight {max_in_flight}")
+
+        #NOTE unchanged texts are served from cache
+        sent = len(requests_seen)
+        await client.aembed(texts[:30] + ["a new text"])
+        assert len(requests_seen) == sent + 1 and requests_seen[-1] == 1, requests_seen
+        print(f"re-embedding 30 cached + 1 new text -> 1 request, cache {client.stats()}")
+
+        slices = [dict(chapter="第一章", article="", content="第一条 内容"), dict(chapter="第一章", article="", content="")]
+        await embed_slices(slices, client)
+        assert slices[0]["embedding"] == fake_embedding("第一章\n第一条 内容") and slices[1]["embedding"] is None
+        print("embed_slices ok")
+
+        #NOTE batches are limited by tokens too, and all batches of one call pass a limiter of 1 slot
+        token_client = EmbeddingClient(
+            f"http://127.0.0.1:{FAKE_PORT}/v1/embeddings", "fake",
+            batch_chars=10000, batch_tokens=30, batch_size=64, limiter=StageLimiter("embedding", 1, wait_timeout=0.01))
+        texts = [f"{i}" + "审计" * 6 for i in range(40)] #NOTE 13 tokens each
+        sent = len(requests_seen)
+        embeddings = await token_client.aembed(texts)
+        assert embeddings == [fake_embedding(text) for text in texts]
+        assert requests_seen[sent:] == [2] * 20, requests_seen[sent:]
+        print(f"40 texts of 13 tokens, 30 tokens per batch -> {len(requests_seen) - sent} requests, one at a time")
+    finally:
+        await HTTP_CLIENT.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""
+measure cold import time of the package entry points by `python -X importtime`, and guard against regressions.
+
+Every module is imported in a fresh interpreter several times and the fastest run is reported,
+with the slowest imported packages. Heavy backends (PyMuPDF, python-docx, aiohttp, FastAPI, pydantic)
+must not be imported by the CLI path, they are imported on first use of a file type.
+
+Example:
+    ```
+    python test/import-time-benchmark.py
+    python test/import-time-benchmark.py --max-ms 300 #NOTE exits with 1 if `dd_parser.batch` imports slower
+    ```
+"""
+import os
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).parents[1]
+
+#NOTE module: top-level packages it must not import
+TARGETS = {
+    "dd_parser": ["fitz", "pymupdf", "docx", "aiohttp", "fastapi", "pydantic", "tokenizers", "xlrd"],
+    "dd_parser.batch": ["fitz", "pymupdf", "docx", "aiohttp", "fastapi", "pydantic", "tokenizers", "xlrd"],
+    "backend": ["fitz", "pymupdf", "docx", "aiohttp", "tokenizers", "xlrd"],
+}
+
+
+def import_time(module:str="") -> tuple[float, dict[str, float], set[str]]:
+    """
+    import `module` in a fresh interpreter. Only interpreter startup modules are imported if `module` is empty.
+
+    Returns:
+        tuple[float, dict[str, float], set[str]]: cumulative import time of `module` in ms,
+        import time of every top-level package in ms (cumulative time of its outermost import),
+        and names of all top-level packages imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}" if module else "pass"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    packages = {}
+    imported = set()
+    total = 0.0
+    for line in result.stderr.splitlines():
+        #NOTE import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue #NOTE header line
+        name = name.strip()
+        if name == module:
+            total = int(cumulative) / 1000
+        #NOTE nested imports are listed before their importers, the outermost import of a package has the largest time
+        package = name.split(".")[0]
+        imported.add(package)
+        packages[package] = max(packages.get(package, 0.0), int(cumulative) / 1000)
+    return total, packages, imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module, the fastest one is reported")
+    parser.add_argument("--top", type=int, default=8, help="number of slowest packages to report")
+    parser.add_argument("--max-ms", type=float, default=None, help="max import time of `dd_parser.batch` in ms")
+    args = parser.parse_args()
+
+    #NOTE modules imported by every interpreter on startup (site, sitecustomize) are not reported
+    _, _, startup = import_time()
+    failed = False
+    for module, forbidden in TARGETS.items():
+        runs = [import_time(module) for _ in range(args.repeat)]
+        total, packages, imported = min(runs, key=lambda run: run[0])
+        print(f"{module}: {total:.1f} ms")
+        packages = {name: ms for name, ms in packages.items() if name not in startup and name != module.split(".")[0]}
+        for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {name:<24}{ms:8.1f} ms")
+        heavy = sorted(set(forbidden) & imported)
+        if heavy:
+            print(f"    ❌ imports heavy backends on import: {heavy}")
+            failed = True
+        if module == "dd_parser.batch" and args.max_ms is not None and total > args.max_ms:
+            print(f"    ❌ slower than {args.max_ms} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+check local pdf extraction of scanned pages: only pages without text layer are rendered, the render resolution is capped,
+pages are recognized in parallel in the OCR process pool, and recognized pages are cached.
+
+Runs without tesseract by a `render` engine, which renders pages like OCR does and reports their pixel sizes.
+Give `--engine tesseract` to recognize by tesseract (requires its `chi_sim`/`eng` language data, see `TESSDATA_PREFIX`).
+
+Example:
+    ```
+    python test/local-ocr-fallback.py --pages 16
+    ```
+"""
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+os.environ.setdefault("OCR_ENGINE", "render")
+
+import fitz
+
+from dd_parser import ocr
+from dd_parser.ocr import register_ocr_engine, get_render_dpi, get_scanned_pages, get_pdf_text_with_ocr, ocr_pdf_pages
+
+
+def render_engine(page:"fitz.Page", dpi:int, language:str) -> str:
+    pixmap = page.get_pixmap(dpi=dpi)
+    return f"扫描页 {page.number} {pixmap.width}x{pixmap.height}"
+
+
+register_ocr_engine("render", render_engine)
+
+
+def scanned_pdf(pages:int) -> bytes:
+    #NOTE the first page has a text layer, the others are images of text like scans
+    source = fitz.open()
+    page = source.new_page()
+    page.insert_text((72, 72), "Chapter 1 text layer", fontsize=12)
+    pixmap = page.get_pixmap(dpi=150)
+    doc = fitz.open()
+    doc.insert_pdf(source)
+    for i in range(pages - 1):
+        width, height = (fitz.paper_size("a4") if i % 4 else fitz.paper_size("a0"))
+        doc.new_page(width=width, height=height).insert_image(fitz.Rect(0, 0, width, height), pixmap=pixmap)
+    return doc.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=16)
+    parser.add_argument("--engine", default="render")
+    args = parser.parse_args()
+
+    a4, a0 = fitz.paper_size("a4"), fitz.paper_size("a0")
+    assert get_render_dpi(*a4, dpi=300, max_side=4000) == 300
+    assert get_render_dpi(*a0, dpi=300, max_side=4000) == 85, "an A0 page is capped at 4000 pixels"
+
+    data = scanned_pdf(args.pages)
+    assert get_scanned_pages(data) == list(range(1, args.pages)), "the text page is never rendered"
+
+    texts = get_pdf_text_with_ocr(data) if args.engine == "render" else None
+    if texts is not None:
+        print("\n".join(texts[:3]))
+        assert texts[0] == "Chapter 1 text layer" and texts[1].startswith("扫描页 1 ")
+        assert all(max(map(int, text.split()[-1].split("x"))) <= 4000 for text in texts[1:])
+
+    scanned = get_scanned_pages(data)
+    ocr.get_ocr_executor().submit(int).result() #NOTE workers are started before timing
+    print(f"{ocr.OCR_WORKERS} OCR workers on {os.cpu_count()} cpus")
+    for name, executor in [("in process", None), ("process pool", ocr.get_ocr_executor())]:
+        ocr._ocr_cache.clear()
+        start = time.perf_counter()
+        ocr_pdf_pages(data, scanned, engine=args.engine, executor=executor)
+        print(f"{name:>12}: {len(scanned)} pages in {(time.perf_counter() - start) * 1000:.0f} ms")
+    start = time.perf_counter()
+    result = ocr_pdf_pages(data, scanned, engine=args.engine, executor=ocr.get_ocr_executor())
+    print(f"{'cached':>12}: {len(scanned)} pages in {(time.perf_counter() - start) * 1000:.1f} ms, {ocr.get_ocr_cache_info()}")
+    if args.engine != "render":
+        print(result[scanned[0]])
+    ocr.shutdown_ocr_executor()
+
+
+if __name__ == '__main__':
+    main()
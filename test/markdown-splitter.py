@@ -0,0 +1,88 @@
+"""
+check the markdown splitter: headings inside code blocks, setext headings, tables and lists,
+and that splitting time grows linearly with the size of the document.
+
+Example:
+    ```
+    python test/markdown-splitter.py --sections 5000 10000 20000 40000
+    ```
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from dd_parser.parse import split_text
+from dd_parser.markdown import iter_markdown_blocks
+
+SAMPLE = """\
+附录A 医疗服务项目
+==================
+
+## A.1 神经内科
+A.1 门诊服务规范。
+
+### A.1.1 门诊
+```bash
+# 不是标题
+echo done
+```
+
+| 项目 | 单价 |
+| --- | ---: |
+| 挂号 | 10 |
+
+### A.1.2 住院
+- 入院登记
+  需要身份证
+- 出院结算
+
+## A.2 神经外科
+~~~
+未闭合的代码块 # 也不是标题
+"""
+
+
+def section(i:int) -> str:
+    return (
+        f"## A.{i} 科室{i}\n第{i}节正文，说明服务内容。\n\n"
+        f"### A.{i}.1 门诊\n```python\n# comment {i}\nprint({i})\n```\n\n"
+        f"| 项目 | 单价 |\n|---|---|\n| 挂号 | {i} |\n\n"
+        f"- 条目一\n- 条目二\n\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, nargs="+", default=[5000, 10000, 20000, 40000])
+    args = parser.parse_args()
+
+    kinds = [block.kind for block in iter_markdown_blocks(SAMPLE)]
+    print(kinds)
+    slices = split_text(SAMPLE, split_mode="markdown")
+    for slice in slices:
+        print(slice)
+    articles = [slice["article"] for slice in slices]
+    assert articles == ["", "", "A.1.1 门诊", "A.1.2 住院", ""], articles
+    assert slices[0]["chapter"] == "附录A 医疗服务项目", "setext heading"
+    assert "# 不是标题" in slices[2]["content"] and "| 挂号 | 10 |" in slices[2]["content"]
+    assert slices[-1]["content"].endswith("# 也不是标题"), "an unclosed code block runs to the end"
+    #NOTE the regex splitter given the patterns of the `__main__` block of parse.py splits inside code blocks
+    regex_slices = split_text(SAMPLE, re_matchers=[r"#\s\w.\d{1,2}\s.*", r"#\s\w.\d{1,2}.\d{1,2}\s.*"])
+    print(f"markdown: {len(slices)} slices, regex: {len(regex_slices)} slices")
+
+    previous = None
+    for sections in args.sections:
+        text = "# 附录A\n\n" + "".join(section(i) for i in range(sections))
+        start = time.perf_counter()
+        slices = split_text(text, split_mode="markdown")
+        elapsed = time.perf_counter() - start
+        assert len(slices) == 2 * sections + 1, len(slices) #NOTE and the empty slice of the title
+        ratio = f", {elapsed / previous[1]:.2f}x time for {sections / previous[0]:.1f}x size" if previous else ""
+        print(f"{sections:>6} sections ({len(text) / 1024 / 1024:.1f} MB): {len(slices)} slices in {elapsed * 1000:.0f} ms{ratio}")
+        previous = (sections, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+compare splitting MinerU json blocks by their heading levels against splitting MinerU markdown by regex patterns.
+
+Runs offline on synthetic MinerU results in the format of `content_list.json`.
+
+Example:
+    ```
+    python test/mineru-json-splitting.py --articles 20000
+    ```
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from dd_parser.parse import mineru_result_to_slices, split_text
+from dd_parser.mineru import get_mineru_text
+
+CHN = "一二三四五六七八九十"
+
+
+def chinese_number(n:int) -> str:
+    tens, ones = divmod(n, 10)
+    if n < 10:
+        return CHN[n - 1]
+    return (CHN[tens - 1] if tens > 1 else "") + "十" + (CHN[ones - 1] if ones else "")
+
+
+def synthetic_content_list(articles:int, per_chapter:int=10) -> list[dict]:
+    blocks = [dict(type="header", text="中山市审计局文件", page_idx=0), dict(type="text", text="审计业务电子数据管理办法", text_level=1)]
+    for i in range(articles):
+        if i % per_chapter == 0:
+            blocks.append(dict(type="text", text=f"第{chinese_number(i // per_chapter % 99 + 1)}章 总则", text_level=1))
+        blocks.append(dict(type="text", text=f"第{chinese_number(i % 99 + 1)}条 数据管理", text_level=2))
+        blocks.append(dict(type="text", text="为了规范审计业务电子数据的采集、存储和使用，制定本办法。"))
+        if i % 7 == 0:
+            blocks.append(dict(
+                type="table", table_caption=["表1 数据清单"],
+                table_body="<table><tr><td>名称</td><td>格式</td></tr><tr><td>总账</td><td>xlsx</td></tr></table>"))
+        blocks.append(dict(type="page_number", text=str(i)))
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=20000)
+    args = parser.parse_args()
+
+    #NOTE a small document shows the slices
+    _, slices = mineru_result_to_slices({"request_id": "0", "data": synthetic_content_list(8, per_chapter=4)})
+    for slice in slices[:4]:
+        print(slice)
+    #NOTE a chapter without content is located at its heading, the header block is discarded before it
+    assert slices[0] == {"chapter": "审计业务电子数据管理办法", "article": "", "content": "", "start": 0, "end": 12}
+    assert slices[1]["chapter"] == "第一章 总则" and slices[1]["article"] == "第一条 数据管理"
+    assert "名称 | 格式\n总账 | xlsx" in slices[1]["content"]
+    assert all("中山市审计局文件" not in slice["content"] for slice in slices), "headers must be discarded"
+
+    #NOTE blocks without headings fall back to regex patterns
+    plain = [dict(type="text", text=block["text"]) for block in synthetic_content_list(8) if block.get("text")]
+    text, slices = mineru_result_to_slices({"data": plain})
+    assert slices is None and text.startswith("中山市审计局文件")
+    print(f"no heading -> {len(split_text(text))} slices by regex patterns")
+
+    blocks = synthetic_content_list(args.articles)
+    start = time.perf_counter()
+    _, json_slices = mineru_result_to_slices({"data": blocks})
+    json_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    regex_slices = split_text(get_mineru_text({"data": blocks}))
+    regex_seconds = time.perf_counter() - start
+    print(
+        f"{args.articles} articles: json blocks {len(json_slices)} slices in {json_seconds * 1000:.1f} ms, "
+        f"regex over their text {len(regex_slices)} slices in {regex_seconds * 1000:.1f} ms")
+    assert [s["article"] for s in json_slices if s["article"]] == [s["article"] for s in regex_slices if s["article"]]
+
+
+if __name__ == '__main__':
+    main()
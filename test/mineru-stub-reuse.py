@@ -0,0 +1,123 @@
+"""
+verify connection reuse, retries and circuit breaker of `request_mineru` against a local MinerU stub.
+
+run: python test/mineru-stub-reuse.py
+"""
+import os
+import sys
+import asyncio
+from pathlib import Path
+from contextlib import suppress
+
+from aiohttp import web
+
+STUB_PORT = 18765
+os.environ["MINERU_URL"] = f"http://127.0.0.1:{STUB_PORT}/parse"
+os.environ["MINERU_BACKOFF_BASE"] = "0.01"
+os.environ["MINERU_BREAKER_THRESHOLD"] = "3"
+os.environ["MINERU_BREAKER_RECOVERY"] = "0.5"
+sys.path.append(str(Path(__file__).parent.parent))
+
+from dd_parser.client import HTTP_CLIENT, MINERU_BREAKER, CircuitOpenError
+from dd_parser.tools import request_mineru
+
+peers = set() # (host, port) of every client connection seen by the stub
+fail_next = 0 # the stub returns 503 for the next `fail_next` requests
+garbage_next = 0 # the stub returns a non-json body for the next `garbage_next` requests
+hang_next = 0 # the stub never answers the next `hang_next` requests
+
+
+async def stub_parse(request:web.Request):
+    global fail_next, garbage_next, hang_next
+    peers.add(request.transport.get_extra_info("peername"))
+    form = await request.post()
+    if fail_next > 0:
+        fail_next -= 1
+        return web.Response(status=503)
+    if garbage_next > 0:
+        garbage_next -= 1
+        return web.Response(text="<html>gateway error</html>", content_type="text/html")
+    if hang_next > 0:
+        hang_next -= 1
+        await asyncio.sleep(3600)
+    return web.json_response(dict(request_id=form["request_id"], data=f"# {form['file'].filename}"))
+
+
+async def open_circuit():
+    global fail_next
+    fail_next = 100
+    with suppress(Exception):
+        await request_mineru("down", "markdown", b"fake pdf", "down.pdf")
+    assert MINERU_BREAKER.state == MINERU_BREAKER.OPEN
+    fail_next = 0
+    await asyncio.sleep(0.6)
+
+
+async def main():
+    global fail_next, garbage_next, hang_next
+    app = web.Application()
+    app.router.add_post("/parse", stub_parse)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+    await HTTP_CLIENT.start()
+    try:
+        #NOTE sequential requests must share one keep-alive connection
+        for i in range(20):
+            await request_mineru(str(i), "markdown", b"fake pdf", f"{i}.pdf")
+        print(f"20 sequential requests -> {len(peers)} connection(s)")
+        assert len(peers) == 1, peers
+
+        #NOTE transient failures are retried
+        fail_next = 2
+        data = await request_mineru("retry", "markdown", b"fake pdf", "retry.pdf")
+        print(f"retried through 2 failures -> {data}")
+
+        #NOTE persistent failures open the circuit, and later calls fail fast
+        fail_next = 100
+        try:
+            await request_mineru("down", "markdown", b"fake pdf", "down.pdf")
+        except Exception as e:
+            print(f"failed after retries -> {e!r}, circuit: {MINERU_BREAKER.state}")
+        try:
+            await request_mineru("fast", "markdown", b"fake pdf", "fast.pdf")
+        except CircuitOpenError as e:
+            print(f"fail fast -> {e}")
+
+        #NOTE the circuit closes once a trial call succeeds
+        fail_next = 0
+        await asyncio.sleep(0.6)
+        await request_mineru("recover", "markdown", b"fake pdf", "recover.pdf")
+        print(f"recovered, circuit: {MINERU_BREAKER.state}")
+
+        #NOTE a trial call failing with a non-json body opens the circuit again, instead of leaving it half open
+        await open_circuit()
+        garbage_next = 1
+        try:
+            await request_mineru("garbage", "markdown", b"fake pdf", "garbage.pdf")
+        except Exception as e:
+            print(f"trial call with non-json body -> {type(e).__name__}, circuit: {MINERU_BREAKER.state}")
+        assert MINERU_BREAKER.state == MINERU_BREAKER.OPEN
+        await asyncio.sleep(0.6)
+        await request_mineru("recover", "markdown", b"fake pdf", "recover.pdf")
+        assert MINERU_BREAKER.state == MINERU_BREAKER.CLOSED
+
+        #NOTE a cancelled trial call lets the next call try
+        await open_circuit()
+        hang_next = 1
+        trial = asyncio.create_task(request_mineru("hang", "markdown", b"fake pdf", "hang.pdf"))
+        await asyncio.sleep(0.2)
+        assert MINERU_BREAKER.state == MINERU_BREAKER.HALF_OPEN
+        trial.cancel()
+        with suppress(asyncio.CancelledError):
+            await trial
+        await request_mineru("recover", "markdown", b"fake pdf", "recover.pdf")
+        print(f"trial call cancelled, next call recovered, circuit: {MINERU_BREAKER.state}")
+        assert MINERU_BREAKER.state == MINERU_BREAKER.CLOSED
+    finally:
+        await HTTP_CLIENT.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
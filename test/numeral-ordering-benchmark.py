@@ -0,0 +1,91 @@
+"""
+check chinese numeral parsing and the ordering of chapters/articles split by regex patterns on large legal texts:
+references to articles wrapped to the start of a line (like `第十二条规定的情形除外。`) must stay body text,
+and splitting time must grow linearly with the size of the text.
+
+Example:
+    ```
+    python test/numeral-ordering-benchmark.py --articles 5000 10000 20000 40000
+    ```
+"""
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from dd_parser.numerals import int_to_chinese, chinese_to_int, get_heading_number
+from dd_parser.parse import regex_patterns, double_patterns_preprocess
+
+CASES = {
+    "十": 10, "十二": 12, "二十": 20, "一百零一": 101, "一百一十": 110, "一千零五十": 1050, "两千": 2000,
+    "二〇二三": 2023, "贰拾叁": 23, "12": 12, "１２": 12, "1百2十": 120, "三万五千": 35000, "一亿二千万": 120000000,
+}
+
+
+def legal_text(articles:int, references:float, seed:int=0) -> tuple[str, int]:
+    """
+    regulations of chapters of 10 articles, with `references` of articles followed by a line
+    starting with a reference to an earlier article. Returns the text and the number of references
+    """
+    rng = random.Random(seed)
+    lines, count = [], 0
+    for i in range(1, articles + 1):
+        if i % 10 == 1:
+            lines.append(f"第{int_to_chinese(i // 10 + 1)}章 总则")
+        lines.append(f"第{int_to_chinese(i)}条 审计机关应当依法履行职责，对被审计单位的财政收支进行审计监督，")
+        if i > 20 and rng.random() < references:
+            lines.append(f"第{int_to_chinese(rng.randrange(1, i - 5))}条规定的情形除外。")
+            count += 1
+    return "\n".join(lines), count
+
+
+def timed(func, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, nargs="+", default=[5000, 10000, 20000, 40000])
+    parser.add_argument("--references", type=float, default=0.05, help="ratio of articles followed by a wrapped reference")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for text, number in CASES.items():
+        assert chinese_to_int(text) == number, (text, chinese_to_int(text))
+    assert get_heading_number("第十二条 规定") == 12 and get_heading_number("（三）内容") == 3 and get_heading_number("审计") is None
+    for name, numbers in [("below 1000 (table)", range(1, 1000)), ("up to 200000 (read)", range(1000, 200000))]:
+        numerals = [int_to_chinese(n) for n in numbers]
+        seconds, parsed = timed(lambda: [chinese_to_int(numeral) for numeral in numerals])
+        assert parsed == list(numbers)
+        print(f"chinese_to_int {name}: {len(numerals)} numerals round trip, {seconds / len(numerals) * 1e9:.0f} ns per numeral")
+
+    patterns = regex_patterns["chapters_with_articles"]
+    chapter_pattern, article_pattern = patterns["chapter_pattern"], patterns["article_pattern"]
+    per_char = []
+    for articles in args.articles:
+        text, references = legal_text(articles, args.references)
+        unordered = min(
+            timed(double_patterns_preprocess, text, chapter_pattern, article_pattern, ordered=False)[0] for _ in range(args.repeat))
+        ordered, slices = min(
+            (timed(double_patterns_preprocess, text, chapter_pattern, article_pattern) for _ in range(args.repeat)),
+            key=lambda result: result[0])
+        _, unordered_slices = timed(double_patterns_preprocess, text, chapter_pattern, article_pattern, ordered=False)
+        assert len(slices) == articles, (len(slices), articles)
+        assert len(unordered_slices) == articles + references
+        assert all(slice["article"].startswith(f"第{int_to_chinese(i)}条") for i, slice in enumerate(slices, start=1))
+        per_char.append(ordered / len(text))
+        print(
+            f"{articles} articles ({len(text) / 1e6:.1f}M chars, {references} wrapped references): "
+            f"ordered {ordered * 1000:.1f} ms -> {len(slices)} slices, "
+            f"unordered {unordered * 1000:.1f} ms -> {len(unordered_slices)} slices")
+    print(f"time per char, largest / smallest text: {per_char[-1] / per_char[0]:.2f}")
+    assert per_char[-1] / per_char[0] < 2, "splitting time grows faster than linearly"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+measure accuracy and speed of `detect_regex_pattern` (samples) against `get_regex_pattern` (full scan).
+
+run:
+    python test/pattern-detection-accuracy.py [CORPUS_DIR]
+
+Files under CORPUS_DIR (.docx/.doc/.pdf/.md/.txt) are extracted by `get_pure_text`.
+A synthetic corpus of legal-like texts is used if CORPUS_DIR is not given.
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from dd_parser.parse import detect_regex_pattern, get_regex_pattern, regex_patterns
+from dd_parser.tools import get_pure_text
+from dd_parser.batch import SUPPORTED_SUFFIXES
+
+CHN = "零一二三四五六七八九"
+
+
+def to_chn(n:int) -> str:
+    if n < 10:
+        return CHN[n]
+    if n < 20:
+        return "十" + (CHN[n % 10] if n % 10 else "")
+    if n < 100:
+        return CHN[n // 10] + "十" + (CHN[n % 10] if n % 10 else "")
+    return CHN[n // 100] + "百" + (("零" + CHN[n % 10]) if n % 100 < 10 and n % 10 else (to_chn(n % 100) if n % 100 else ""))
+
+
+def synthetic_corpus(n:int=200, seed:int=42):
+    rng = random.Random(seed)
+    body = "为了加强预算管理，规范预算行为，依据有关法律法规，结合本单位实际，制定本制度。"
+    for i in range(n):
+        kind = rng.choice(["chapters", "articles", "dots", "plain", "chapters_only"])
+        lines = ["关于印发管理办法的通知", body * rng.randint(1, 5)]
+        article = 0
+        for c in range(1, rng.randint(3, 30)):
+            match kind:
+                case "chapters" | "chapters_only":
+                    lines.append(f"第{to_chn(c)}章 总则")
+                case "dots":
+                    lines.append(f"{to_chn(c)}、工作要求")
+            for _ in range(rng.randint(2, 20)):
+                article += 1
+                lines.extend([body * rng.randint(1, 6)] * rng.randint(0, 8)) #NOTE paragraphs of the article
+                match kind:
+                    case "chapters":
+                        lines.append(f"第{to_chn(article)}条 {body}")
+                    case "articles":
+                        lines.append(f"第{to_chn(article)}条 {body}")
+                        lines.extend(f"（{to_chn(k)}）{body}" for k in range(1, rng.randint(1, 4)))
+                    case "dots":
+                        lines.append(f"（{to_chn(article % 10 + 1)}）{body}")
+                    case _:
+                        lines.append(body * rng.randint(1, 6))
+        yield f"synthetic_{i}_{kind}", "\n".join(lines)
+
+
+def corpus_from_dir(corpus_dir:Path):
+    for filepath in sorted(corpus_dir.rglob("*")):
+        if filepath.suffix.lower() in SUPPORTED_SUFFIXES:
+            try:
+                yield filepath.name, get_pure_text(filepath)
+            except Exception as e:
+                print(f"skip {filepath}: {e!r}")
+
+
+def name_of(patterns) -> str:
+    for key, family in regex_patterns.items():
+        if patterns == (family["chapter_pattern"], family["article_pattern"]):
+            return key
+        if patterns is family["chapter_pattern"] or patterns is family["article_pattern"]:
+            return f"single:{patterns.pattern}"
+    return "none"
+
+
+def main():
+    corpus = corpus_from_dir(Path(sys.argv[1])) if len(sys.argv) > 1 else synthetic_corpus()
+    total = correct = fallbacks = 0
+    sample_seconds = full_seconds = 0.0
+    for name, text in corpus:
+        start = time.perf_counter()
+        expected = get_regex_pattern(text)
+        full_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        detected, confidence = detect_regex_pattern(text)
+        sample_seconds += time.perf_counter() - start
+
+        total += 1
+        fallbacks += confidence == 0.0
+        if name_of(detected) == name_of(expected):
+            correct += 1
+        else:
+            print(f"[mismatch] {name}: full scan {name_of(expected)}, samples {name_of(detected)} ({confidence:.2f})")
+    print(
+        f"{total} documents, accuracy {correct/total:.2%}, full-scan fallbacks {fallbacks/total:.2%}, "
+        f"full scan {full_seconds:.3f}s, samples {sample_seconds:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
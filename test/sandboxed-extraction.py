@@ -0,0 +1,82 @@
+"""
+check sandboxed extraction workers against hostile jobs: a hung job is killed by its timeout, a CPU burner by its CPU cap,
+a memory balloon by its address space cap and a crashing parser is reported, while the pool keeps serving other jobs.
+
+Example:
+    ```
+    python test/sandboxed-extraction.py
+    ```
+"""
+import os
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from dd_parser.sandbox import SandboxPool, ExtractionError
+
+
+def hang():
+    time.sleep(3600)
+
+
+def burn_cpu():
+    while True:
+        pass
+
+
+def balloon():
+    chunks = []
+    while True:
+        chunks.append(bytearray(64 * 1024 * 1024))
+
+
+def crash():
+    os.abort()
+
+
+def fail():
+    raise ValueError("not a valid document")
+
+
+def extract(i:int) -> str:
+    time.sleep(0.05)
+    return f"document {i}"
+
+
+async def run(pool:SandboxPool, func, *args, **kwargs) -> tuple[str, float]:
+    start = time.perf_counter()
+    try:
+        result = await pool.acall(func, *args, **kwargs)
+    except ExtractionError as e:
+        result = f"ExtractionError({e.reason})"
+    except ValueError as e:
+        result = f"ValueError({e})"
+    return result, time.perf_counter() - start
+
+
+async def main():
+    pool = SandboxPool("test", workers=4, timeout=2, cpu_limit=1, memory_limit=512)
+    hostile = [(hang, "ExtractionError(timeout)"), (burn_cpu, "ExtractionError(cpu)"), (balloon, "ExtractionError(memory)"),
+               (crash, "ExtractionError(crashed)"), (fail, "ValueError(not a valid document)")]
+    start = time.perf_counter()
+    #NOTE the CPU burner shares cpus with other jobs, its wall-clock timeout is longer so that its CPU cap is hit first
+    results = await asyncio.gather(
+        *(run(pool, func, timeout=30 if func is burn_cpu else None) for func, _ in hostile),
+        *(run(pool, extract, i) for i in range(20)))
+    for (func, expected), (result, seconds) in zip(hostile, results):
+        print(f"{func.__name__:>9}: {result} in {seconds:.2f}s")
+        if os.name != "nt" or func not in (burn_cpu, balloon):
+            assert result == expected, (func.__name__, result)
+    normal = results[len(hostile):]
+    assert [result for result, _ in normal] == [f"document {i}" for i in range(20)]
+    print(
+        f"20 normal jobs next to {len(hostile)} hostile ones done in {time.perf_counter() - start:.2f}s, "
+        f"slowest {max(seconds for _, seconds in normal):.2f}s, {pool.stats()}")
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,157 @@
+"""
+check the source metadata of slices: `start`/`end` offsets of every slice in the extracted text by the regex, markdown and MinerU splitters,
+`pages` of pdf slices, `paragraphs` of docx slices, and the stage timings of the `Server-Timing` header.
+Reports what tracking offsets costs the splitters.
+
+Example:
+    ```
+    python test/slice-source-metadata.py --articles 20000
+    ```
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from loadtest import make_document
+from dd_parser.parse import split_text, mineru_result_to_slices
+from dd_parser.mineru import get_mineru_text, get_content_list, get_page_index
+from dd_parser.offsets import LineOffsets, UnitIndex, add_unit_numbers
+from dd_parser.timing import request_timer, stage_timer
+
+MARKDOWN = """\
+审计业务电子数据管理办法
+========================
+
+## 第一章 总则
+  第一条 为了规范审计业务电子数据管理，制定本办法。  \r
+第二条 本办法适用于审计机关。
+
+```text
+## 不是标题
+```
+
+| 名称 | 格式 |
+| --- | --- |
+| 总账 | xlsx |
+
+## 第二章 附则
+
+## 第三章 实施
+- 本办法自发布之日起施行。
+"""
+
+
+def check_offsets(text:str, slices:list[dict]) -> int:
+    """the source `text[start:end]` of every slice starts with the first line of its content and ends with its last line"""
+    for slice in slices:
+        source = text[slice["start"]:slice["end"]]
+        lines = [line.strip() for line in slice["content"].splitlines() if line.strip()]
+        if not lines:
+            assert slice["chapter"].strip("# ") in source, (slice, source)
+            continue
+        assert source == source.strip(), f"source must be stripped: {source!r}"
+        assert source.startswith(lines[0]) or lines[0] in source.splitlines()[0], (lines[0], source[:80])
+        assert source.endswith(lines[-1]) or lines[-1] in source.splitlines()[-1], (lines[-1], source[-80:])
+    return len(slices)
+
+
+def check_splitters():
+    text = make_document("txt", 0, 40).decode("utf-8")
+    crlf = "  前言\r\n" + text.replace("\n", "\r\n") + "\r\n\r\n"
+    print(f"regex: {check_offsets(crlf, split_text(crlf))} slices located in a CRLF text")
+    print(f"markdown: {check_offsets(MARKDOWN, split_text(MARKDOWN, split_mode='markdown'))} slices located")
+
+    blocks = [dict(type="header", text="中山市审计局文件", page_idx=0), dict(type="text", text="审计业务电子数据管理办法", text_level=1, page_idx=0)]
+    for i in range(1, 13):
+        if i % 4 == 1:
+            blocks.append(dict(type="text", text=f"第{i // 4 + 1}章 总则", text_level=1, page_idx=i // 3))
+        blocks.append(dict(type="text", text=f"第{i}条 数据管理", text_level=2, page_idx=i // 3))
+        blocks.append(dict(type="text", text="为了规范审计业务电子数据的采集、存储和使用，制定本办法。", page_idx=i // 3))
+    _, slices = mineru_result_to_slices({"data": blocks})
+    mineru_text = get_mineru_text({"data": blocks})
+    check_offsets(mineru_text, slices)
+    add_unit_numbers(slices, "pages", get_page_index(get_content_list({"data": blocks})))
+    for slice in slices:
+        article = slice["article"]
+        if article:
+            expected = int(article[1:article.index("条")]) // 3 + 1
+            assert slice["pages"] == [expected, expected], (slice, expected)
+    print(f"mineru: {len(slices)} slices located, pages {slices[1]['pages']} .. {slices[-1]['pages']}")
+
+
+def check_units():
+    from dd_parser.tools import get_docx_paragraphs
+    from dd_parser.ocr import get_pdf_text_with_ocr
+    import tempfile
+
+    pages = get_pdf_text_with_ocr(make_document("pdf", 0, 60))
+    text = "\n".join(pages)
+    slices = add_unit_numbers(split_text(text), "pages", UnitIndex.from_texts(pages, first=1))
+    for slice in slices:
+        first, last = slice["pages"]
+        lines = [line.strip() for line in slice["content"].splitlines() if line.strip()] or [slice["chapter"]]
+        assert lines[0] in pages[first - 1] and lines[-1] in pages[last - 1], (slice, first, last)
+    print(f"pdf: {len(pages)} pages, {len(slices)} slices located in them")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = Path(tmp) / "document.docx"
+        filepath.write_bytes(make_document("docx", 0, 40))
+        paragraphs = get_docx_paragraphs(filepath)
+    text = "\n".join(paragraphs)
+    slices = add_unit_numbers(split_text(text), "paragraphs", UnitIndex.from_texts(paragraphs))
+    for slice in slices:
+        first, last = slice["paragraphs"]
+        lines = [line.strip() for line in slice["content"].splitlines() if line.strip()] or [slice["chapter"]]
+        assert lines[0] in paragraphs[first] and lines[-1] in paragraphs[last], (slice, first, last)
+    print(f"docx: {len(paragraphs)} paragraphs, {len(slices)} slices located in them")
+
+
+def check_timing():
+    with stage_timer("split"): #NOTE a no-op outside requests
+        pass
+    with request_timer() as timer:
+        for _ in range(2):
+            with stage_timer("split"):
+                time.sleep(0.01)
+        with stage_timer("format"):
+            pass
+    header = timer.server_timing()
+    names = [metric.split(";")[0] for metric in header.split(", ")]
+    assert names == ["split", "format", "total"], header
+    assert timer.stages["split"] >= 20, "a stage entered twice is summed up"
+    print(f"Server-Timing: {header}")
+
+
+def benchmark(articles:int, repeat:int=5):
+    text = make_document("txt", 0, articles).decode("utf-8")
+    markdown = make_document("md", 0, articles).decode("utf-8")
+    for name, source, mode in [("regex", text, "regex"), ("markdown", markdown, "markdown")]:
+        seconds = min(timed(split_text, source, split_mode=mode) for _ in range(repeat))
+        offsets = min(timed(LineOffsets, source) for _ in range(repeat))
+        print(
+            f"{name}: {len(source) / 1e6:.1f}M chars split in {seconds * 1000:.1f} ms, "
+            f"of which line offsets {offsets * 1000:.1f} ms")
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=20000)
+    args = parser.parse_args()
+
+    check_splitters()
+    check_units()
+    check_timing()
+    benchmark(args.articles)
+
+
+if __name__ == '__main__':
+    main()
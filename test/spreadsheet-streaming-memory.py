@@ -0,0 +1,73 @@
+"""
+check that xlsx row groups are streamed: rows are never loaded at once, and peak memory stays far below the size of the sheet.
+
+Writes workbooks of growing row counts (requires `openpyxl`), then walks their slices without keeping them,
+and reports peak memory allocated by python while reading.
+
+Example:
+    ```
+    python test/spreadsheet-streaming-memory.py --rows 10000 100000 300000
+    ```
+"""
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+from openpyxl import Workbook
+
+from dd_parser.spreadsheet import iter_xlsx_sheets, iter_sheet_slices
+
+
+def write_workbook(filepath:Path, rows:int):
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("审计台账")
+    worksheet.append(["序号", "单位", "科目", "金额", "日期", "备注"])
+    for i in range(rows):
+        worksheet.append([i + 1, f"单位{i % 97}", f"科目{i % 13}", i * 1.5, f"2025-{i % 12 + 1:02d}-01", "无"])
+    workbook.save(str(filepath))
+
+
+def walk_slices(filepath:Path, length_limit:int) -> tuple[int, int, bool]:
+    slices = 0
+    rows = 0
+    header_repeated = True
+    for sheet_name, sheet_rows in iter_xlsx_sheets(filepath):
+        for slice in iter_sheet_slices(sheet_name, sheet_rows, length_limit):
+            slices += 1
+            lines = slice["content"].split("\n")
+            rows += len(lines) - 1
+            header_repeated &= lines[0].startswith("序号 | 单位") and len(slice["content"]) <= length_limit
+    return slices, rows, header_repeated
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 300000])
+    parser.add_argument("--length-limit", type=int, default=4000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for rows in args.rows:
+            filepath = Path(temp_dir) / f"{rows}.xlsx"
+            write_workbook(filepath, rows)
+            start = time.perf_counter()
+            slices, read_rows, header_repeated = walk_slices(filepath, args.length_limit)
+            elapsed = time.perf_counter() - start
+            #NOTE tracing slows reading down, trace another pass for peak memory
+            tracemalloc.start()
+            walk_slices(filepath, args.length_limit)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f"{rows:>8} rows ({filepath.stat().st_size / 1024 / 1024:.1f} MB): {slices} slices, "
+                f"{read_rows} rows read, header repeated and bounded: {header_repeated}, "
+                f"peak {peak / 1024 / 1024:.2f} MB, {rows / elapsed:.0f} rows/s")
+            assert read_rows == rows and header_repeated
+
+
+if __name__ == '__main__':
+    main()
@@ -68,7 +68,7 @@ async def get_reranker(
     
 
 async def main():
-    with aiohttp.ClientSession(
+    async with aiohttp.ClientSession(
         "http://172.29.1.239:9000/v1/",
         connector=aiohttp.TCPConnector(ssl=False,limit=80,),
         timeout=aiohttp.ClientTimeout(20.0),
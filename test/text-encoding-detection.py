@@ -0,0 +1,48 @@
+"""
+check encoding detection and newline normalization of .txt/.md uploads, and decoding throughput.
+
+Example:
+    ```
+    python test/text-encoding-detection.py --megabytes 20
+    ```
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+from dd_parser.decoding import decode_bytes
+
+TEXT = "第一章 总则\r\n第一条 为了规范审计业务，制定本制度。\r\nASCII line\rmixed 𠀀\n"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=20)
+    args = parser.parse_args()
+
+    expected = TEXT.replace("\r\n", "\n").replace("\r", "\n")
+    #NOTE `utf-16`/`utf-32` encoders write a BOM. A tiny chunk size splits characters and `\r\n` across chunks
+    for encoding in ["utf-8", "utf-8-sig", "gb18030", "utf-16", "utf-32"]:
+        for chunk_size in [3, 1024]:
+            text, detected = decode_bytes(TEXT.encode(encoding), chunk_size=chunk_size)
+            assert text == expected, (encoding, chunk_size, text)
+        print(f"{encoding:>10} -> {detected}")
+    #NOTE GBK texts saved by Windows have no BOM, and decode as GB18030
+    text, detected = decode_bytes(expected.replace("𠀀", "").encode("gbk"))
+    assert detected == "gb18030" and text == expected.replace("𠀀", "")
+    print(f"{'gbk':>10} -> {detected}")
+
+    for encoding in ["utf-8", "gb18030"]:
+        data = (TEXT * (args.megabytes * 1024 * 1024 // len(TEXT.encode(encoding)))).encode(encoding)
+        start = time.perf_counter()
+        text, detected = decode_bytes(data)
+        elapsed = time.perf_counter() - start
+        assert detected == encoding and "\r" not in text
+        print(f"{encoding:>10}: {len(data) / 1024 / 1024:.1f} MB in {elapsed * 1000:.0f} ms, {len(data) / 1024 / 1024 / elapsed:.0f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
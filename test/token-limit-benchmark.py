@@ -0,0 +1,101 @@
+"""
+benchmark `limit_unit=token` against `limit_unit=char` of `format_txt_slices`.
+
+run:
+    TOKENIZER_PATH=/path/to/tokenizer.json python test/token-limit-benchmark.py [--length-limit 512]
+
+Runs offline. If TOKENIZER_PATH is not given, a small BPE tokenizer is trained on the synthetic corpus
+(requires `tokenizers`) and saved into a temporary file to stand in for the tokenizer of the embedding model.
+Reports formatting time (cold and warm line cache), and how far chunks of both modes land from the token budget.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+WORDS = ["audit", "budget", "ledger", "compliance", "Q3", "2025", "ERP", "SAP", "VAT", "IFRS", "cash-flow", "KPI"]
+CHN = "预算管理规范行为依据有关法律法规结合单位实际制定本制度审计监督财务报告内部控制资产负债"
+
+
+def synthetic_slices(n:int, seed:int=42) -> list[dict]:
+    rng = random.Random(seed)
+    slices = []
+    for i in range(n):
+        lines = []
+        for _ in range(rng.randint(1, 8)):
+            parts = []
+            for _ in range(rng.randint(3, 20)):
+                if rng.random() < 0.6:
+                    parts.append("".join(rng.choice(CHN) for _ in range(rng.randint(2, 8))))
+                else:
+                    parts.append(f" {rng.choice(WORDS)} ")
+            lines.append("".join(parts) + "。")
+        slices.append(dict(chapter=f"第{i // 10 + 1}章 总则", article=f"第{i + 1}条", content="\n".join(lines)))
+    return slices
+
+
+def train_tokenizer(slices:list[dict], path:str):
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers
+    tokenizer = Tokenizer(models.BPE(unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["[UNK]"])
+    tokenizer.train_from_iterator((s["content"] for s in slices), trainer=trainer)
+    tokenizer.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slices", type=int, default=20000)
+    parser.add_argument("--length-limit", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    slices = synthetic_slices(args.slices)
+    temp_dir = tempfile.TemporaryDirectory()
+    if not os.getenv("TOKENIZER_PATH"):
+        os.environ["TOKENIZER_PATH"] = str(Path(temp_dir.name) / "tokenizer.json")
+        train_tokenizer(slices, os.environ["TOKENIZER_PATH"])
+        print(f"trained a BPE tokenizer on the synthetic corpus: {os.environ['TOKENIZER_PATH']}")
+
+    #NOTE imported after TOKENIZER_PATH is set, config reads it on import
+    from dd_parser.parse import format_txt_slices
+    from dd_parser.tokenizer import get_token_counter
+
+    counter = get_token_counter()
+    splitter = "\n\n\n\n"
+    chars = sum(len(s["content"]) for s in slices)
+    print(f"{len(slices)} slices, {chars} characters, length limit {args.length_limit}")
+
+    def run(limit_unit:str) -> tuple[float, str]:
+        start = time.perf_counter()
+        text = format_txt_slices(
+            slices, filename="bench.txt", filename_in_chunk=True,
+            length_limit=args.length_limit, splitter=splitter, limit_unit=limit_unit)
+        return time.perf_counter() - start, text
+
+    def budget_report(text:str) -> str:
+        tokens = counter.count_texts(text.split(splitter))
+        over = sum(count > args.length_limit for count in tokens)
+        fill = sum(tokens) / len(tokens) / args.length_limit
+        return f"{len(tokens)} chunks, max {max(tokens)} tokens, {over} over budget, mean fill {fill:.0%}"
+
+    char_seconds = min(run("char")[0] for _ in range(args.repeat))
+    _, char_text = run("char")
+    cold_seconds, token_text = run("token")
+    warm_seconds = min(run("token")[0] for _ in range(args.repeat))
+    stats = counter.stats()
+
+    print(f"char  mode: {char_seconds * 1000:8.1f} ms, {budget_report(char_text)}")
+    print(f"token mode: {cold_seconds * 1000:8.1f} ms cold, {warm_seconds * 1000:8.1f} ms warm "
+          f"({warm_seconds / char_seconds:.1f}x char), {budget_report(token_text)}")
+    print(f"line cache: {stats['size']} lines, hit rate {stats['hit_rate']:.1%}")
+    temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()